@@ -1,11 +1,38 @@
 """
 Chats API - endpoints для работы с чатами
 """
-from flask import Blueprint, request, jsonify, session, current_app
+from flask import Blueprint, request, session, current_app, stream_with_context
+from collections import OrderedDict
+from contextlib import nullcontext
+from datetime import datetime, timezone
 from functools import wraps
+import base64
+import binascii
+import json
 import logging
 from logging.handlers import RotatingFileHandler
 import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from avito_api import get_avito_api
+from database import get_db_connection, get_db_reader, is_sqlite_io_error
+from services.messenger_service import MessengerService, chat_sort_key
+from services.sync_service import SyncService
+from tasks import enqueue_extract_product_urls, enqueue_sync_all_chats, get_job_status, RQ_AVAILABLE, redis_conn
+from utils.decorators import retry_on_sqlite_busy
+from utils.helpers import DIRECT_PRODUCT_URL_KEYS, first_present, normalize_avito_url
+from utils.ratelimit import TokenBucket
+from utils.validators import validate_send_message
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 # Настройка логирования для этого модуля
 # Используем тот же logger, что и в app.py для консистентности
@@ -18,24 +45,537 @@ def handle_errors(f):
     def decorated_function(*args, **kwargs):
         try:
             return f(*args, **kwargs)
+        except sqlite3.OperationalError as db_error:
+            # Сюда попадают ошибки, которые не помог обойти @retry_on_sqlite_busy
+            if is_sqlite_io_error(db_error):
+                logger.error(f"[{f.__name__}] Disk I/O error: {db_error}")
+                return _json({
+                    'error': 'Internal server error',
+                    'message': 'disk I/O error',
+                    'code': 'DISK_IO_ERROR'
+                }), 500
+            logger.error(f"[{f.__name__}] Database error: {db_error}", exc_info=True)
+            return _json({
+                'error': 'Internal server error',
+                'message': str(db_error),
+                'code': 'DB_ERROR'
+            }), 500
         except Exception as error:
             logger.error(f"Ошибка в {f.__name__}: {error}", exc_info=True)
-            return jsonify({'error': str(error), 'code': 'INTERNAL_ERROR'}), 500
+            return _json({'error': str(error), 'code': 'INTERNAL_ERROR'}), 500
     return decorated_function
 
 chats_bp = Blueprint('chats_api', __name__, url_prefix='/api/chats')
 
 
+def _json_default(obj):
+    """Сериализация типов, которые не поддерживает JSON-энкодер"""
+    if isinstance(obj, sqlite3.Row):
+        return dict(obj)
+    return str(obj)
+
+
+def _json_encode(payload) -> bytes:
+    """Сериализует значение в JSON (bytes) через orjson, если он установлен, иначе через json"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(payload, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, ensure_ascii=False, default=_json_default).encode('utf-8')
+
+
+def _json(payload, status=200, headers=None):
+    """
+    JSON-ответ через orjson (C-энкодер), если он установлен, иначе через json.
+
+    Замена jsonify для списков чатов и сообщений до 500 элементов.
+    """
+    return current_app.response_class(_json_encode(payload), status=status, headers=headers,
+                                      mimetype='application/json')
+
+
+# Сколько элементов списка кодируется в один фрагмент потокового ответа
+_STREAM_CHUNK_ITEMS = 50
+
+
+def _json_items_stream(items, extra, headers=None):
+    """
+    Потоковый JSON-ответ вида {"items": [...], **extra}.
+
+    Элементы кодируются и отдаются фрагментами по _STREAM_CHUNK_ITEMS штук,
+    поэтому весь ответ не собирается в памяти одним буфером, а первые байты
+    уходят клиенту сразу.
+    """
+    def generate():
+        yield b'{"items":['
+        for start in range(0, len(items), _STREAM_CHUNK_ITEMS):
+            chunk = b','.join(_json_encode(item) for item in items[start:start + _STREAM_CHUNK_ITEMS])
+            yield chunk if start == 0 else b',' + chunk
+        yield b']'
+        for key, value in extra.items():
+            yield b',' + _json_encode(key) + b':' + _json_encode(value)
+        yield b'}'
+
+    return current_app.response_class(stream_with_context(generate()), headers=headers,
+                                      mimetype='application/json')
+
+
+def _sse_event(event, data):
+    """Одно событие Server-Sent Events с JSON в поле data"""
+    return b'event: ' + event.encode('ascii') + b'\ndata: ' + _json_encode(data) + b'\n\n'
+
+
+def _sse_response(events):
+    """
+    Ответ text/event-stream из генератора событий (_sse_event).
+
+    X-Accel-Buffering: no отключает буферизацию в nginx, чтобы каждое событие
+    уходило клиенту сразу и соединение не простаивало до таймаута.
+    """
+    return current_app.response_class(
+        stream_with_context(events), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+# SQL-запросы горячих обработчиков вынесены в константы: один и тот же объект
+# строки попадает в кэш подготовленных выражений соединения (cached_statements)
+_SQL_GET_CHAT_MANAGER = 'SELECT assigned_manager_id FROM avito_chats WHERE id = ?'
+
+# У магазина заданы все ключи Avito API (пустые строки и user_id = 0 не считаются)
+_SQL_HAS_CREDS = (
+    "(COALESCE(s.client_id, '') <> '' AND COALESCE(s.client_secret, '') <> ''"
+    " AND COALESCE(s.user_id, 0) NOT IN (0, ''))"
+)
+
+_SQL_SELECT_CHATS_WITHOUT_URL = f'''
+    SELECT ac.id, ac.chat_id, ac.shop_id, s.client_id, s.client_secret, s.user_id, s.shop_url
+    FROM avito_chats ac
+    JOIN avito_shops s ON ac.shop_id = s.id
+    WHERE (ac.product_url IS NULL OR ac.product_url = '')
+    AND ac.id > ?
+    AND {_SQL_HAS_CREDS}
+    ORDER BY ac.id
+    LIMIT ?
+'''
+
+# Перевод устаревшего offset в курсор: id последнего чата, пропускаемого
+# смещением (выполняется один раз на запрос, дальше страница берется по ac.id > ?)
+_SQL_CHAT_ID_AT_OFFSET_WITHOUT_URL = f'''
+    SELECT ac.id
+    FROM avito_chats ac
+    JOIN avito_shops s ON ac.shop_id = s.id
+    WHERE (ac.product_url IS NULL OR ac.product_url = '')
+    AND {_SQL_HAS_CREDS}
+    ORDER BY ac.id
+    LIMIT 1 OFFSET ?
+'''
+
+_SQL_COUNT_CHATS_WITHOUT_URL = f'''
+    SELECT COUNT(*) AS cnt
+    FROM avito_chats ac
+    JOIN avito_shops s ON ac.shop_id = s.id
+    WHERE (ac.product_url IS NULL OR ac.product_url = '')
+    AND {_SQL_HAS_CREDS}
+'''
+
+# Количество чатов без product_url нужно только для сообщения о прогрессе,
+# поэтому кэшируется (в Redis, если он доступен, иначе в памяти процесса)
+# и уменьшается на число сохраненных URL вместо пересчета на каждой странице
+_TOTAL_WITHOUT_URL_TTL = int(os.environ.get('TOTAL_WITHOUT_URL_TTL', '60'))
+_TOTAL_WITHOUT_URL_KEY = 'extract:total_without_url'
+_total_without_url_cache = {}  # {'value': int, 'expires_at': float}
+_total_without_url_lock = threading.Lock()
+
+# Чаты, для которых Avito API ответил без ссылки на объявление: повторный
+# POST /extract-product-url в течение NO_PRODUCT_URL_TTL не запрашивает API.
+# Redis, если доступен, иначе память процесса ({ключ: expires_at})
+_NO_PRODUCT_URL_TTL = int(os.environ.get('NO_PRODUCT_URL_TTL', '3600'))
+_NO_PRODUCT_URL_KEY_PREFIX = 'no_product_url:'
+_NO_PRODUCT_URL_MAXSIZE = 10000
+_no_product_url_cache = OrderedDict()
+_no_product_url_lock = threading.Lock()
+
+# product_url, найденные через Avito API, по chat_id Avito: повторный прогон
+# страницы (после таймаута или неудачной записи) не запрашивает API заново.
+# Redis-хеш, если доступен, иначе память процесса ({chat_id: (expires_at, url)})
+_RESOLVED_URLS_TTL = int(os.environ.get('RESOLVED_URLS_TTL', '86400'))
+_RESOLVED_URLS_KEY = 'avito:chat_items'
+_RESOLVED_URLS_MAXSIZE = 10000
+_resolved_urls_cache = OrderedDict()
+_resolved_urls_lock = threading.Lock()
+
+_SQL_SET_PRODUCT_URL = '''
+    UPDATE avito_chats
+    SET product_url = ?, updated_at = CURRENT_TIMESTAMP
+    WHERE id = ?
+'''
+# Размер пачки executemany при сохранении найденных product_url
+_PRODUCT_URL_BATCH_SIZE = 500
+
+# Параллельная обработка в extract_all_product_urls: число потоков и лимит
+# частоты запросов к Avito API (запросов в секунду и допустимый всплеск)
+_EXTRACT_MAX_WORKERS = int(os.environ.get('EXTRACT_MAX_WORKERS', '8'))
+_EXTRACT_RATE_PER_SEC = float(os.environ.get('AVITO_API_RATE_PER_SEC', '5'))
+_EXTRACT_RATE_BURST = int(os.environ.get('AVITO_API_RATE_BURST', '10'))
+
+_SQL_GET_CHAT_CONTEXT = f'''
+    SELECT ac.*, s.client_id, s.client_secret, s.user_id, {_SQL_HAS_CREDS} AS has_creds
+    FROM avito_chats ac
+    JOIN avito_shops s ON ac.shop_id = s.id
+    WHERE ac.id = ?
+'''
+
+_SQL_SET_LAST_SYNC_AT = 'UPDATE avito_chats SET last_sync_at = CURRENT_TIMESTAMP WHERE id = ?'
+
+# Минимальный интервал между синхронизациями сообщений чата в GET /messages?sync=true
+_MESSAGES_SYNC_TTL = float(os.environ.get('MESSAGES_SYNC_TTL', '10'))
+
+# Кэш строки чата с учетными данными магазина: открытие чата (GET /messages)
+# и последующие POST /send, /block читают одну и ту же строку.
+# {chat_id: (expires_at, chat_dict)}, вытесняются самые старые записи.
+_CHAT_CONTEXT_TTL = float(os.environ.get('CHAT_CONTEXT_TTL', '30'))
+_CHAT_CONTEXT_MAXSIZE = 2048
+_chat_context_cache = OrderedDict()
+_chat_context_lock = threading.Lock()
+
+
 def require_auth(f):
     """Декоратор проверки аутентификации"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
-            return jsonify({'error': 'Not authenticated'}), 401
+            return _json({'error': 'Not authenticated'}), 401
         return f(*args, **kwargs)
     return decorated_function
 
 
+def _encode_chat_cursor(chat: dict) -> str:
+    """Кодирует ключ сортировки последнего чата (chat_sort_key) в непрозрачный курсор"""
+    raw = json.dumps(chat_sort_key(chat), default=str)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def _decode_chat_cursor(cursor: str):
+    """
+    Декодирует курсор, полученный от _encode_chat_cursor.
+
+    Returns:
+        tuple | None: (ранг таймера, response_timer, updated_at, id) или None для первой страницы
+
+    Raises:
+        ValueError: Если курсор поврежден
+    """
+    if not cursor:
+        return None
+    try:
+        rank, response_timer, updated_at, chat_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if isinstance(response_timer, bool) or not isinstance(response_timer, (int, float)):
+            raise ValueError('response_timer must be a number')
+        return int(rank), response_timer, str(updated_at), int(chat_id)
+    except (binascii.Error, UnicodeError, TypeError, ValueError) as e:
+        raise ValueError(f'Invalid cursor: {e}') from e
+
+
+def get_chat_context(conn, chat_id: int):
+    """
+    Получить чат вместе с client_id, client_secret и user_id магазина.
+
+    Строка кэшируется в памяти процесса на CHAT_CONTEXT_TTL секунд;
+    обработчики, изменяющие чат, сбрасывают запись через invalidate_chat_context.
+
+    Returns:
+        dict | None: Данные чата или None, если чат не найден
+    """
+    now = time.monotonic()
+    with _chat_context_lock:
+        entry = _chat_context_cache.get(chat_id)
+        if entry and entry[0] > now:
+            _chat_context_cache.move_to_end(chat_id)
+            return dict(entry[1])
+
+    row = conn.execute(_SQL_GET_CHAT_CONTEXT, (chat_id,)).fetchone()
+    if not row:
+        return None
+    chat = dict(row)
+
+    with _chat_context_lock:
+        _chat_context_cache[chat_id] = (now + _CHAT_CONTEXT_TTL, chat)
+        _chat_context_cache.move_to_end(chat_id)
+        while len(_chat_context_cache) > _CHAT_CONTEXT_MAXSIZE:
+            _chat_context_cache.popitem(last=False)
+    return dict(chat)
+
+
+def invalidate_chat_context(chat_id: int = None):
+    """Сбросить кэш get_chat_context для чата (или целиком, если chat_id не указан)"""
+    with _chat_context_lock:
+        if chat_id is None:
+            _chat_context_cache.clear()
+        else:
+            _chat_context_cache.pop(chat_id, None)
+
+
+def _save_product_urls(conn, updates):
+    """
+    Сохранить найденные product_url одной транзакцией.
+
+    BEGIN IMMEDIATE сразу берет блокировку записи (вместо ее повышения посреди
+    транзакции), строки пишутся через executemany пачками по _PRODUCT_URL_BATCH_SIZE.
+
+    Args:
+        updates (list): Пары (product_url, id чата)
+    """
+    if not updates:
+        return
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+    try:
+        for start in range(0, len(updates), _PRODUCT_URL_BATCH_SIZE):
+            conn.executemany(_SQL_SET_PRODUCT_URL, updates[start:start + _PRODUCT_URL_BATCH_SIZE])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    _decrement_total_without_url(len(updates))
+
+
+def _known_without_product_url(avito_chat_id) -> bool:
+    """Avito API недавно (NO_PRODUCT_URL_TTL) не вернул ссылку на объявление для чата"""
+    if not avito_chat_id:
+        return False
+    key = f'{_NO_PRODUCT_URL_KEY_PREFIX}{avito_chat_id}'
+    if redis_conn is not None:
+        try:
+            return bool(redis_conn.exists(key))
+        except Exception:
+            return False
+    with _no_product_url_lock:
+        expires_at = _no_product_url_cache.get(key)
+        if expires_at is None:
+            return False
+        if expires_at > time.monotonic():
+            return True
+        del _no_product_url_cache[key]
+        return False
+
+
+def _remember_without_product_url(avito_chat_id):
+    """Запомнить на NO_PRODUCT_URL_TTL секунд, что у чата нет ссылки на объявление"""
+    if not avito_chat_id:
+        return
+    key = f'{_NO_PRODUCT_URL_KEY_PREFIX}{avito_chat_id}'
+    if redis_conn is not None:
+        try:
+            redis_conn.setex(key, _NO_PRODUCT_URL_TTL, 1)
+        except Exception:
+            pass
+        return
+    with _no_product_url_lock:
+        _no_product_url_cache[key] = time.monotonic() + _NO_PRODUCT_URL_TTL
+        _no_product_url_cache.move_to_end(key)
+        while len(_no_product_url_cache) > _NO_PRODUCT_URL_MAXSIZE:
+            _no_product_url_cache.popitem(last=False)
+
+
+def _get_resolved_product_urls(avito_chat_ids) -> dict:
+    """Ранее найденные product_url для чатов Avito: {avito_chat_id: product_url}"""
+    avito_chat_ids = [cid for cid in avito_chat_ids if cid]
+    if not avito_chat_ids:
+        return {}
+    if redis_conn is not None:
+        try:
+            values = redis_conn.hmget(_RESOLVED_URLS_KEY, avito_chat_ids)
+        except Exception:
+            return {}
+        return {cid: url for cid, url in zip(avito_chat_ids, values) if url}
+    now = time.monotonic()
+    found = {}
+    with _resolved_urls_lock:
+        for cid in avito_chat_ids:
+            entry = _resolved_urls_cache.get(cid)
+            if entry and entry[0] > now:
+                found[cid] = entry[1]
+    return found
+
+
+def _remember_resolved_product_urls(resolved: dict):
+    """Запомнить найденные product_url ({avito_chat_id: product_url}) на RESOLVED_URLS_TTL"""
+    if not resolved:
+        return
+    if redis_conn is not None:
+        try:
+            pipe = redis_conn.pipeline()
+            pipe.hset(_RESOLVED_URLS_KEY, mapping=resolved)
+            pipe.expire(_RESOLVED_URLS_KEY, _RESOLVED_URLS_TTL)
+            pipe.execute()
+        except Exception:
+            pass
+        return
+    expires_at = time.monotonic() + _RESOLVED_URLS_TTL
+    with _resolved_urls_lock:
+        for cid, url in resolved.items():
+            _resolved_urls_cache[cid] = (expires_at, url)
+            _resolved_urls_cache.move_to_end(cid)
+        while len(_resolved_urls_cache) > _RESOLVED_URLS_MAXSIZE:
+            _resolved_urls_cache.popitem(last=False)
+
+
+def _get_total_without_url(conn) -> int:
+    """
+    Количество чатов без product_url (с ключами Avito у магазина).
+
+    Значение кэшируется на TOTAL_WITHOUT_URL_TTL секунд: в Redis (общий кэш
+    для всех воркеров) или, если Redis недоступен, в памяти процесса.
+    """
+    if redis_conn is not None:
+        try:
+            cached = redis_conn.get(_TOTAL_WITHOUT_URL_KEY)
+            if cached is not None:
+                return max(int(cached), 0)
+        except Exception as e:
+            logger.warning("[EXTRACT ALL] Redis недоступен для кэша total_without_url: %s", e)
+    else:
+        with _total_without_url_lock:
+            if _total_without_url_cache.get('expires_at', 0) > time.monotonic():
+                return _total_without_url_cache['value']
+
+    row = conn.execute(_SQL_COUNT_CHATS_WITHOUT_URL).fetchone()
+    total = row['cnt'] if row else 0
+
+    if redis_conn is not None:
+        try:
+            redis_conn.setex(_TOTAL_WITHOUT_URL_KEY, _TOTAL_WITHOUT_URL_TTL, total)
+        except Exception:
+            pass
+    else:
+        with _total_without_url_lock:
+            _total_without_url_cache['value'] = total
+            _total_without_url_cache['expires_at'] = time.monotonic() + _TOTAL_WITHOUT_URL_TTL
+    return total
+
+
+def _decrement_total_without_url(extracted: int):
+    """Уменьшить закэшированное количество чатов без product_url на число сохраненных URL"""
+    if not extracted:
+        return
+    if redis_conn is not None:
+        try:
+            # DECRBY на отсутствующем ключе создал бы отрицательное значение без TTL
+            if redis_conn.exists(_TOTAL_WITHOUT_URL_KEY):
+                redis_conn.decrby(_TOTAL_WITHOUT_URL_KEY, extracted)
+        except Exception:
+            pass
+        return
+    with _total_without_url_lock:
+        if 'value' in _total_without_url_cache:
+            _total_without_url_cache['value'] = max(_total_without_url_cache['value'] - extracted, 0)
+
+
+# Поля с product_url в ответе get_chat_by_id, в порядке приоритета:
+# контейнер объявления в context и ссылка внутри него
+# (прямые поля чата - DIRECT_PRODUCT_URL_KEYS)
+_CTX_KEYS = ('value', 'item', 'listing', 'ad')
+_URL_KEYS = ('url', 'link', 'href', 'value', 'uri')
+
+
+def _shop_url_part(shop_url: str) -> str:
+    """Последний сегмент shop_url магазина (используется в ссылке на объявление)"""
+    return shop_url.rsplit('/', 1)[-1] if shop_url else ''
+
+
+def _extract_product_url(chat_details: dict, shop_url_part: str = '', include_direct: bool = True):
+    """
+    Извлекает product_url из детальной информации о чате (ответ get_chat_by_id
+    или элемент списка get_chats).
+
+    ВАЖНО: Avito API возвращает context.value, а не context.item!
+    Структура: {"context": {"type": "item", "value": {"id": 123, "url": "..."}}}
+    Если ссылки нет, но есть id объявления - URL собирается из id и
+    shop_url_part (см. _shop_url_part; вычисляется один раз на магазин).
+    Если в context ничего не нашлось, проверяются прямые поля чата (include_direct).
+
+    Returns:
+        tuple: (product_url, source) - source: 'context_value', 'context_value_id'
+            или 'direct'; (None, None), если ссылка не найдена
+    """
+    detail_context = chat_details.get('context')
+    if isinstance(detail_context, dict):
+        detail_item = next((detail_context[k] for k in _CTX_KEYS if isinstance(detail_context.get(k), dict)), None)
+        if detail_item:
+            detail_url = next((detail_item[k] for k in _URL_KEYS if isinstance(detail_item.get(k), str) and detail_item[k]), None)
+            if detail_url:
+                return normalize_avito_url(detail_url), 'context_value'
+            detail_item_id = detail_item.get('id')
+            if detail_item_id:
+                if shop_url_part:
+                    return f"https://www.avito.ru/{shop_url_part}/items/{detail_item_id}", 'context_value_id'
+                return f"https://www.avito.ru/items/{detail_item_id}", 'context_value_id'
+
+    if include_direct:
+        direct_url = first_present(chat_details, DIRECT_PRODUCT_URL_KEYS)
+        if direct_url:
+            return direct_url, 'direct'
+    return None, None
+
+
+def _chat_item_id(chat_item):
+    """ID чата из элемента списка get_chats (строкой) или None"""
+    if not isinstance(chat_item, dict):
+        return None
+    value = chat_item.get('value')
+    item_id = (chat_item.get('id') or chat_item.get('chat_id')
+               or (value.get('id') if isinstance(value, dict) else None))
+    return str(item_id) if item_id else None
+
+
+_ITEM_URL_RE = re.compile(r'items/\d+', re.IGNORECASE)
+
+
+def _find_item_url(root, max_depth: int = 3):
+    """
+    Поиск ссылки на объявление (.../items/<id>) в любых полях ответа API.
+
+    Обход в глубину на явном стеке (без рекурсии), в том же порядке полей,
+    что и рекурсивный вариант; вложенность ограничена max_depth.
+
+    Returns:
+        str | None: Первая найденная ссылка или None
+    """
+    stack = [(root, 0)]
+    while stack:
+        node, depth = stack.pop()
+        if isinstance(node, str):
+            lowered = node.lower()
+            if ('avito.ru' in lowered or '/items/' in lowered) and _ITEM_URL_RE.search(node):
+                return node
+            continue
+        if depth > max_depth:
+            continue
+        if isinstance(node, dict):
+            children = list(node.values())
+        elif isinstance(node, list):
+            # Строки-элементы списков не проверяются - только значения полей
+            children = [child for child in node if not isinstance(child, str)]
+        else:
+            continue
+        # Стек - LIFO: кладем в обратном порядке, чтобы обходить поля по порядку
+        stack.extend((child, depth + 1) for child in reversed(children))
+    return None
+
+
+def _synced_recently(chat: dict) -> bool:
+    """Сообщения чата синхронизировались менее _MESSAGES_SYNC_TTL секунд назад"""
+    last_sync_at = chat.get('last_sync_at')
+    if not last_sync_at:
+        return False
+    try:
+        # CURRENT_TIMESTAMP в SQLite - UTC в формате 'YYYY-MM-DD HH:MM:SS'
+        synced_at = datetime.strptime(str(last_sync_at)[:19], '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return False
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return (now - synced_at).total_seconds() < _MESSAGES_SYNC_TTL
+
+
 def _ensure_manager_can_access_chat(chat_row) -> bool:
     """
     Проверяет доступ к чату.
@@ -51,236 +591,195 @@ def _ensure_manager_can_access_chat(chat_row) -> bool:
 @chats_bp.route('/', methods=['GET'])
 @require_auth
 @handle_errors
+@retry_on_sqlite_busy()
 def get_chats():
     """Получить список чатов"""
-    logger.info(f"[CHATS_API] Запрос получен через chats_bp blueprint. Session: user_id={session.get('user_id')}")
-    from database import get_db_connection
-    from services.messenger_service import MessengerService
-    from avito_api import AvitoAPI
-    import sqlite3
+    logger.info("[CHATS_API] Запрос получен через chats_bp blueprint. Session: user_id=%s", session.get('user_id'))
     
     limit = max(1, min(request.args.get('limit', default=100, type=int), 500))
     offset = max(0, request.args.get('offset', default=0, type=int))
 
-    # Пробуем получить соединение с обработкой ошибок диска
-    max_retries = 3
-    retry_count = 0
-    conn = None
-    
-    while retry_count < max_retries:
+    # Keyset-пагинация: ?cursor= (пустой для первой страницы) включает режим курсора,
+    # offset остается для обратной совместимости
+    cursor_param = request.args.get('cursor')
+    # COUNT(*) по всей выборке - только по явному запросу ?with_total=true
+    with_total = request.args.get('with_total', 'false').lower() == 'true'
+    cursor = None
+    if cursor_param is not None:
         try:
-            conn = get_db_connection()
-            break
-        except (sqlite3.OperationalError, RuntimeError) as conn_error:
-            error_msg = str(conn_error).lower()
-            if "disk i/o error" in error_msg or "i/o error" in error_msg:
-                retry_count += 1
-                if retry_count >= max_retries:
-                    logger.error(f"[GET_CHATS] Disk I/O error after {max_retries} retries: {conn_error}")
-                    return jsonify({
-                        'error': 'Internal server error',
-                        'message': 'disk I/O error',
-                        'code': 'DISK_IO_ERROR'
-                    }), 500
-                import time
-                time.sleep(0.1 * retry_count)  # Увеличиваем задержку с каждой попыткой
-                continue
-            else:
-                # Другая ошибка, пробрасываем дальше
-                raise
+            cursor = _decode_chat_cursor(cursor_param)
+        except ValueError:
+            return _json({'error': 'Invalid cursor', 'code': 'INVALID_CURSOR'}), 400
+
+    # Параметры фильтрации
+    shop_id = request.args.get('shop_id', type=int)
+    pool_only = request.args.get('pool', 'false').lower() == 'true'
     
-    if conn is None:
-        logger.error("[GET_CHATS] Failed to get database connection")
-        return jsonify({
-            'error': 'Internal server error',
-            'message': 'Failed to connect to database',
-            'code': 'DB_CONNECTION_ERROR'
-        }), 500
+    # Убраны фильтры по менеджерам - все видят все чаты
+    manager_id = None
     
-    try:
-        # Параметры фильтрации
-        shop_id = request.args.get('shop_id', type=int)
-        pool_only = request.args.get('pool', 'false').lower() == 'true'
-        
-        # Убраны фильтры по менеджерам - все видят все чаты
-        manager_id = None
-        
+    # Временные ошибки SQLite (busy/locked/disk I/O) повторяет @retry_on_sqlite_busy,
+    # итоговую ошибку превращает в JSON-ответ @handle_errors.
+    # Только чтение - берем соединение из пула читателей
+    # Во всех режимах запрашиваем на одну строку больше: по ней определяем has_more,
+    # total (COUNT(*)) для этого не нужен
+    total = 0
+    with get_db_reader() as conn:
         # Создаём сервис (без API, так как только читаем из БД)
         service = MessengerService(conn, None)
         
-        # Пробуем выполнить запрос с повторными попытками при disk I/O ошибках
-        max_query_retries = 3
-        query_retry_count = 0
-        chats = None
-        total = 0
-        
-        while query_retry_count < max_query_retries:
-            try:
-                chats, total = service.get_chats_list(
-                    shop_id=shop_id,
-                    manager_id=manager_id,  # Всегда None - убраны фильтры
-                    pool_only=pool_only,
-                    limit=limit,
-                    offset=offset,
-                    with_total=True
-                )
-                break  # Успешно выполнили запрос
-            except sqlite3.OperationalError as query_error:
-                error_msg = str(query_error).lower()
-                if ("disk i/o error" in error_msg or "i/o error" in error_msg) and query_retry_count < max_query_retries - 1:
-                    query_retry_count += 1
-                    logger.warning(f"[GET_CHATS] Disk I/O error during query (attempt {query_retry_count}/{max_query_retries}), retrying...")
-                    
-                    # Сбрасываем глобальное соединение через get_db_connection
-                    # (он сам обработает переподключение)
-                    import time
-                    time.sleep(0.1 * query_retry_count)
-                    
-                    # Получаем новое соединение (get_db_connection сам переподключится)
-                    try:
-                        # Принудительно сбрасываем соединение, вызвав get_db_connection
-                        # который обнаружит проблему и переподключится
-                        conn = get_db_connection()
-                        service = MessengerService(conn, None)
-                    except Exception as reconnect_error:
-                        logger.error(f"[GET_CHATS] Failed to reconnect: {reconnect_error}")
-                        if query_retry_count >= max_query_retries:
-                            raise
-                        continue
-                else:
-                    # Другая ошибка или все попытки исчерпаны
-                    raise
-        
-        if chats is None:
-            raise RuntimeError("Failed to get chats after all retries")
-        
-        # Соединение глобальное, не закрываем
-        
-        response = jsonify({
-            'items': chats,
-            'total': total,
+        if cursor_param is not None:
+            chats = service.get_chats_list_cursor(
+                shop_id=shop_id,
+                cursor=cursor,
+                limit=limit + 1,
+                pool_only=pool_only
+            )
+        elif with_total:
+            chats, total = service.get_chats_list(
+                shop_id=shop_id,
+                manager_id=manager_id,  # Всегда None - убраны фильтры
+                pool_only=pool_only,
+                limit=limit + 1,
+                offset=offset,
+                with_total=True
+            )
+        else:
+            chats = service.get_chats_list(
+                shop_id=shop_id,
+                manager_id=manager_id,  # Всегда None - убраны фильтры
+                pool_only=pool_only,
+                limit=limit + 1,
+                offset=offset,
+                with_total=False
+            )
+    
+    has_more = len(chats) > limit
+    chats = chats[:limit]
+    
+    if cursor_param is not None:
+        next_cursor = _encode_chat_cursor(chats[-1]) if has_more else None
+        return _json_items_stream(chats, {
+            'limit': limit,
+            'next_cursor': next_cursor,
+            'has_more': has_more
+        }, headers={'X-Limit': limit})
+    
+    if not with_total:
+        return _json_items_stream(chats, {
             'limit': limit,
             'offset': offset,
-            'has_more': offset + limit < total
-        })
-        response.headers['X-Total-Count'] = total
-        response.headers['X-Limit'] = limit
-        response.headers['X-Offset'] = offset
-        return response
-    except sqlite3.OperationalError as db_error:
-        error_msg = str(db_error).lower()
-        if "disk i/o error" in error_msg or "i/o error" in error_msg:
-            logger.error(f"[GET_CHATS] Disk I/O error during query: {db_error}")
-            return jsonify({
-                'error': 'Internal server error',
-                'message': 'disk I/O error',
-                'code': 'DISK_IO_ERROR'
-            }), 500
-        else:
-            logger.error(f"[GET_CHATS] Database error: {db_error}", exc_info=True)
-            return jsonify({
-                'error': 'Internal server error',
-                'message': str(db_error),
-                'code': 'DB_ERROR'
-            }), 500
+            'has_more': has_more
+        }, headers={'X-Limit': limit, 'X-Offset': offset})
+    
+    return _json_items_stream(chats, {
+        'total': total,
+        'limit': limit,
+        'offset': offset,
+        'has_more': has_more
+    }, headers={'X-Total-Count': total, 'X-Limit': limit, 'X-Offset': offset})
 
 
 @chats_bp.route('/<int:chat_id>/messages', methods=['GET'])
 @require_auth
+@handle_errors
+@retry_on_sqlite_busy()
 def get_messages(chat_id):
     """Получить сообщения чата"""
-    from database import get_db_connection
-    from services.messenger_service import MessengerService
-    from avito_api import AvitoAPI
-    
     try:
         limit = max(1, min(int(request.args.get('limit', 100)), 500))
         offset = max(0, int(request.args.get('offset', 0)))
         sync = request.args.get('sync', 'false').lower() == 'true'
+        with_total = request.args.get('with_total', 'false').lower() == 'true'
         
-        conn = get_db_connection()
-        
-        # Получаем данные чата
-        try:
-            chat_row = conn.execute('''
-                SELECT ac.*, s.client_id, s.client_secret, s.user_id
-                FROM avito_chats ac
-                JOIN avito_shops s ON ac.shop_id = s.id
-                WHERE ac.id = ?
-            ''', (chat_id,)).fetchone()
-        except Exception as e:
-            logger.error(f"[API/MESSAGES] Ошибка получения данных чата {chat_id}: {e}", exc_info=True)
-            return jsonify({'error': f'Database error: {str(e)}', 'code': 'DB_ERROR'}), 500
+        # Без синхронизации обработчик только читает - берем соединение из пула читателей;
+        # синхронизация пишет новые сообщения через глобальное соединение
+        db_context = nullcontext(get_db_connection()) if sync else get_db_reader()
+        with db_context as conn:
+            # Получаем данные чата
+            try:
+                chat = get_chat_context(conn, chat_id)
+            except sqlite3.OperationalError:
+                raise  # Повторяется @retry_on_sqlite_busy
+            except Exception as e:
+                logger.error("[API/MESSAGES] Ошибка получения данных чата %s: %s", chat_id, e, exc_info=True)
+                return _json({'error': f'Database error: {str(e)}', 'code': 'DB_ERROR'}), 500
         
-        if not chat_row:
-            # Соединение глобальное, не закрываем
-            return jsonify({'error': 'Chat not found'}), 404
-
-        # Преобразуем в dict для безопасного доступа
-        chat = dict(chat_row) if not isinstance(chat_row, dict) else chat_row
+            if not chat:
+                return _json({'error': 'Chat not found'}), 404
 
-        if not _ensure_manager_can_access_chat(chat):
-            # Соединение глобальное, не закрываем
-            return jsonify({'error': 'Access denied'}), 403
+            if not _ensure_manager_can_access_chat(chat):
+                return _json({'error': 'Access denied'}), 403
         
-        # Создаём API если нужна синхронизация
-        logger.info(f"[API/MESSAGES] Запрос сообщений для чата {chat_id}, sync={sync}, client_id={bool(chat.get('client_id'))}, client_secret={bool(chat.get('client_secret'))}, user_id={chat.get('user_id')}")
+            # Создаём API если нужна синхронизация
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("[API/MESSAGES] Запрос сообщений для чата %s, sync=%s, has_creds=%s, user_id=%s",
+                            chat_id, sync, bool(chat['has_creds']), chat.get('user_id'))
         
-        service = None
-        if sync and chat.get('client_id') and chat.get('client_secret') and chat.get('user_id'):
-            try:
-                logger.info(f"[API/MESSAGES] Начинаем синхронизацию сообщений для чата {chat_id}, user_id={chat['user_id']}, avito_chat_id={chat.get('chat_id')}")
-                api = AvitoAPI(
-                    client_id=chat['client_id'],
-                    client_secret=chat['client_secret']
-                )
-                service = MessengerService(conn, api)
+            service = None
+            # Повторный ?sync=true вскоре после синхронизации отдает сообщения из БД без вызова Avito API
+            if sync and _synced_recently(chat):
+                logger.info("[API/MESSAGES] Синхронизация чата %s пропущена (недавно синхронизирован)", chat_id)
+                sync = False
+                service = MessengerService(conn, None)
+            elif sync and chat['has_creds']:
+                try:
+                    logger.info("[API/MESSAGES] Начинаем синхронизацию сообщений для чата %s, user_id=%s, avito_chat_id=%s", chat_id, chat['user_id'], chat.get('chat_id'))
+                    api = get_avito_api(chat['client_id'], chat['client_secret'])
+                    service = MessengerService(conn, api)
                 
-                # Синхронизируем
-                new_messages_count = service.sync_chat_messages(
-                    chat_id=chat_id,
-                    user_id=chat['user_id'],
-                    avito_chat_id=chat.get('chat_id') or ''
-                )
-                logger.info(f"[API/MESSAGES] Синхронизация завершена: {new_messages_count} новых сообщений для чата {chat_id}")
-            except Exception as sync_error:
-                logger.error(f"[API/MESSAGES] Ошибка синхронизации сообщений для чата {chat_id}: {sync_error}", exc_info=True)
-                # Продолжаем без синхронизации
+                    # Синхронизируем
+                    new_messages_count = service.sync_chat_messages(
+                        chat_id=chat_id,
+                        user_id=chat['user_id'],
+                        avito_chat_id=chat.get('chat_id') or ''
+                    )
+                    logger.info("[API/MESSAGES] Синхронизация завершена: %s новых сообщений для чата %s", new_messages_count, chat_id)
+                    conn.execute(_SQL_SET_LAST_SYNC_AT, (chat_id,))
+                    conn.commit()
+                    invalidate_chat_context(chat_id)
+                except Exception as sync_error:
+                    logger.error("[API/MESSAGES] Ошибка синхронизации сообщений для чата %s: %s", chat_id, sync_error, exc_info=True)
+                    # Продолжаем без синхронизации
+                    service = MessengerService(conn, None)
+            else:
+                if sync:
+                    logger.warning("[API/MESSAGES] Синхронизация запрошена, но не выполнена: у магазина чата %s нет ключей Avito API", chat_id)
                 service = MessengerService(conn, None)
-        else:
-            if sync:
-                logger.warning(f"[API/MESSAGES] Синхронизация запрошена, но не выполнена: client_id={bool(chat.get('client_id'))}, client_secret={bool(chat.get('client_secret'))}, user_id={bool(chat.get('user_id'))}")
-            service = MessengerService(conn, None)
-        
-        # Получаем сообщения
-        try:
-            messages, total = service.get_chat_messages(chat_id, limit, offset)
-        except Exception as msg_error:
-            logger.error(f"[API/MESSAGES] Ошибка получения сообщений для чата {chat_id}: {msg_error}", exc_info=True)
-            import traceback
-            logger.error(f"[API/MESSAGES] Traceback получения сообщений: {traceback.format_exc()}")
-            return jsonify({'error': f'Error getting messages: {str(msg_error)}', 'code': 'MESSAGES_ERROR'}), 500
         
-        logger.info(f"[API/MESSAGES] Возвращаем {len(messages)} сообщений из {total} всего для чата {chat_id}")
+            # Получаем сообщения
+            try:
+                # Одна лишняя строка вместо total для вычисления has_more
+                messages, total = service.get_chat_messages(chat_id, limit + 1, offset, with_total=with_total)
+                has_more = len(messages) > limit
+                messages = messages[:limit]
+            except sqlite3.OperationalError:
+                raise  # Повторяется @retry_on_sqlite_busy
+            except Exception as msg_error:
+                logger.error("[API/MESSAGES] Ошибка получения сообщений для чата %s: %s", chat_id, msg_error, exc_info=True)
+                return _json({'error': f'Error getting messages: {str(msg_error)}', 'code': 'MESSAGES_ERROR'}), 500
         
-        # Соединение глобальное, не закрываем
+            logger.info("[API/MESSAGES] Возвращаем %s сообщений из %s всего для чата %s", len(messages), total, chat_id)
         
-        return jsonify({
-            'messages': messages,
-            'total': total,
-            'limit': limit,
-            'offset': offset,
-            'has_more': offset + limit < total
-        })
+            response_data = {
+                'messages': messages,
+                'limit': limit,
+                'offset': offset,
+                'has_more': has_more
+            }
+            if with_total:
+                response_data['total'] = total
+            return _json(response_data)
+    except sqlite3.OperationalError:
+        raise  # Повторяется @retry_on_sqlite_busy
     except Exception as e:
-        logger.error(f"[API/MESSAGES] Критическая ошибка при получении сообщений для чата {chat_id}: {e}", exc_info=True)
-        import traceback
-        logger.error(f"[API/MESSAGES] Полный traceback: {traceback.format_exc()}")
-        return jsonify({'error': str(e), 'code': 'INTERNAL_ERROR'}), 500
+        logger.error("[API/MESSAGES] Критическая ошибка при получении сообщений для чата %s: %s", chat_id, e, exc_info=True)
+        return _json({'error': str(e), 'code': 'INTERNAL_ERROR'}), 500
 
 
 @chats_bp.route('/<int:chat_id>/send', methods=['POST'])
 @require_auth
+@retry_on_sqlite_busy()
 def send_message(chat_id):
     """
     Отправить сообщение в чат
@@ -296,83 +795,49 @@ def send_message(chat_id):
         "attachments": [{"id": "attachment_id"}, ...] (опционально)
     }
     """
-    from database import get_db_connection
-    from services.messenger_service import MessengerService
-    from avito_api import AvitoAPI
-    
     data = request.get_json()
     if not data:
-        return jsonify({'error': 'Request body is required'}), 400
-    
-    message_text = data.get('message', '').strip() if data.get('message') else None
-    attachments = data.get('attachments', [])
-    
-    # Валидация: должно быть либо сообщение, либо вложения
-    if not message_text and not attachments:
-        return jsonify({'error': 'Either message text or attachments are required'}), 400
-    
-    if message_text and len(message_text) > 5000:
-        return jsonify({'error': 'Message is too long (max 5000 characters)'}), 400
+        return _json({'error': 'Request body is required'}), 400
     
-    if attachments and not isinstance(attachments, list):
-        return jsonify({'error': 'Attachments must be a list'}), 400
-    
-    # Валидация формата attachments
-    if attachments:
-        for i, attachment in enumerate(attachments):
-            if not isinstance(attachment, dict):
-                return jsonify({'error': f'Attachment {i} must be an object'}), 400
-            if 'id' not in attachment:
-                return jsonify({'error': f'Attachment {i} must have an "id" field'}), 400
+    message_text, attachments, validation_error = validate_send_message(data)
+    if validation_error:
+        return _json({'error': validation_error}), 400
     
     conn = get_db_connection()
     
     # Получаем данные чата
-    chat = conn.execute('''
-        SELECT ac.*, s.client_id, s.client_secret, s.user_id
-        FROM avito_chats ac
-        JOIN avito_shops s ON ac.shop_id = s.id
-        WHERE ac.id = ?
-    ''', (chat_id,)).fetchone()
+    chat = get_chat_context(conn, chat_id)
     
     if not chat:
-        # Соединение глобальное, не закрываем
-        return jsonify({'error': 'Chat not found'}), 404
-
-    # Преобразуем sqlite3.Row в словарь для безопасного доступа
-    chat = dict(chat) if not isinstance(chat, dict) else chat
+        return _json({'error': 'Chat not found'}), 404
 
     if not _ensure_manager_can_access_chat(chat):
-        # Соединение глобальное, не закрываем
-        return jsonify({'error': 'Access denied'}), 403
+        return _json({'error': 'Access denied'}), 403
     
     # Проверяем наличие учетных данных для Авито
-    if not chat.get('client_id') or not chat.get('client_secret') or not chat.get('user_id'):
-        # Соединение глобальное, не закрываем
-        return jsonify({'error': 'Avito credentials are missing for this shop'}), 400
+    if not chat['has_creds']:
+        return _json({'error': 'Avito credentials are missing for this shop'}), 400
 
     # Создаём API и сервис
-    api = AvitoAPI(
-        client_id=chat['client_id'],
-        client_secret=chat['client_secret']
-    )
+    api = get_avito_api(chat['client_id'], chat['client_secret'])
     service = MessengerService(conn, api)
     
     # Отправляем - устанавливаем manager_id для всех пользователей, которые отправляют сообщение
     manager_id = session.get('user_id')
     
     # Логируем начало отправки
-    logger.info(f"[SEND MESSAGE] ========== НАЧАЛО ОТПРАВКИ СООБЩЕНИЯ ==========")
-    logger.info(f"[SEND MESSAGE] Chat ID (БД): {chat_id}")
-    logger.info(f"[SEND MESSAGE] Avito Chat ID: {chat.get('chat_id')}")
-    logger.info(f"[SEND MESSAGE] User ID: {chat.get('user_id')}")
-    logger.info(f"[SEND MESSAGE] Message text: {message_text[:100] if message_text else 'None'}...")
-    logger.info(f"[SEND MESSAGE] Has attachments: {bool(attachments)}, count: {len(attachments) if attachments else 0}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("[SEND MESSAGE] ========== НАЧАЛО ОТПРАВКИ СООБЩЕНИЯ ==========")
+        logger.info("[SEND MESSAGE] Chat ID (БД): %s", chat_id)
+        logger.info("[SEND MESSAGE] Avito Chat ID: %s", chat.get('chat_id'))
+        logger.info("[SEND MESSAGE] User ID: %s", chat.get('user_id'))
+        logger.info("[SEND MESSAGE] Message text: %s...", message_text[:100] if message_text else 'None')
+        logger.info("[SEND MESSAGE] Has attachments: %s, count: %s", bool(attachments), len(attachments) if attachments else 0)
     
     # Если есть attachments, отправляем через API напрямую
     if attachments:
         try:
-            logger.info(f"[SEND MESSAGE] Отправка через api.send_message с attachments")
+            logger.info("[SEND MESSAGE] Отправка через api.send_message с attachments")
             # Отправляем через API с attachments
             api_result = api.send_message(
                 user_id=str(chat.get('user_id')),
@@ -383,119 +848,84 @@ def send_message(chat_id):
             
             # Сохраняем в БД
             message_for_db = message_text or f"[{len(attachments)} вложений]"
-            conn.execute('''
-                INSERT INTO avito_messages (chat_id, message_text, message_type, sender_name, manager_id)
-                VALUES (?, ?, 'outgoing', 'Магазин', ?)
-            ''', (chat_id, message_for_db, manager_id))
-            
-            # Обновляем чат
-            conn.execute('''
-                UPDATE avito_chats
-                SET last_message = ?, updated_at = CURRENT_TIMESTAMP, unread_count = 0
-                WHERE id = ?
-            ''', (message_for_db, chat_id))
-            
-            conn.commit()
-            # Соединение глобальное, не закрываем
+            service.save_outgoing_message(chat_id, message_for_db, 'Магазин', manager_id)
+            invalidate_chat_context(chat_id)
             
-            logger.info(f"[SEND MESSAGE] Сообщение с вложениями отправлено для чата {chat_id}")
-            return jsonify({'success': True, 'message_id': api_result.get('id')})
+            logger.info("[SEND MESSAGE] Сообщение с вложениями отправлено для чата %s", chat_id)
+            return _json({'success': True, 'message_id': api_result.get('id')})
         except Exception as e:
-            logger.error(f"[SEND MESSAGE] Ошибка отправки сообщения с вложениями: {e}", exc_info=True)
-            # Соединение глобальное, не закрываем
-            return jsonify({'error': str(e)}), 500
+            logger.error("[SEND MESSAGE] Ошибка отправки сообщения с вложениями: %s", e, exc_info=True)
+            return _json({'error': str(e)}), 500
     else:
         # Обычная отправка текста через сервис
-        logger.info(f"[SEND MESSAGE] Отправка через service.send_message (без attachments)")
+        logger.info("[SEND MESSAGE] Отправка через service.send_message (без attachments)")
         success, error_msg = service.send_message(chat_id, message_text, manager_id)
-        # Соединение глобальное, не закрываем
+        invalidate_chat_context(chat_id)
         
         if success:
-            logger.info(f"[SEND MESSAGE] ✅ Сообщение успешно отправлено через service.send_message для чата {chat_id}")
-            return jsonify({'success': True})
+            logger.info("[SEND MESSAGE] ✅ Сообщение успешно отправлено через service.send_message для чата %s", chat_id)
+            return _json({'success': True})
         else:
-            logger.error(f"[SEND MESSAGE] ❌ Ошибка отправки через service.send_message для чата {chat_id}: {error_msg}")
-            return jsonify({'error': error_msg or 'Failed to send message'}), 500
+            logger.error("[SEND MESSAGE] ❌ Ошибка отправки через service.send_message для чата %s: %s", chat_id, error_msg)
+            return _json({'error': error_msg or 'Failed to send message'}), 500
 
 
 @chats_bp.route('/<int:chat_id>/take', methods=['POST'])
 @require_auth
+@retry_on_sqlite_busy()
 def take_chat(chat_id):
     """Взять чат из пула"""
-    from database import get_db_connection
-    from services.messenger_service import MessengerService
-    
     conn = get_db_connection()
     service = MessengerService(conn, None)
     
     success = service.take_from_pool(chat_id, session['user_id'])
+    invalidate_chat_context(chat_id)
     
-    # Соединение глобальное, не закрываем
-    
-    return jsonify({'success': success})
+    return _json({'success': success})
 
 
 @chats_bp.route('/<int:chat_id>/return', methods=['POST'])
 @require_auth
+@retry_on_sqlite_busy()
 def return_chat(chat_id):
     """Вернуть чат в пул"""
-    from database import get_db_connection
-    from services.messenger_service import MessengerService
-    
     conn = get_db_connection()
-    chat = conn.execute('SELECT assigned_manager_id FROM avito_chats WHERE id = ?', (chat_id,)).fetchone()
+    chat = conn.execute(_SQL_GET_CHAT_MANAGER, (chat_id,)).fetchone()
     if not chat:
-        # Соединение глобальное, не закрываем
-        return jsonify({'error': 'Chat not found'}), 404
+        return _json({'error': 'Chat not found'}), 404
 
     if session.get('user_role') == 'manager' and chat['assigned_manager_id'] != session.get('user_id'):
-        # Соединение глобальное, не закрываем
-        return jsonify({'error': 'Access denied'}), 403
+        return _json({'error': 'Access denied'}), 403
 
     service = MessengerService(conn, None)
     success = service.return_to_pool(chat_id)
+    invalidate_chat_context(chat_id)
     
-    # Соединение глобальное, не закрываем
-    
-    return jsonify({'success': success})
+    return _json({'success': success})
 
 
 @chats_bp.route('/<int:chat_id>/block', methods=['POST'])
 @require_auth
+@retry_on_sqlite_busy()
 def block_chat(chat_id):
     """Заблокировать пользователя в чате"""
-    from database import get_db_connection
-    from services.messenger_service import MessengerService
-    from avito_api import AvitoAPI
-    
     data = request.get_json() or {}
     block = data.get('block', True)
     
     conn = get_db_connection()
     
-    chat = conn.execute('''
-        SELECT ac.*, s.client_id, s.client_secret, s.user_id
-        FROM avito_chats ac
-        JOIN avito_shops s ON ac.shop_id = s.id
-        WHERE ac.id = ?
-    ''', (chat_id,)).fetchone()
+    chat = get_chat_context(conn, chat_id)
     
     if not chat:
-        # Соединение глобальное, не закрываем
-        return jsonify({'error': 'Chat not found'}), 404
+        return _json({'error': 'Chat not found'}), 404
 
     if not _ensure_manager_can_access_chat(chat):
-        # Соединение глобальное, не закрываем
-        return jsonify({'error': 'Access denied'}), 403
+        return _json({'error': 'Access denied'}), 403
     
-    if not chat['client_id'] or not chat['client_secret'] or not chat['user_id']:
-        # Соединение глобальное, не закрываем
-        return jsonify({'error': 'Avito credentials are missing for this shop'}), 400
+    if not chat['has_creds']:
+        return _json({'error': 'Avito credentials are missing for this shop'}), 400
 
-    api = AvitoAPI(
-        client_id=chat['client_id'],
-        client_secret=chat['client_secret']
-    )
+    api = get_avito_api(chat['client_id'], chat['client_secret'])
     service = MessengerService(conn, api)
     
     success = service.block_user(
@@ -504,10 +934,9 @@ def block_chat(chat_id):
         avito_chat_id=chat['chat_id'],
         block=block
     )
+    invalidate_chat_context(chat_id)
     
-    # Соединение глобальное, не закрываем
-    
-    return jsonify({'success': success})
+    return _json({'success': success})
 
 
 @chats_bp.route('/sync', methods=['POST'])
@@ -515,12 +944,10 @@ def block_chat(chat_id):
 def sync_chats():
     """Синхронизировать все чаты (асинхронно)"""
     try:
-        from tasks import enqueue_sync_all_chats, RQ_AVAILABLE
-        
         if RQ_AVAILABLE:
             job = enqueue_sync_all_chats()
             if hasattr(job, 'id'):
-                return jsonify({
+                return _json({
                     'success': True,
                     'job_id': job.id,
                     'status': 'queued',
@@ -528,186 +955,281 @@ def sync_chats():
                 }), 202
             else:
                 # Fallback - синхронное выполнение
-                return jsonify({
+                invalidate_chat_context()
+                return _json({
                     'success': True,
                     'status': 'completed',
                     'result': job
                 }), 200
         else:
             # Синхронное выполнение если RQ недоступен
-            from database import get_db_connection
-            from services.sync_service import SyncService
-            
             conn = get_db_connection()
             service = SyncService(conn)
             results = service.sync_all_shops()
-            # Соединение глобальное, не закрываем
+            invalidate_chat_context()
             
-            return jsonify(results)
+            return _json(results)
     except Exception as e:
         logger.error(f"Ошибка синхронизации чатов: {e}", exc_info=True)
         # Fallback на синхронную синхронизацию
-        from database import get_db_connection
-        from services.sync_service import SyncService
-        
         conn = get_db_connection()
         service = SyncService(conn)
         results = service.sync_all_shops()
-        # Соединение глобальное, не закрываем
+        invalidate_chat_context()
         
-        return jsonify(results)
+        return _json(results)
 
 
-@chats_bp.route('/extract-all-product-urls', methods=['POST'])
-@require_auth
-@handle_errors
-def extract_all_product_urls():
+# Верхняя граница размера страницы извлечения product_url (запросы и задача RQ)
+EXTRACT_MAX_LIMIT = 500
+
+
+def _int_param(data, key, default=None, min_value=0, max_value=None):
     """
-    Принудительно извлечь product_url для всех чатов, у которых его нет
+    Прочитать целочисленный параметр из JSON тела запроса
+
+    Строки вида "50" принимаются, значение ограничивается сверху max_value.
+
+    Raises:
+        ValueError: Значение не целое или меньше min_value
     """
-    from database import get_db_connection
-    from avito_api import AvitoAPI
-    import re
-    
-    conn = get_db_connection()
+    value = data.get(key)
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        raise ValueError(f'Параметр {key} должен быть целым числом')
     try:
-        # Получаем все чаты без product_url (увеличиваем лимит и добавляем пагинацию)
-        request_data = request.get_json() or {}
-        limit = request_data.get('limit', 500)  # По умолчанию 500 чатов
-        offset = request_data.get('offset', 0)
-        
-        chats_without_url = conn.execute('''
-            SELECT ac.id, ac.chat_id, ac.shop_id, s.client_id, s.client_secret, s.user_id, s.shop_url
-            FROM avito_chats ac
-            JOIN avito_shops s ON ac.shop_id = s.id
-            WHERE (ac.product_url IS NULL OR ac.product_url = '')
-            AND s.client_id IS NOT NULL AND s.client_secret IS NOT NULL AND s.user_id IS NOT NULL
-            ORDER BY ac.id
-            LIMIT ? OFFSET ?
-        ''', (limit, offset)).fetchall()
-        
-        # Получаем общее количество чатов без product_url для информации
-        total_without_url = conn.execute('''
-            SELECT COUNT(*) as cnt
-            FROM avito_chats ac
-            JOIN avito_shops s ON ac.shop_id = s.id
-            WHERE (ac.product_url IS NULL OR ac.product_url = '')
-            AND s.client_id IS NOT NULL AND s.client_secret IS NOT NULL AND s.user_id IS NOT NULL
-        ''').fetchone()
-        total_count = total_without_url['cnt'] if total_without_url else 0
-        
-        logger.info(f"[EXTRACT ALL] Найдено {len(chats_without_url)} чатов без product_url (всего без URL: {total_count}, offset: {offset}, limit: {limit})")
-        
-        results = {
-            'total': len(chats_without_url),
-            'total_without_url': total_count,
-            'offset': offset,
-            'limit': limit,
-            'extracted': 0,
-            'errors': 0,
-            'has_more': (offset + limit) < total_count
-        }
-        
-        import time
-        
-        for idx, chat_row in enumerate(chats_without_url):
-            chat = dict(chat_row)
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Параметр {key} должен быть целым числом')
+    if value < min_value:
+        raise ValueError(f'Параметр {key} должен быть не меньше {min_value}')
+    if max_value is not None:
+        value = min(value, max_value)
+    return value
+
+
+def _extract_page_params(request_data, default_limit):
+    """Разобрать limit/after_id/offset запроса извлечения product_url"""
+    return (
+        _int_param(request_data, 'limit', default_limit, 1, EXTRACT_MAX_LIMIT),
+        _int_param(request_data, 'after_id'),
+        _int_param(request_data, 'offset'),
+    )
+
+
+def run_extract_product_urls(limit=500, after_id=None, offset=None, on_progress=None):
+    """
+    Извлечь product_url для одной страницы чатов, у которых его нет
+
+    Выполняется и из обработчика extract_all_product_urls (если RQ недоступен),
+    и в воркере RQ (tasks.extract_product_urls_task), поэтому не использует
+    request и возвращает обычный dict.
+
+    Args:
+        limit (int): Размер страницы
+        after_id (int): Keyset-пагинация - обработать чаты с id > after_id
+        offset (int): Устаревшая пагинация по смещению (если after_id не передан)
+        on_progress (callable): Вызывается как on_progress(processed, total) по ходу
+            обработки (воркер RQ сохраняет прогресс в job.meta)
+
+    Returns:
+        dict: {'success': True, 'results': {...}, 'next_after_id' | 'next_offset': ..., 'message': ...}
+    """
+    # Keyset-пагинация по ac.id (after_id) - следующая страница находится
+    # поиском по индексу, без пропуска offset строк. Параметр offset
+    # поддерживается для старых клиентов, если after_id не передан.
+    use_offset = after_id is None and offset is not None
+    offset = (offset or 0) if use_offset else 0
+    after_id = after_id or 0
+    
+    # Чтение - через соединение из пула читателей (WAL), которое возвращается
+    # в пул до запросов к Avito; общее соединение-писатель нужно только
+    # для записи найденных ссылок в конце
+    with get_db_reader() as reader:
+        if offset:
+            # Смещение переводится в after_id, выборка страницы остается keyset
+            row = reader.execute(_SQL_CHAT_ID_AT_OFFSET_WITHOUT_URL, (offset - 1,)).fetchone()
+            after_id = row['id'] if row else None
+        if after_id is None:
+            # Смещение за пределами выборки - страница пустая
+            cursor = None
+            chats_without_url = []
+            has_more = False
+        else:
+            # Запрашиваем limit + 1 строк: читаем limit строк с курсора, а наличие
+            # следующей страницы проверяем одним fetchone() без копирования списка
+            cursor = reader.execute(_SQL_SELECT_CHATS_WITHOUT_URL, (after_id, limit + 1))
+            chats_without_url = list(islice(cursor, limit))
+            has_more = cursor.fetchone() is not None
+            cursor.close()
+        total_count = _get_total_without_url(reader)
+    
+    if use_offset:
+        next_after_id = None
+    else:
+        next_after_id = chats_without_url[-1]['id'] if has_more else None
+    
+    logger.info(f"[EXTRACT ALL] Найдено {len(chats_without_url)} чатов без product_url (всего без URL: {total_count}, after_id: {after_id}, offset: {offset}, limit: {limit})")
+    
+    results = {
+        'total': len(chats_without_url),
+        'total_without_url': total_count,
+        'after_id': after_id,
+        'offset': offset,
+        'limit': limit,
+        'extracted': 0,
+        'errors': 0,
+        'has_more': has_more
+    }
+    
+    # Обрабатываем чаты параллельно: каждый чат требует отдельного вызова
+    # get_chat_by_id (Avito API не возвращает context.item в списке чатов),
+    # а частоту запросов к Avito ограничивает общий token bucket.
+    # Ключи Avito у всех выбранных чатов проверены в SQL (_SQL_HAS_CREDS);
+    # клиент AvitoAPI общий на пару ключей (get_avito_api).
+    # Строки sqlite3.Row читаются по имени колонки - в dict не копируются
+    chats = chats_without_url
+    # Сегмент shop_url для ссылок вида /<shop>/items/<id> - один раз на магазин
+    shop_url_parts = {chat['shop_id']: _shop_url_part(chat['shop_url']) for chat in chats}
+    rate_limiter = TokenBucket(rate=_EXTRACT_RATE_PER_SEC, burst=_EXTRACT_RATE_BURST)
+    
+    def fetch_chat_details(chat):
+        api = get_avito_api(chat['client_id'], chat['client_secret'])
+        rate_limiter.acquire()
+        # Вызываем get_chat_by_id для получения детальной информации о чате
+        # Это единственный надежный способ получить product_url
+        return api.get_chat_by_id(
+            user_id=chat['user_id'],
+            chat_id=chat['chat_id']
+        )
+    
+    # Чаты, ссылка для которых уже найдена в прошлом прогоне, в API не запрашиваем
+    cached_urls = _get_resolved_product_urls([chat['chat_id'] for chat in chats])
+    
+    updates = []
+    resolved = {}
+    with ThreadPoolExecutor(max_workers=_EXTRACT_MAX_WORKERS) as executor:
+        futures = [
+            None if chat['chat_id'] in cached_urls else executor.submit(fetch_chat_details, chat)
+            for chat in chats
+        ]
+        for idx, (chat, future) in enumerate(zip(chats, futures)):
             chat_id = chat['id']
             avito_chat_id = chat['chat_id']
             
-            # Добавляем небольшую задержку между запросами, чтобы не превысить лимиты Avito API
-            # (примерно 1 запрос в секунду)
             if idx > 0 and idx % 10 == 0:
-                logger.info(f"[EXTRACT ALL] Прогресс: обработано {idx}/{len(chats_without_url)} чатов...")
-                time.sleep(1)  # Задержка каждые 10 чатов
+                logger.info("[EXTRACT ALL] Прогресс: обработано %d/%d чатов...", idx, len(chats))
+                if on_progress:
+                    on_progress(idx, len(chats))
             
             try:
-                # ВАЖНО: Avito API не возвращает context.item в списке чатов
-                # Поэтому ОБЯЗАТЕЛЬНО вызываем get_chat_by_id для каждого чата
-                product_url = None
-                if chat['client_id'] and chat['client_secret'] and chat['user_id']:
+                product_url = cached_urls.get(avito_chat_id)
+                if future is not None:
                     try:
-                        api = AvitoAPI(
-                            client_id=chat['client_id'],
-                            client_secret=chat['client_secret']
-                        )
-                        # Вызываем get_chat_by_id для получения детальной информации о чате
-                        # Это единственный надежный способ получить product_url
-                        chat_details = api.get_chat_by_id(
-                            user_id=chat['user_id'],
-                            chat_id=avito_chat_id
-                        )
-                        
-                        if isinstance(chat_details, dict):
-                            # ВАЖНО: Avito API возвращает context.value, а не context.item!
-                            # Структура: {"context": {"type": "item", "value": {"id": 123, "url": "..."}}}
-                            detail_context = chat_details.get('context', {})
-                            if isinstance(detail_context, dict):
-                                detail_item = detail_context.get('value') or detail_context.get('item') or detail_context.get('listing') or detail_context.get('ad', {})
-                                if isinstance(detail_item, dict):
-                                    detail_item_id = detail_item.get('id')
-                                    detail_url = (detail_item.get('url') or 
-                                                 detail_item.get('link') or 
-                                                 detail_item.get('href') or
-                                                 detail_item.get('value') or
-                                                 detail_item.get('uri'))
-                                    if detail_url:
-                                        product_url = detail_url
-                                        if product_url.startswith('/'):
-                                            product_url = f"https://www.avito.ru{product_url}"
-                                    elif detail_item_id:
-                                        item_id_str = str(detail_item_id)
-                                        shop_url_part = chat.get('shop_url', '').split('/')[-1] if chat.get('shop_url') else ''
-                                        if shop_url_part:
-                                            product_url = f"https://www.avito.ru/{shop_url_part}/items/{item_id_str}"
-                                        else:
-                                            product_url = f"https://www.avito.ru/items/{item_id_str}"
-                            
-                            # Если не нашли в context, проверяем прямые поля
-                            if not product_url:
-                                product_url = (chat_details.get('item_url') or 
-                                             chat_details.get('listing_url') or 
-                                             chat_details.get('ad_url') or
-                                             chat_details.get('product_url'))
+                        chat_details = future.result()
                     except Exception as api_error:
-                        logger.warning(f"[EXTRACT ALL] Ошибка API для чата {chat_id} (avito_chat_id={avito_chat_id}): {api_error}")
+                        logger.warning("[EXTRACT ALL] Ошибка API для чата %s (avito_chat_id=%s): %s", chat_id, avito_chat_id, api_error)
+                        chat_details = None
+                    
+                    if isinstance(chat_details, dict):
+                        product_url, _ = _extract_product_url(chat_details, shop_url_parts[chat['shop_id']])
+                        if product_url:
+                            resolved[avito_chat_id] = product_url
                 
-                # Сохраняем найденный product_url
+                # Сохраняем найденный product_url (одним executemany после цикла)
                 if product_url:
-                    conn.execute('''
-                        UPDATE avito_chats 
-                        SET product_url = ?, updated_at = CURRENT_TIMESTAMP
-                        WHERE id = ?
-                    ''', (product_url, chat_id))
+                    updates.append((product_url, chat_id))
                     results['extracted'] += 1
-                    logger.info(f"[EXTRACT ALL] ✅ Для чата {chat_id} найден product_url: {product_url}")
+                    logger.debug("[EXTRACT ALL] ✅ Для чата %s найден product_url: %s", chat_id, product_url)
                 else:
-                    logger.warning(f"[EXTRACT ALL] ⚠️ Для чата {chat_id} product_url не найден")
+                    logger.debug("[EXTRACT ALL] ⚠️ Для чата %s product_url не найден", chat_id)
                     results['errors'] += 1
             except Exception as e:
-                logger.error(f"[EXTRACT ALL] Ошибка для чата {chat_id}: {e}", exc_info=True)
+                logger.error("[EXTRACT ALL] Ошибка для чата %s: %s", chat_id, e, exc_info=True)
                 results['errors'] += 1
-        
-        conn.commit()
-        # Соединение глобальное, не закрываем
-        
-        logger.info(f"[EXTRACT ALL] Завершено: обработано {results['total']}, найдено {results['extracted']}, ошибок {results['errors']}, осталось: {results.get('total_without_url', 0) - offset - len(chats_without_url)}")
-        
-        response_data = {
-            'success': True,
-            'results': results
-        }
-        
-        # Если есть еще чаты для обработки, добавляем информацию для следующего запроса
-        if results.get('has_more'):
+    
+    # Запоминаем найденные ссылки до записи: если запись не удастся,
+    # повторный прогон возьмет их из кэша
+    _remember_resolved_product_urls(resolved)
+    # Все обновления - одной короткой транзакцией на соединении-писателе
+    _save_product_urls(get_db_connection(), updates)
+    
+    logger.info(f"[EXTRACT ALL] Завершено: обработано {results['total']}, найдено {results['extracted']}, ошибок {results['errors']}, осталось без URL: {max(total_count - results['extracted'], 0)}")
+    
+    response_data = {
+        'success': True,
+        'results': results
+    }
+    
+    # Если есть еще чаты для обработки, добавляем информацию для следующего запроса
+    if results.get('has_more'):
+        if use_offset:
             response_data['next_offset'] = offset + limit
             response_data['message'] = f'Обработано {len(chats_without_url)} из {total_count} чатов. Для продолжения отправьте запрос с offset={offset + limit}'
+        else:
+            response_data['next_after_id'] = next_after_id
+            response_data['message'] = f'Обработано {len(chats_without_url)} из {total_count} чатов. Для продолжения отправьте запрос с after_id={next_after_id}'
+    
+    return response_data
+
+
+@chats_bp.route('/extract-all-product-urls', methods=['POST'])
+@require_auth
+@handle_errors
+@retry_on_sqlite_busy()
+def extract_all_product_urls():
+    """
+    Принудительно извлечь product_url для всех чатов, у которых его нет
+
+    Каждый чат требует вызова Avito API, поэтому при доступном RQ страница
+    обрабатывается в фоне: ответ 202 с job_id. Без RQ - синхронно, как раньше.
+    """
+    try:
+        request_data = request.get_json() or {}
+        try:
+            # По умолчанию 500 чатов
+            limit, after_id, offset = _extract_page_params(request_data, 500)
+        except ValueError as e:
+            return _json({'error': str(e)}), 400
+        
+        if RQ_AVAILABLE:
+            job = enqueue_extract_product_urls(limit=limit, after_id=after_id, offset=offset)
+            if hasattr(job, 'id'):
+                return _json({
+                    'success': True,
+                    'job_id': job.id,
+                    'status': 'queued',
+                    'message': 'Задача извлечения product_url поставлена в очередь'
+                }), 202
+            # Fallback - задача выполнилась синхронно
+            if job.get('status') == 'error':
+                return _json({'error': job.get('error')}), 500
+            return _json(job), 200
         
-        return jsonify(response_data), 200
+        return _json(run_extract_product_urls(limit=limit, after_id=after_id, offset=offset)), 200
+    except sqlite3.OperationalError:
+        raise  # Повторяется @retry_on_sqlite_busy
     except Exception as e:
         logger.error(f"[EXTRACT ALL] Критическая ошибка: {e}", exc_info=True)
-        # Соединение глобальное, не закрываем
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}), 500
+
+
+def _check_internal_api_key(request_data):
+    """
+    Проверка API ключа внутренних эндпоинтов (заголовок X-API-Key или поле api_key)
+
+    Returns:
+        tuple | None: Ответ 401, если EXTRACT_API_KEY задан и ключ не совпал
+    """
+    api_key = request.headers.get('X-API-Key') or request_data.get('api_key')
+    expected_api_key = os.environ.get('EXTRACT_API_KEY', '')
+    
+    # Если API ключ настроен, проверяем его
+    if expected_api_key and api_key != expected_api_key:
+        logger.warning("[EXTRACT ALL INTERNAL] Неверный API ключ")
+        return _json({'error': 'Invalid API key'}), 401
+    return None
 
 
 @chats_bp.route('/extract-all-product-urls-internal', methods=['POST'])
@@ -717,181 +1239,99 @@ def extract_all_product_urls_internal():
     Извлечь product_url для всех чатов БЕЗ авторизации (для внутреннего использования)
     Требует API ключ в заголовке X-API-Key для защиты (опционально)
     
-    ВАЖНО: Обработка каждого чата требует вызова Avito API, что занимает время.
-    Используйте небольшой limit (10-50) чтобы избежать таймаута nginx.
+    При доступном RQ страница обрабатывается в фоновом воркере: ответ 202 с job_id,
+    прогресс - GET /extract-all-product-urls-internal/status/<job_id>. Таймаут
+    nginx при этом не ограничивает limit. Без RQ - синхронно (limit 10-50).
+    
+    С заголовком Accept: text/event-stream (или ?stream=1) все чаты без URL
+    обрабатываются в одном запросе страницами по limit, а прогресс отдается
+    событиями SSE (progress после каждой страницы, done в конце). Параметр
+    max_chats ограничивает общее количество обработанных чатов.
     """
-    from database import get_db_connection
-    from avito_api import AvitoAPI
-    import re
-    import os
+    request_data = request.get_json(silent=True) or {}
+    auth_error = _check_internal_api_key(request_data)
+    if auth_error:
+        return auth_error
     
-    # Проверка API ключа (опционально, можно задать через переменную окружения)
-    request_data = request.get_json() or {}
-    api_key = request.headers.get('X-API-Key') or request_data.get('api_key')
-    expected_api_key = os.environ.get('EXTRACT_API_KEY', '')
+    try:
+        # Для синхронного режима - не больше 50. Keyset-пагинация по ac.id
+        # (after_id), как в extract_all_product_urls; offset поддерживается
+        # для старых клиентов, если after_id не передан
+        limit, after_id, offset = _extract_page_params(request_data, 50)
+        max_chats = _int_param(request_data, 'max_chats', min_value=1)
+    except ValueError as e:
+        return _json({'error': str(e)}), 400
     
-    # Если API ключ настроен, проверяем его
-    if expected_api_key and api_key != expected_api_key:
-        logger.warning(f"[EXTRACT ALL INTERNAL] Неверный API ключ")
-        return jsonify({'error': 'Invalid API key'}), 401
+    if request.args.get('stream') or 'text/event-stream' in request.headers.get('Accept', ''):
+        return _sse_response(_extract_progress_events(
+            page_size=limit,
+            after_id=after_id or 0,
+            max_chats=max_chats
+        ))
     
-    conn = get_db_connection()
     try:
-        # Получаем все чаты без product_url (уменьшаем лимит по умолчанию, чтобы избежать таймаута)
-        # Обработка каждого чата требует вызова API Avito, что занимает время
-        request_data = request.get_json() or {}
-        limit = request_data.get('limit', 50)  # Уменьшено с 500 до 50
-        offset = request_data.get('offset', 0)
-        
-        chats_without_url = conn.execute('''
-            SELECT ac.id, ac.chat_id, ac.shop_id, s.client_id, s.client_secret, s.user_id, s.shop_url
-            FROM avito_chats ac
-            JOIN avito_shops s ON ac.shop_id = s.id
-            WHERE (ac.product_url IS NULL OR ac.product_url = '')
-            AND s.client_id IS NOT NULL AND s.client_secret IS NOT NULL AND s.user_id IS NOT NULL
-            ORDER BY ac.id
-            LIMIT ? OFFSET ?
-        ''', (limit, offset)).fetchall()
-        
-        # Получаем общее количество чатов без product_url для информации
-        total_without_url = conn.execute('''
-            SELECT COUNT(*) as cnt
-            FROM avito_chats ac
-            JOIN avito_shops s ON ac.shop_id = s.id
-            WHERE (ac.product_url IS NULL OR ac.product_url = '')
-            AND s.client_id IS NOT NULL AND s.client_secret IS NOT NULL AND s.user_id IS NOT NULL
-        ''').fetchone()
-        total_count = total_without_url['cnt'] if total_without_url else 0
-        
-        logger.info(f"[EXTRACT ALL INTERNAL] Найдено {len(chats_without_url)} чатов без product_url (всего без URL: {total_count}, offset: {offset}, limit: {limit})")
-        
-        results = {
-            'total': len(chats_without_url),
-            'total_without_url': total_count,
-            'offset': offset,
-            'limit': limit,
-            'extracted': 0,
-            'errors': 0,
-            'has_more': (offset + limit) < total_count
-        }
-        
-        import time
-        
-        for idx, chat_row in enumerate(chats_without_url):
-            chat = dict(chat_row)
-            chat_id = chat['id']
-            avito_chat_id = chat['chat_id']
-            
-            # Добавляем небольшую задержку между запросами (но не слишком долгую, чтобы не превысить таймаут)
-            if idx > 0 and idx % 5 == 0:
-                logger.info(f"[EXTRACT ALL INTERNAL] Прогресс: обработано {idx}/{len(chats_without_url)} чатов...")
-                time.sleep(0.5)  # Уменьшена задержка
-            
-            try:
-                # ВАЖНО: Avito API не возвращает context.item в списке чатов
-                # Поэтому ОБЯЗАТЕЛЬНО вызываем get_chat_by_id для каждого чата
-                product_url = None
-                if chat['client_id'] and chat['client_secret'] and chat['user_id']:
-                    try:
-                        api = AvitoAPI(
-                            client_id=chat['client_id'],
-                            client_secret=chat['client_secret']
-                        )
-                        chat_details = api.get_chat_by_id(
-                            user_id=chat['user_id'],
-                            chat_id=avito_chat_id
-                        )
-                        
-                        # Детальное логирование для первых 3 чатов
-                        if idx < 3:
-                            logger.info(f"[EXTRACT ALL INTERNAL] Чат {chat_id}: ответ API тип={type(chat_details)}")
-                            if isinstance(chat_details, dict):
-                                logger.info(f"[EXTRACT ALL INTERNAL] Чат {chat_id}: ключи в ответе: {list(chat_details.keys())[:20]}")
-                                if 'context' in chat_details:
-                                    logger.info(f"[EXTRACT ALL INTERNAL] Чат {chat_id}: context тип={type(chat_details.get('context'))}")
-                                    if isinstance(chat_details.get('context'), dict):
-                                        logger.info(f"[EXTRACT ALL INTERNAL] Чат {chat_id}: context ключи: {list(chat_details.get('context', {}).keys())}")
-                        
-                        if isinstance(chat_details, dict):
-                            detail_context = chat_details.get('context', {})
-                            if isinstance(detail_context, dict):
-                                # ВАЖНО: Avito API возвращает context.value, а не context.item!
-                                # Структура: {"context": {"type": "item", "value": {"id": 123, "url": "..."}}}
-                                detail_item = detail_context.get('value') or detail_context.get('item') or detail_context.get('listing') or detail_context.get('ad', {})
-                                
-                                # Логирование для первых чатов
-                                if idx < 3:
-                                    logger.info(f"[EXTRACT ALL INTERNAL] Чат {chat_id}: detail_item тип={type(detail_item)}, значение={str(detail_item)[:200] if detail_item else 'None'}")
-                                
-                                if isinstance(detail_item, dict):
-                                    detail_item_id = detail_item.get('id')
-                                    detail_url = (detail_item.get('url') or 
-                                                 detail_item.get('link') or 
-                                                 detail_item.get('href') or
-                                                 detail_item.get('uri'))
-                                    
-                                    if idx < 3:
-                                        logger.info(f"[EXTRACT ALL INTERNAL] Чат {chat_id}: detail_item_id={detail_item_id}, detail_url={detail_url}")
-                                    
-                                    if detail_url:
-                                        product_url = detail_url
-                                        # URL может быть относительным или абсолютным
-                                        if product_url.startswith('/'):
-                                            product_url = f"https://www.avito.ru{product_url}"
-                                        elif not product_url.startswith('http'):
-                                            product_url = f"https://www.avito.ru{product_url}"
-                                    elif detail_item_id:
-                                        item_id_str = str(detail_item_id)
-                                        shop_url_part = chat.get('shop_url', '').split('/')[-1] if chat.get('shop_url') else ''
-                                        if shop_url_part:
-                                            product_url = f"https://www.avito.ru/{shop_url_part}/items/{item_id_str}"
-                                        else:
-                                            product_url = f"https://www.avito.ru/items/{item_id_str}"
-                            
-                            if not product_url:
-                                product_url = (chat_details.get('item_url') or 
-                                             chat_details.get('listing_url') or 
-                                             chat_details.get('ad_url') or
-                                             chat_details.get('product_url'))
-                                
-                                if idx < 3:
-                                    logger.info(f"[EXTRACT ALL INTERNAL] Чат {chat_id}: проверка прямых полей, product_url={product_url}")
-                    except Exception as api_error:
-                        logger.warning(f"[EXTRACT ALL INTERNAL] Ошибка API для чата {chat_id} (avito_chat_id={avito_chat_id}): {api_error}")
-                
-                # Сохраняем найденный product_url
-                if product_url:
-                    conn.execute('''
-                        UPDATE avito_chats 
-                        SET product_url = ?, updated_at = CURRENT_TIMESTAMP
-                        WHERE id = ?
-                    ''', (product_url, chat_id))
-                    results['extracted'] += 1
-                    logger.info(f"[EXTRACT ALL INTERNAL] ✅ Для чата {chat_id} найден product_url: {product_url}")
-                else:
-                    logger.warning(f"[EXTRACT ALL INTERNAL] ⚠️ Для чата {chat_id} product_url не найден")
-                    results['errors'] += 1
-            except Exception as e:
-                logger.error(f"[EXTRACT ALL INTERNAL] Ошибка для чата {chat_id}: {e}", exc_info=True)
-                results['errors'] += 1
-        
-        conn.commit()
-        
-        logger.info(f"[EXTRACT ALL INTERNAL] Завершено: обработано {results['total']}, найдено {results['extracted']}, ошибок {results['errors']}")
-        
-        response_data = {
-            'success': True,
-            'results': results
-        }
-        
-        if results.get('has_more'):
-            response_data['next_offset'] = offset + limit
-            response_data['message'] = f'Обработано {len(chats_without_url)} из {total_count} чатов. Для продолжения отправьте запрос с offset={offset + limit}'
+        if RQ_AVAILABLE:
+            job = enqueue_extract_product_urls(limit=limit, after_id=after_id, offset=offset)
+            if hasattr(job, 'id'):
+                return _json({
+                    'success': True,
+                    'job_id': job.id,
+                    'status': 'queued',
+                    'status_url': f'/api/chats/extract-all-product-urls-internal/status/{job.id}',
+                    'message': 'Задача извлечения product_url поставлена в очередь'
+                }), 202
+            # Fallback - задача выполнилась синхронно
+            if job.get('status') == 'error':
+                return _json({'error': job.get('error')}), 500
+            return _json(job), 200
         
-        return jsonify(response_data), 200
+        return _json(run_extract_product_urls(limit=limit, after_id=after_id, offset=offset)), 200
     except Exception as e:
         logger.error(f"[EXTRACT ALL INTERNAL] Критическая ошибка: {e}", exc_info=True)
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}), 500
+
+
+def _extract_progress_events(page_size, after_id=0, max_chats=None):
+    """
+    Генератор SSE-событий для потокового extract-all-product-urls-internal.
+
+    Страницы обрабатываются run_extract_product_urls по keyset-курсору after_id;
+    после каждой отдается событие progress с накопленными счетчиками.
+    """
+    totals = {'processed': 0, 'extracted': 0, 'errors': 0}
+    try:
+        while True:
+            result = run_extract_product_urls(limit=page_size, after_id=after_id)
+            page = result['results']
+            totals['processed'] += page['total']
+            totals['extracted'] += page['extracted']
+            totals['errors'] += page['errors']
+            after_id = result.get('next_after_id')
+            yield _sse_event('progress', {
+                **totals,
+                'total_without_url': page['total_without_url'],
+                'next_after_id': after_id
+            })
+            if not after_id or (max_chats and totals['processed'] >= max_chats):
+                break
+        yield _sse_event('done', {**totals, 'next_after_id': after_id})
+    except Exception as e:
+        logger.error("[EXTRACT ALL INTERNAL] Ошибка потоковой обработки: %s", e, exc_info=True)
+        yield _sse_event('error', {**totals, 'error': str(e), 'next_after_id': after_id})
+
+
+@chats_bp.route('/extract-all-product-urls-internal/status/<job_id>', methods=['GET'])
+@handle_errors
+def extract_all_product_urls_internal_status(job_id):
+    """Статус и прогресс фоновой задачи extract-all-product-urls-internal"""
+    auth_error = _check_internal_api_key(request.args)
+    if auth_error:
+        return auth_error
+    
+    status = get_job_status(job_id)
+    if status is None:
+        return _json({'error': 'Job not found'}), 404
+    return _json({'success': True, **status}), 200
 
 
 @chats_bp.route('/<int:chat_id>/extract-product-url', methods=['POST'])
@@ -901,13 +1341,7 @@ def extract_product_url_from_messages(chat_id):
     """
     Извлечь product_url для чата (сначала через API, затем из сообщений)
     """
-    from database import get_db_connection
-    from avito_api import AvitoAPI
-    import re
-    import json
-    
     # ВАЖНО: Логируем в app.logger для гарантированного попадания в логи
-    import logging
     app_logger = logging.getLogger('app')
     app_logger.info(f"[EXTRACT PRODUCT URL] ========== НАЧАЛО ИЗВЛЕЧЕНИЯ ДЛЯ ЧАТА {chat_id} ==========")
     logger.info(f"[EXTRACT PRODUCT URL] ========== НАЧАЛО ИЗВЛЕЧЕНИЯ ДЛЯ ЧАТА {chat_id} ==========")
@@ -925,7 +1359,7 @@ def extract_product_url_from_messages(chat_id):
         
         if not chat:
             logger.warning(f"[EXTRACT PRODUCT URL] Чат {chat_id} не найден в базе данных")
-            return jsonify({
+            return _json({
                 'success': False,
                 'error': 'Chat not found',
                 'message': f'Чат с ID {chat_id} не найден в базе данных'
@@ -936,7 +1370,7 @@ def extract_product_url_from_messages(chat_id):
         # Проверяем, есть ли уже product_url
         if chat_dict.get('existing_product_url'):
             logger.info(f"[EXTRACT PRODUCT URL] У чата {chat_id} уже есть product_url: {chat_dict['existing_product_url']}")
-            return jsonify({
+            return _json({
                 'success': True,
                 'product_url': chat_dict['existing_product_url'],
                 'source': 'existing'
@@ -945,16 +1379,18 @@ def extract_product_url_from_messages(chat_id):
         
         product_url = None
         source = None
+        # force=true в теле запроса - запросить Avito API, даже если недавно ссылка не нашлась
+        force = bool((request.get_json(silent=True) or {}).get('force'))
+        known_miss = not force and _known_without_product_url(chat_dict.get('chat_id'))
         
+        if known_miss:
+            logger.info(f"[EXTRACT PRODUCT URL] Для чата {chat_id} ссылка не найдена менее {_NO_PRODUCT_URL_TTL} с назад, API не запрашиваем")
         # Сначала пробуем через API get_chat_by_id
-        if chat_dict.get('client_id') and chat_dict.get('client_secret') and chat_dict.get('user_id'):
+        elif chat_dict.get('client_id') and chat_dict.get('client_secret') and chat_dict.get('user_id'):
             app_logger.info(f"[EXTRACT PRODUCT URL] Пытаемся получить данные через Avito API для чата {chat_id}...")
             logger.info(f"[EXTRACT PRODUCT URL] Пытаемся получить данные через Avito API...")
             try:
-                api = AvitoAPI(
-                    client_id=chat_dict['client_id'],
-                    client_secret=chat_dict['client_secret']
-                )
+                api = get_avito_api(chat_dict['client_id'], chat_dict['client_secret'])
                 # ВАЖНО: Согласно документации Avito API, context может приходить в базовом ответе
                 # Но для надежности пробуем и с параметрами include_messages/include_users
                 # Сначала пробуем без параметров (быстрее)
@@ -1002,83 +1438,18 @@ def extract_product_url_from_messages(chat_id):
                     logger.warning(f"[EXTRACT PRODUCT URL] API вернул не словарь: {chat_details}")
                 
                 if isinstance(chat_details, dict):
-                    # ВАЖНО: Avito API v3 возвращает context.value, а не context.item!
-                    # Структура: {"context": {"type": "item", "value": {"id": 123, "url": "..."}}}
-                    detail_context = chat_details.get('context', {})
-                    if isinstance(detail_context, dict):
-                        # Приоритет: context.value (API v3), затем context.item (старая версия)
-                        detail_item = (detail_context.get('value') or 
-                                      detail_context.get('item') or 
-                                      detail_context.get('listing') or 
-                                      detail_context.get('ad', {}))
-                        
-                        if isinstance(detail_item, dict):
-                            detail_item_id = detail_item.get('id')
-                            detail_url = (detail_item.get('url') or 
-                                         detail_item.get('link') or 
-                                         detail_item.get('href') or
-                                         detail_item.get('value') or
-                                         detail_item.get('uri'))
-                            
-                            if detail_url:
-                                product_url = detail_url
-                                # URL может быть относительным или абсолютным
-                                if product_url.startswith('/'):
-                                    product_url = f"https://www.avito.ru{product_url}"
-                                elif not product_url.startswith('http'):
-                                    product_url = f"https://www.avito.ru{product_url}"
-                                source = 'api_context_value'
-                                app_logger.info(f"[EXTRACT PRODUCT URL] ✅ Найден через API context.value.url для чата {chat_id}: {product_url}")
-                                logger.info(f"[EXTRACT PRODUCT URL] ✅ Найден через API context.value.url: {product_url}")
-                            elif detail_item_id:
-                                item_id_str = str(detail_item_id)
-                                shop_url_part = chat_dict.get('shop_url', '').split('/')[-1] if chat_dict.get('shop_url') else ''
-                                if shop_url_part:
-                                    product_url = f"https://www.avito.ru/{shop_url_part}/items/{item_id_str}"
-                                else:
-                                    product_url = f"https://www.avito.ru/items/{item_id_str}"
-                                source = 'api_context_value_id'
-                                logger.info(f"[EXTRACT PRODUCT URL] ✅ Найден через API: {product_url}")
-                    
-                    # Если не нашли в context, проверяем прямые поля
-                    if not product_url:
-                        product_url = (chat_details.get('item_url') or 
-                                     chat_details.get('listing_url') or 
-                                     chat_details.get('ad_url') or
-                                     chat_details.get('product_url'))
-                        if product_url:
-                            source = 'api_direct'
-                            logger.info(f"[EXTRACT PRODUCT URL] Найден через API прямые поля: {product_url}")
+                    # Сначала context.value (API v3) / context.item, затем прямые поля чата
+                    product_url, found_in = _extract_product_url(chat_details, _shop_url_part(chat_dict.get('shop_url')))
+                    if product_url:
+                        source = f'api_{found_in}'
+                        app_logger.info(f"[EXTRACT PRODUCT URL] ✅ Найден через API ({source}) для чата {chat_id}: {product_url}")
+                        logger.info(f"[EXTRACT PRODUCT URL] ✅ Найден через API ({source}): {product_url}")
                     
                     # Стратегия 3: Ищем в любых полях ответа API (глубокий поиск)
                     if not product_url:
-                        def find_url_in_dict(d, depth=0, max_depth=3):
-                            """Рекурсивный поиск URL в словаре"""
-                            if depth > max_depth:
-                                return None
-                            if isinstance(d, dict):
-                                for key, value in d.items():
-                                    if isinstance(value, str) and ('avito.ru' in value.lower() or '/items/' in value.lower()):
-                                        # Проверяем, похоже ли на URL объявления
-                                        if re.search(r'items/\d+', value, re.IGNORECASE):
-                                            return value
-                                    result = find_url_in_dict(value, depth + 1, max_depth)
-                                    if result:
-                                        return result
-                            elif isinstance(d, list):
-                                for item in d:
-                                    result = find_url_in_dict(item, depth + 1, max_depth)
-                                    if result:
-                                        return result
-                            return None
-                        
-                        found_url = find_url_in_dict(chat_details)
+                        found_url = _find_item_url(chat_details)
                         if found_url:
-                            product_url = found_url
-                            if product_url.startswith('/'):
-                                product_url = f"https://www.avito.ru{product_url}"
-                            elif not product_url.startswith('http'):
-                                product_url = f"https://www.avito.ru{product_url}"
+                            product_url = normalize_avito_url(found_url)
                             source = 'api_deep_search'
                             logger.info(f"[EXTRACT PRODUCT URL] Найден через глубокий поиск в API: {product_url}")
             except Exception as api_error:
@@ -1086,13 +1457,18 @@ def extract_product_url_from_messages(chat_id):
                 # Устанавливаем chat_details в None, чтобы продолжить выполнение
                 chat_details = None
             
+            # get_chat_by_id ответил, но без context - чат не привязан к объявлению,
+            # и в списке get_chats context для него тоже не будет
+            no_context = isinstance(chat_details, dict) and 'context' not in chat_details
+            
             # УЛУЧШЕНИЕ СПОСОБА 2: Если get_chat_by_id не сработал (404 или None), пробуем get_chats
             # Это часть способа 2, так как используем тот же API, просто другой метод
-            if not product_url and chat_dict.get('client_id') and chat_dict.get('client_secret') and chat_dict.get('user_id'):
+            if not product_url and not no_context:
                 try:
                     # Ищем нужный чат в списке
                     target_chat = None
                     avito_chat_id = chat_dict.get('chat_id')
+                    avito_chat_id_str = str(avito_chat_id)
                     
                     # Используем пагинацию: проверяем первые 3 страницы (300 чатов)
                     max_pages = 3
@@ -1119,25 +1495,14 @@ def extract_product_url_from_messages(chat_id):
                         else:
                             chats_array = []
                         
-                        # Ищем чат по avito_chat_id
-                        for idx, chat_item in enumerate(chats_array):
-                            if isinstance(chat_item, dict):
-                                # Проверяем разные возможные поля для ID чата
-                                item_id = (chat_item.get('id') or 
-                                          chat_item.get('chat_id') or
-                                          chat_item.get('value', {}).get('id'))
-                                
-                                # Сравниваем ID (с учетом разных форматов)
-                                if item_id and (str(item_id) == str(avito_chat_id) or 
-                                               item_id == avito_chat_id):
-                                    target_chat = chat_item
-                                    logger.info(f"[EXTRACT PRODUCT URL] ✅ Найден чат в списке get_chats (страница {page + 1})")
-                                    break
-                            
-                            if target_chat:
-                                break
-                        
+                        # Ищем чат по avito_chat_id (один проход, до первого совпадения)
+                        target_chat = next(
+                            (chat_item for chat_item in chats_array
+                             if _chat_item_id(chat_item) == avito_chat_id_str),
+                            None
+                        )
                         if target_chat:
+                            logger.info(f"[EXTRACT PRODUCT URL] ✅ Найден чат в списке get_chats (страница {page + 1})")
                             break
                         
                         # Если на этой странице меньше чатов, чем лимит, значит это последняя страница
@@ -1146,90 +1511,52 @@ def extract_product_url_from_messages(chat_id):
                     
                     if target_chat:
                         # Извлекаем context из найденного чата
-                        target_context = target_chat.get('context', {})
-                        if isinstance(target_context, dict):
-                            # ВАЖНО: Avito API v3 возвращает context.value, а не context.item!
-                            context_item = (target_context.get('value') or 
-                                           target_context.get('item') or 
-                                           target_context.get('listing') or 
-                                           target_context.get('ad', {}))
-                            
-                            if isinstance(context_item, dict):
-                                context_item_id = context_item.get('id')
-                                context_url = (context_item.get('url') or 
-                                             context_item.get('link') or 
-                                             context_item.get('href') or
-                                             context_item.get('value') or
-                                             context_item.get('uri'))
-                                
-                                if context_url:
-                                    product_url = context_url
-                                    if product_url.startswith('/'):
-                                        product_url = f"https://www.avito.ru{product_url}"
-                                    elif not product_url.startswith('http'):
-                                        product_url = f"https://www.avito.ru{product_url}"
-                                    source = 'api_get_chats_context_value'
-                                    logger.info(f"[EXTRACT PRODUCT URL] ✅ Найден через get_chats: {product_url}")
-                                elif context_item_id:
-                                    item_id_str = str(context_item_id)
-                                    shop_url_part = chat_dict.get('shop_url', '').split('/')[-1] if chat_dict.get('shop_url') else ''
-                                    if shop_url_part:
-                                        product_url = f"https://www.avito.ru/{shop_url_part}/items/{item_id_str}"
-                                    else:
-                                        product_url = f"https://www.avito.ru/items/{item_id_str}"
-                                    source = 'api_get_chats_context_value_id'
-                                    logger.info(f"[EXTRACT PRODUCT URL] ✅ Найден через get_chats: {product_url}")
+                        product_url, found_in = _extract_product_url(target_chat, _shop_url_part(chat_dict.get('shop_url')), include_direct=False)
+                        if product_url:
+                            source = f'api_get_chats_{found_in}'
+                            logger.info(f"[EXTRACT PRODUCT URL] ✅ Найден через get_chats: {product_url}")
                     else:
                         # Логируем примеры ID из последней проверенной страницы для диагностики
-                        if chats_array and len(chats_array) > 0:
-                            sample_ids = []
-                            for idx, sample_chat in enumerate(chats_array[:3]):  # Первые 3 чата
-                                if isinstance(sample_chat, dict):
-                                    sample_id = (sample_chat.get('id') or 
-                                                sample_chat.get('chat_id') or
-                                                sample_chat.get('value', {}).get('id'))
-                                    sample_ids.append(str(sample_id))
+                        if chats_array:
+                            sample_ids = [str(_chat_item_id(sample_chat)) for sample_chat in chats_array[:3]]  # Первые 3 чата
                             logger.warning(f"[EXTRACT PRODUCT URL] ⚠️ Чат {avito_chat_id} не найден. Примеры ID: {', '.join(sample_ids)}")
                 except Exception as get_chats_error:
                     logger.debug(f"[EXTRACT PRODUCT URL] Ошибка get_chats: {get_chats_error}")
+            
+            # API ответил, но ссылки нет - запоминаем, чтобы не повторять запросы
+            if not product_url and isinstance(chat_details, dict):
+                _remember_without_product_url(chat_dict.get('chat_id'))
         else:
             logger.warning(f"[EXTRACT PRODUCT URL] Нет credentials для API запроса (client_id, client_secret или user_id отсутствуют)")
         
         # Сохраняем найденный product_url
         if product_url:
-            conn.execute('''
-                UPDATE avito_chats 
-                SET product_url = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (product_url, chat_id))
-            conn.commit()
+            _save_product_urls(conn, [(product_url, chat_id)])
             
             logger.info(f"[EXTRACT PRODUCT URL] Для чата {chat_id} найден product_url: {product_url} (источник: {source})")
-            # Соединение глобальное, не закрываем
-            return jsonify({
+            return _json({
                 'success': True,
                 'product_url': product_url,
                 'source': source or 'unknown'
             }), 200
         
-        # Соединение глобальное, не закрываем
         logger.warning(f"[EXTRACT PRODUCT URL] ⚠️ Не удалось найти product_url для чата {chat_id}")
         
         # Возвращаем 200 с success: false, а не 404, так как это не ошибка маршрута
-        return jsonify({
+        return _json({
             'success': False,
             'message': 'Product URL not found',
             'error': 'Product URL not found in chat messages or API',
             'debug_info': {
                 'has_api_credentials': bool(chat_dict.get('client_id') and chat_dict.get('client_secret') and chat_dict.get('user_id')),
                 'chat_id_in_db': chat_dict.get('chat_id'),
-                'shop_id': chat_dict.get('shop_id')
+                'shop_id': chat_dict.get('shop_id'),
+                'recently_not_found': known_miss
             }
         }), 200
     except Exception as e:
         logger.error(f"[EXTRACT PRODUCT URL] Ошибка для чата {chat_id}: {e}", exc_info=True)
-        # Соединение глобальное, не закрываем
-        return jsonify({
+        return _json({
             'success': False,
             'error': str(e),
             'message': f'Ошибка при извлечении product_url: {str(e)}'
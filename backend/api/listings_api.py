@@ -1,122 +1,262 @@
 """
 Listings API - endpoints для работы с объявлениями
 """
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify, session, current_app, g
+from collections import OrderedDict
 from functools import wraps
+import json
 import logging
+import os
+import threading
+import time
+from database import get_db_connection, get_db_reader
+from services.listings_service import ListingsService, LISTING_FORBIDDEN, LISTING_NOT_FOUND, LISTING_OK
+from tasks import enqueue_save_search_results, get_job_status, redis_conn
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 logger = logging.getLogger(__name__)
 
 listings_bp = Blueprint('listings_api', __name__, url_prefix='/api/listings')
 
+# Кэш ответов: результаты публичного поиска и страницы сохраненных объявлений.
+# Хранится в Redis (общий для всех воркеров) или, если Redis недоступен, в памяти процесса.
+# Страницы сохраненных объявлений зависят от поколения кэша, которое увеличивается
+# при любой записи в avito_listings, так что устаревшая страница не отдается.
+_LISTINGS_CACHE_TTL = int(os.environ.get('LISTINGS_CACHE_TTL', '60'))
+_LISTINGS_CACHE_MAXSIZE = 1000
+# Количество сохраненных объявлений по фильтру: по нему страницы за концом
+# выборки отдаются пустыми без запроса к БД
+_LISTINGS_TOTAL_TTL = int(os.environ.get('LISTINGS_TOTAL_TTL', '10'))
+_LISTINGS_GEN_KEY = 'listings:gen'
+_listings_cache = OrderedDict()  # key -> (expires_at, value)
+_listings_cache_lock = threading.Lock()
+_listings_gen = 0
+
+
+def _json_encode(payload) -> bytes:
+    """Сериализует значение в JSON (bytes) через orjson, если он установлен, иначе через json"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(payload, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')
+
+
+def _json_decode(data):
+    """Разбирает JSON (str или bytes) через orjson, если он установлен, иначе через json"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json(payload, status=200):
+    """JSON-ответ через orjson (C-энкодер), если он установлен; замена jsonify для списков объявлений"""
+    return current_app.response_class(_json_encode(payload), status=status, mimetype='application/json')
+
+
+def _cache_get(key):
+    """Значение из кэша ответов или None"""
+    if redis_conn is not None:
+        try:
+            cached = redis_conn.get(key)
+            return _json_decode(cached) if cached is not None else None
+        except Exception as e:
+            logger.warning("[LISTINGS API] Redis недоступен для кэша ответов: %s", e)
+            return None
+    with _listings_cache_lock:
+        entry = _listings_cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del _listings_cache[key]
+            return None
+        _listings_cache.move_to_end(key)
+        return entry[1]
+
+
+def _cache_set(key, value, ttl=None):
+    """Положить значение в кэш ответов на ttl секунд (по умолчанию LISTINGS_CACHE_TTL)"""
+    ttl = ttl or _LISTINGS_CACHE_TTL
+    if redis_conn is not None:
+        try:
+            redis_conn.setex(key, ttl, _json_encode(value))
+        except Exception:
+            pass
+        return
+    with _listings_cache_lock:
+        _listings_cache[key] = (time.monotonic() + ttl, value)
+        _listings_cache.move_to_end(key)
+        while len(_listings_cache) > _LISTINGS_CACHE_MAXSIZE:
+            _listings_cache.popitem(last=False)
+
+
+def _listings_generation() -> int:
+    """Текущее поколение кэша сохраненных объявлений"""
+    if redis_conn is not None:
+        try:
+            return int(redis_conn.get(_LISTINGS_GEN_KEY) or 0)
+        except Exception:
+            return 0
+    return _listings_gen
+
+
+def _invalidate_listings_cache():
+    """Сбросить закэшированные страницы сохраненных объявлений после записи в БД"""
+    global _listings_gen
+    if redis_conn is not None:
+        try:
+            redis_conn.incr(_LISTINGS_GEN_KEY)
+        except Exception:
+            pass
+        return
+    with _listings_cache_lock:
+        _listings_gen += 1
+        for key in [k for k in _listings_cache if k.startswith(('listings:page:', 'listings:total:'))]:
+            del _listings_cache[key]
+
+
+_LISTING_WRITE_ERRORS = {
+    LISTING_NOT_FOUND: ({'error': 'Listing not found'}, 404),
+    LISTING_FORBIDDEN: ({'error': 'Access denied'}, 403),
+}
+
+
+def _json_number(data, key, cast, default=None):
+    """
+    Число из JSON-тела запроса
+    
+    Аналог request.args.get(key, type=...) для dict: у dict.get нет аргумента type,
+    поэтому значение приводится явно, а пустое или некорректное заменяется default.
+    """
+    value = data.get(key)
+    if value is None or value == '':
+        return default
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return default
+
 
 def require_auth(f):
-    """Декоратор проверки аутентификации"""
+    """Декоратор проверки аутентификации; кладет user_id и user_role в g"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        user_id = session.get('user_id')
+        if user_id is None:
             return jsonify({'error': 'Not authenticated'}), 401
+        g.user_id = user_id
+        g.user_role = session.get('user_role', 'unknown')
         return f(*args, **kwargs)
     return decorated_function
 
 
+def save_search_results(listings, search_params, user_id):
+    """
+    Сохранить параметры поиска и найденные объявления
+    
+    Параметры поиска и объявления пишутся одной транзакцией (один fsync).
+    Вызывается из save_search_results_task (RQ) или синхронно, если RQ недоступен.
+    
+    Returns:
+        dict: {'param_id': int, 'saved': int}
+    """
+    conn = get_db_connection()
+    service = ListingsService(conn)
+    start_time = time.perf_counter()
+    
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+    try:
+        param_id = service.save_search_params(search_params, user_id)
+        saved_count = service.save_listings_bulk(listings, param_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    _invalidate_listings_cache()
+    
+    logger.info("[LISTINGS API] Сохранение завершено за %.2f сек. Сохранено: %d/%d объявлений, param_id=%s",
+                time.perf_counter() - start_time, saved_count, len(listings), param_id)
+    return {'param_id': param_id, 'saved': saved_count}
+
+
 @listings_bp.route('/search', methods=['POST'])
 @require_auth
 def search_listings():
     """Поиск объявлений"""
-    from database import get_db_connection
-    from services.listings_service import ListingsService
-    
-    user_id = session.get('user_id')
-    user_role = session.get('user_role', 'unknown')
+    user_id = g.user_id
+    user_role = g.user_role
     
-    logger.info(f"[LISTINGS API] Начало поиска объявлений. User ID: {user_id}, Role: {user_role}")
+    logger.debug("[LISTINGS API] Начало поиска объявлений. User ID: %s, Role: %s", user_id, user_role)
     
-    data = request.get_json() or {}
+    data = request.get_json(silent=True) or {}
     
     query = data.get('query')
-    category_id = data.get('category_id', type=int)
-    location_id = data.get('location_id', type=int)
-    price_min = data.get('price_min', type=float)
-    price_max = data.get('price_max', type=float)
-    limit = min(int(data.get('limit', 50)), 100)
+    category_id = _json_number(data, 'category_id', int)
+    location_id = _json_number(data, 'location_id', int)
+    price_min = _json_number(data, 'price_min', float)
+    price_max = _json_number(data, 'price_max', float)
+    limit = min(_json_number(data, 'limit', int, 50), 100)
     save_results = data.get('save_results', False)
     
-    logger.info(f"[LISTINGS API] Параметры поиска: query='{query}', category_id={category_id}, "
-                f"location_id={location_id}, price_min={price_min}, price_max={price_max}, "
-                f"limit={limit}, save_results={save_results}")
+    logger.debug("[LISTINGS API] Параметры поиска: query='%s', category_id=%s, location_id=%s, "
+                 "price_min=%s, price_max=%s, limit=%s, save_results=%s",
+                 query, category_id, location_id, price_min, price_max, limit, save_results)
     
     try:
-        conn = get_db_connection()
-        logger.debug(f"[LISTINGS API] Подключение к БД установлено")
-        
-        service = ListingsService(conn)
-        logger.debug(f"[LISTINGS API] ListingsService создан")
+        service = ListingsService(get_db_connection())
         
         # Поиск
-        logger.info(f"[LISTINGS API] Вызов service.search_public_listings()...")
-        import time
-        start_time = time.time()
-        
-        results = service.search_public_listings(
-            query=query,
-            category_id=category_id,
-            location_id=location_id,
-            price_min=price_min,
-            price_max=price_max,
-            limit=limit
+        start_time = time.perf_counter()
+        search_cache_key = 'listings:search:' + json.dumps(
+            [query, category_id, location_id, price_min, price_max, limit], ensure_ascii=False
         )
+        results = _cache_get(search_cache_key)
+        if results is None:
+            logger.debug("[LISTINGS API] Вызов service.search_public_listings()...")
+            results = service.search_public_listings(
+                query=query,
+                category_id=category_id,
+                location_id=location_id,
+                price_min=price_min,
+                price_max=price_max,
+                limit=limit
+            )
+            if 'error' not in results:
+                _cache_set(search_cache_key, results)
+        else:
+            logger.debug("[LISTINGS API] Результаты поиска взяты из кэша")
         
-        elapsed_time = time.time() - start_time
+        elapsed_time = time.perf_counter() - start_time
         listings_count = len(results.get('listings', []))
         total_count = results.get('total', 0)
         
-        logger.info(f"[LISTINGS API] Поиск завершен за {elapsed_time:.2f} сек. "
-                    f"Найдено объявлений: {listings_count}, total: {total_count}")
+        logger.info("[LISTINGS API] Поиск завершен за %.2f сек. Найдено объявлений: %d, total: %s",
+                    elapsed_time, listings_count, total_count)
         
         if 'error' in results:
-            logger.warning(f"[LISTINGS API] Ошибка в результатах поиска: {results.get('error')}")
+            logger.warning("[LISTINGS API] Ошибка в результатах поиска: %s", results.get('error'))
         
-        # Сохраняем результаты если нужно
+        # Сохраняем результаты если нужно: в фоновом воркере RQ, если он доступен,
+        # чтобы запись в БД не задерживала ответ
         saved_count = 0
         param_id = None
+        job_id = None
         
         if save_results:
-            logger.info(f"[LISTINGS API] Сохранение результатов включено. Начало сохранения...")
-            
             if results.get('listings'):
-                logger.debug(f"[LISTINGS API] Сохранение параметров поиска...")
-                # Сохраняем параметры поиска
-                param_id = service.save_search_params(data, user_id)
-                logger.info(f"[LISTINGS API] Параметры поиска сохранены с ID: {param_id}")
-                
-                # Сохраняем объявления
-                logger.debug(f"[LISTINGS API] Сохранение {listings_count} объявлений...")
-                save_start_time = time.time()
-                
-                for idx, listing in enumerate(results['listings'], 1):
-                    listing_id = listing.get('listing_id', 'unknown')
-                    listing_title = listing.get('title', '')[:50]  # Первые 50 символов
-                    logger.debug(f"[LISTINGS API] Сохранение объявления {idx}/{listings_count}: "
-                                f"ID={listing_id}, title='{listing_title}'")
-                    
-                    saved_id = service.save_listing(listing, param_id)
-                    if saved_id:
-                        saved_count += 1
-                        logger.debug(f"[LISTINGS API] Объявление {idx} сохранено с БД ID: {saved_id}")
-                    else:
-                        logger.warning(f"[LISTINGS API] Не удалось сохранить объявление {idx} (ID={listing_id})")
-                
-                save_elapsed = time.time() - save_start_time
-                logger.info(f"[LISTINGS API] Сохранение завершено за {save_elapsed:.2f} сек. "
-                           f"Сохранено: {saved_count}/{listings_count} объявлений")
+                job = enqueue_save_search_results(results['listings'], data, user_id)
+                if hasattr(job, 'id'):
+                    job_id = job.id
+                elif job.get('status') == 'error':
+                    raise RuntimeError(job.get('error'))
+                else:
+                    param_id, saved_count = job['param_id'], job['saved']
             else:
-                logger.warning(f"[LISTINGS API] Нет объявлений для сохранения")
-        else:
-            logger.debug(f"[LISTINGS API] Сохранение результатов отключено")
-        
-        conn.close()
-        logger.debug(f"[LISTINGS API] Подключение к БД закрыто")
+                logger.warning("[LISTINGS API] Нет объявлений для сохранения")
         
         response_data = {
             'listings': results.get('listings', []),
@@ -124,14 +264,14 @@ def search_listings():
             'saved': saved_count,
             'param_id': param_id
         }
+        if job_id:
+            response_data['job_id'] = job_id
+            response_data['status_url'] = f'/api/listings/jobs/{job_id}'
         
-        logger.info(f"[LISTINGS API] Поиск завершен успешно. Возврат ответа: "
-                   f"listings={listings_count}, total={total_count}, saved={saved_count}")
-        
-        return jsonify(response_data)
+        return _json(response_data)
         
     except Exception as e:
-        logger.error(f"[LISTINGS API] КРИТИЧЕСКАЯ ОШИБКА при поиске объявлений: {str(e)}", exc_info=True)
+        logger.error("[LISTINGS API] КРИТИЧЕСКАЯ ОШИБКА при поиске объявлений: %s", e, exc_info=True)
         return jsonify({
             'error': str(e),
             'listings': [],
@@ -140,57 +280,69 @@ def search_listings():
         }), 500
 
 
+@listings_bp.route('/jobs/<job_id>', methods=['GET'])
+@require_auth
+def get_listings_job(job_id):
+    """Статус фоновой задачи сохранения результатов поиска"""
+    status = get_job_status(job_id)
+    if status is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({'success': True, **status})
+
+
 @listings_bp.route('/', methods=['GET'])
 @require_auth
 def get_listings():
     """Получить сохранённые объявления"""
-    from database import get_db_connection
-    from services.listings_service import ListingsService
+    user_id = g.user_id
+    user_role = g.user_role
     
-    user_id = session.get('user_id')
-    user_role = session.get('user_role', 'unknown')
-    
-    logger.info(f"[LISTINGS API] Получение сохраненных объявлений. User ID: {user_id}, Role: {user_role}")
+    logger.debug("[LISTINGS API] Получение сохраненных объявлений. User ID: %s, Role: %s", user_id, user_role)
     
     status = request.args.get('status')
-    limit = min(int(request.args.get('limit', 100)), 500)
-    offset = int(request.args.get('offset', 0))
+    limit = max(1, min(request.args.get('limit', default=100, type=int), 500))
+    offset = max(0, request.args.get('offset', default=0, type=int))
     
-    logger.info(f"[LISTINGS API] Параметры запроса: status='{status}', limit={limit}, offset={offset}")
+    logger.debug("[LISTINGS API] Параметры запроса: status='%s', limit=%d, offset=%d", status, limit, offset)
     
     # Для менеджеров - только их объявления
-    if session.get('user_role') == 'manager':
-        manager_id = session['user_id']
-        logger.debug(f"[LISTINGS API] Фильтр по менеджеру: manager_id={manager_id}")
-    else:
-        manager_id = None
-        logger.debug(f"[LISTINGS API] Фильтр по менеджеру: нет (роль: {user_role})")
+    manager_id = user_id if user_role == 'manager' else None
+    
+    generation = _listings_generation()
+    page_cache_key = f'listings:page:{generation}:{manager_id}:{status}:{limit}:{offset}'
+    cached = _cache_get(page_cache_key)
+    if cached is not None:
+        logger.debug("[LISTINGS API] Страница объявлений взята из кэша")
+        return _json(cached)
+    
+    total_cache_key = f'listings:total:{generation}:{manager_id}:{status}'
+    cached_total = _cache_get(total_cache_key)
+    if cached_total is not None and offset >= cached_total:
+        return _json({
+            'listings': [],
+            'total': cached_total,
+            'limit': limit,
+            'offset': offset,
+            'has_more': False
+        })
     
     try:
-        conn = get_db_connection()
-        logger.debug(f"[LISTINGS API] Подключение к БД установлено")
+        start_time = time.perf_counter()
         
-        service = ListingsService(conn)
-        logger.debug(f"[LISTINGS API] ListingsService создан")
+        # Только чтение: соединение из пула читателей, глобальный writer не блокируется
+        with get_db_reader() as conn:
+            listings, total = ListingsService(conn).get_saved_listings(
+                status=status,
+                assigned_manager_id=manager_id,
+                limit=limit,
+                offset=offset
+            )
         
-        import time
-        start_time = time.time()
-        
-        listings, total = service.get_saved_listings(
-            status=status,
-            assigned_manager_id=manager_id,
-            limit=limit,
-            offset=offset
-        )
-        
-        elapsed_time = time.time() - start_time
+        elapsed_time = time.perf_counter() - start_time
         listings_count = len(listings)
         
-        logger.info(f"[LISTINGS API] Запрос выполнен за {elapsed_time:.2f} сек. "
-                   f"Получено объявлений: {listings_count}, всего в БД: {total}")
-        
-        conn.close()
-        logger.debug(f"[LISTINGS API] Подключение к БД закрыто")
+        logger.info("[LISTINGS API] Запрос выполнен за %.2f сек. Получено объявлений: %d, всего в БД: %d",
+                    elapsed_time, listings_count, total)
         
         response_data = {
             'listings': listings,
@@ -200,12 +352,12 @@ def get_listings():
             'has_more': offset + limit < total
         }
         
-        logger.info(f"[LISTINGS API] Запрос завершен успешно. has_more={response_data['has_more']}")
-        
-        return jsonify(response_data)
+        _cache_set(page_cache_key, response_data)
+        _cache_set(total_cache_key, total, ttl=_LISTINGS_TOTAL_TTL)
+        return _json(response_data)
         
     except Exception as e:
-        logger.error(f"[LISTINGS API] ОШИБКА при получении объявлений: {str(e)}", exc_info=True)
+        logger.error("[LISTINGS API] ОШИБКА при получении объявлений: %s", e, exc_info=True)
         return jsonify({
             'error': str(e),
             'listings': [],
@@ -217,10 +369,7 @@ def get_listings():
 @require_auth
 def update_listing(listing_id):
     """Обновить объявление"""
-    from database import get_db_connection
-    from services.listings_service import ListingsService
-    
-    data = request.get_json() or {}
+    data = request.get_json(silent=True) or {}
     
     status = data.get('status')
     notes = data.get('notes')
@@ -228,46 +377,36 @@ def update_listing(listing_id):
     if not status:
         return jsonify({'error': 'Status is required'}), 400
     
-    conn = get_db_connection()
-    service = ListingsService(conn)
-
-    listing = conn.execute('SELECT assigned_manager_id FROM avito_listings WHERE id = ?', (listing_id,)).fetchone()
-    if not listing:
-        conn.close()
-        return jsonify({'error': 'Listing not found'}), 404
-    if session.get('user_role') == 'manager' and listing['assigned_manager_id'] not in (None, session.get('user_id')):
-        conn.close()
-        return jsonify({'error': 'Access denied'}), 403
-    
-    success = service.update_listing_status(listing_id, status, notes)
+    manager_id = g.user_id if g.user_role == 'manager' else None
     
-    conn.close()
+    try:
+        result = ListingsService(get_db_connection()).update_listing_status(
+            listing_id, status, notes, manager_id=manager_id
+        )
+    except Exception as e:
+        logger.error("[LISTINGS API] Ошибка обновления объявления %s: %s", listing_id, e, exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
     
-    return jsonify({'success': success})
+    if result != LISTING_OK:
+        body, code = _LISTING_WRITE_ERRORS[result]
+        return jsonify(body), code
+    _invalidate_listings_cache()
+    return jsonify({'success': True})
 
 
 @listings_bp.route('/<int:listing_id>', methods=['DELETE'])
 @require_auth
 def delete_listing(listing_id):
     """Удалить объявление"""
-    from database import get_db_connection
-    
-    conn = get_db_connection()
+    manager_id = g.user_id if g.user_role == 'manager' else None
     
     try:
-        listing = conn.execute('SELECT assigned_manager_id FROM avito_listings WHERE id = ?', (listing_id,)).fetchone()
-        if not listing:
-            conn.close()
-            return jsonify({'error': 'Listing not found'}), 404
-        if session.get('user_role') == 'manager' and listing['assigned_manager_id'] not in (None, session.get('user_id')):
-            conn.close()
-            return jsonify({'error': 'Access denied'}), 403
-
-        conn.execute('DELETE FROM avito_listings WHERE id = ?', (listing_id,))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True})
+        result = ListingsService(get_db_connection()).delete_listing(listing_id, manager_id=manager_id)
     except Exception as e:
-        conn.close()
         return jsonify({'error': str(e)}), 500
-
+    
+    if result != LISTING_OK:
+        body, code = _LISTING_WRITE_ERRORS[result]
+        return jsonify(body), code
+    _invalidate_listings_cache()
+    return jsonify({'success': True})
@@ -13,25 +13,66 @@ OSAGAMING CRM - Основной файл приложения Flask
 Версия: 2.0
 """
 
-from flask import Flask, jsonify, render_template, send_from_directory, request, session, redirect, url_for, flash, make_response
+from flask import Flask, jsonify, render_template, send_from_directory, request, session, redirect, url_for, flash, make_response, has_request_context, g, Response
 try:
     from flask_cors import CORS
     CORS_AVAILABLE = True
 except ImportError:
     CORS_AVAILABLE = False
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import wraps
 import json
 import os
 import re
 import secrets
 import sqlite3
+import threading
+import traceback
 from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
 from typing import Optional, Dict, Any
-from database import get_db_connection, init_database
-from auth import authenticate_user, get_user_by_id, get_user_settings
+from database import get_db_connection, get_db_reader, init_database, open_writer_connection, release_db_connection
+from avito_api import AvitoAPI, get_avito_api
+from auth import (
+    authenticate_user, generate_temp_password, get_user_by_id, get_user_bundle, get_user_settings,
+    hash_password, invalidate_user_cache, update_user_password
+)
 from health import register_health_routes
+from utils.decorators import require_role
+from utils.helpers import DIRECT_PRODUCT_URL_KEYS, check_name_columns, first_present
+from utils.validators import validate_email
+from tasks import redis_conn
+from session_redis import RedisSessionInterface
 import time
 
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+def _json_dumps(value):
+    """Сериализует значение в JSON-строку через orjson (C-энкодер), если он установлен, иначе через json"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(value, default=str)
+
+
+def _json_response(value, status=200):
+    """
+    JSON-ответ, сериализованный _json_dumps
+
+    В отличие от jsonify не сортирует ключи и при наличии orjson кодирует
+    ответ C-энкодером сразу в байты - используется для списков, которые
+    отдаются целиком (пользователи, магазины).
+    """
+    if ORJSON_AVAILABLE:
+        body = orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS)
+    else:
+        body = json.dumps(value, default=str)
+    return Response(body, status=status, mimetype='application/json')
+
 # ==================== ИНИЦИАЛИЗАЦИЯ ПРИЛОЖЕНИЯ ====================
 
 # Создаем экземпляр Flask приложения
@@ -39,15 +80,44 @@ import time
 app = Flask(__name__)
 
 # Настройка логирования в файл
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 # Создаем папку для логов если её нет
 log_dir = os.path.join(os.path.dirname(__file__), 'logs')
 os.makedirs(log_dir, exist_ok=True)
 
+
+class _RotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler без проверки файла на каждую запись
+    
+    Стандартный shouldRollover вызывает os.path.exists/isfile при каждом emit.
+    Здесь признак обычного файла запоминается при открытии потока, а решение
+    о ротации принимается только по текущей позиции в файле.
+    """
+
+    def _open(self):
+        stream = super()._open()
+        self._is_regular_file = os.path.isfile(self.baseFilename)
+        return stream
+
+    def shouldRollover(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        if self.maxBytes <= 0 or not self._is_regular_file:
+            return False
+        pos = self.stream.tell()
+        if not pos:
+            return False
+        msg = "%s\n" % self.format(record)
+        return pos + len(msg) >= self.maxBytes
+
+
 # Настройка файлового логирования
-file_handler = RotatingFileHandler(
+file_handler = _RotatingFileHandler(
     os.path.join(log_dir, 'app.log'),
     maxBytes=10240000,  # 10MB
     backupCount=10
@@ -56,7 +126,6 @@ file_handler.setFormatter(logging.Formatter(
     '%(asctime)s [%(levelname)s] %(name)s: %(message)s [in %(pathname)s:%(lineno)d]'
 ))
 file_handler.setLevel(logging.INFO)
-app.logger.addHandler(file_handler)
 app.logger.setLevel(logging.INFO)
 
 # Также выводим в консоль
@@ -65,7 +134,17 @@ console_handler.setFormatter(logging.Formatter(
     '%(asctime)s [%(levelname)s] %(message)s'
 ))
 console_handler.setLevel(logging.INFO)
-app.logger.addHandler(console_handler)
+
+# Запись в файл и консоль выполняет фоновый поток QueueListener: в потоке
+# запроса вызов app.logger только кладет запись в очередь и не ждет диска.
+# Ротация (переименование файлов при достижении maxBytes) тоже происходит
+# в этом потоке, поэтому не дает всплесков задержки у запросов
+_log_queue = queue.Queue(-1)
+app.logger.addHandler(QueueHandler(_log_queue))
+_log_listener = QueueListener(_log_queue, file_handler, console_handler, respect_handler_level=True)
+_log_listener.start()
+# При завершении процесса дописываем оставшиеся в очереди записи
+atexit.register(_log_listener.stop)
 
 # Устанавливаем секретный ключ для сессий
 # Используется для шифрования данных сессии (cookies)
@@ -97,6 +176,12 @@ app.config['SESSION_COOKIE_HTTPONLY'] = True   # Защита от XSS
 app.config['SESSION_COOKIE_SECURE'] = os.environ.get('SESSION_COOKIE_SECURE', 'False').lower() == 'true'  # HTTPS только в продакшене
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)  # Сессия живет 7 дней
 
+# Данные сессии храним в Redis, в cookie - только подписанный идентификатор.
+# Без Redis (или при SESSION_TYPE=cookie) остаются стандартные cookie-сессии Flask
+if redis_conn is not None and os.environ.get('SESSION_TYPE', 'redis').lower() == 'redis':
+    app.session_interface = RedisSessionInterface(redis_conn)
+    app.logger.info("[INIT] Сессии хранятся в Redis")
+
 # Включаем CORS (Cross-Origin Resource Sharing) для работы с фронтендом
 # Ограничиваем список разрешённых источников через переменную окружения CORS_ORIGINS
 # (например: "http://localhost:3000,https://crm.example.com")
@@ -111,7 +196,7 @@ else:
 # Инициализируем базу данных при старте приложения
 # Создает все необходимые таблицы, индексы и тестовые данные
 try:
-    from database import safe_init_database, get_db_connection
+    from database import safe_init_database
     safe_init_database()
     # Инициализируем глобальное соединение при старте
     get_db_connection()
@@ -124,11 +209,17 @@ except Exception as e:
         get_db_connection()
     except Exception as e2:
         app.logger.error(f"Критическая ошибка инициализации БД: {e2}")
-        import traceback
         traceback.print_exc()
 # Регистрируем health/readiness/metrics
 register_health_routes(app)
 
+
+@app.teardown_appcontext
+def _release_db_connection(exc):
+    """Вернуть соединение с БД потока запроса в пул"""
+    release_db_connection()
+
+
 # Регистрируем blueprints для API
 # ВРЕМЕННО ОТКЛЮЧЕН: chats_bp конфликтует с @app.route('/api/chats') в app.py
 # Используем обработчик из app.py вместо blueprint
@@ -141,165 +232,86 @@ except Exception as e:
 
 # ==================== КОНТЕКСТНЫЙ ПРОЦЕССОР ====================
 
+# Роли с доступом к административным вкладкам
+_ADMIN_ROLES = frozenset({'admin', 'super_admin'})
+
+# Видимость вкладок по умолчанию (если у пользователя нет своих настроек).
+# Неизменяемые словари строятся один раз, в шаблон уходит их копия
+_TAB_VISIBILITY_ADMIN = MappingProxyType({
+    'dashboard': True, 'chats': True, 'buyout': True,
+    'deliveries': True, 'quick_replies': True,
+    'shops': True, 'analytics': True, 'settings': True
+})
+_TAB_VISIBILITY_MANAGER = MappingProxyType({
+    'dashboard': True, 'chats': True, 'buyout': True,
+    'deliveries': True, 'quick_replies': True,
+    'shops': False, 'analytics': False, 'settings': False
+})
+_TAB_VISIBILITY_OTHER = MappingProxyType({})
+_TAB_VISIBILITY_DEFAULTS = {
+    'admin': _TAB_VISIBILITY_ADMIN,
+    'super_admin': _TAB_VISIBILITY_ADMIN,
+    'manager': _TAB_VISIBILITY_MANAGER,
+}
+
+
+# Пути, для которых inject_user не загружает пользователя
+_NO_USER_CONTEXT_PREFIXES = ('/api/', '/static/', '/health', '/ready', '/metrics')
+
+
+def _fallback_tab_visibility(user_role):
+    """Видимость вкладок при ошибке загрузки настроек: основные вкладки открыты всем,
+    административные - только админам"""
+    return dict(_TAB_VISIBILITY_ADMIN if user_role in _ADMIN_ROLES else _TAB_VISIBILITY_MANAGER)
+
+
 @app.context_processor
 def inject_user():
     """
     Автоматически добавляет объект user и настройки видимости вкладок во все шаблоны
-    """
-    # Всегда возвращаем словарь, даже при ошибках
-    user = None
-    tab_visibility = {}
-    
-    # ВАЖНО: context_processor может вызываться вне контекста запроса
-    # Обертываем ВЕСЬ код в один большой try-except для максимальной безопасности
-    # Если произойдет ЛЮБАЯ ошибка, просто возвращаем пустые значения
-    try:
-        from flask import has_request_context
-        
-        # Проверяем контекст запроса - обертываем в try-except
-        try:
-            if not has_request_context():
-                return dict(user=user, tab_visibility=tab_visibility)
-        except Exception:
-            # Ошибка при проверке контекста - возвращаем пустые значения
-            return dict(user=user, tab_visibility=tab_visibility)
-
-        # Пытаемся получить доступ к session
-        # ВАЖНО: даже простое обращение к session может вызвать RuntimeError
-        # Обертываем ВСЕ обращения к session в try-except
-        try:
-            # Пытаемся получить user_id из session
-            # Если session недоступна, это вызовет RuntimeError
-            user_id = session.get('user_id')
-        except Exception:
-            # ЛЮБАЯ ошибка при доступе к session - это нормально вне HTTP-запроса
-            # Не логируем, так как это ожидаемое поведение
-            return dict(user=user, tab_visibility=tab_visibility)
-        
-        if user_id:
-            try:
-                user = get_user_by_id(user_id)
-                
-                # Загружаем индивидуальные настройки видимости вкладок для текущего пользователя
-                if user:
-                    user_role = user.get('role', '').strip()
-                    user_id = user.get('id')
-                    try:
-                        conn = get_db_connection()
-                        try:
-                            # Сначала пытаемся загрузить индивидуальные настройки пользователя
-                            user_setting = conn.execute(
-                                'SELECT tab_visibility FROM user_settings WHERE user_id = ?',
-                                (user_id,)
-                            ).fetchone()
-                            
-                            if user_setting and user_setting['tab_visibility']:
-                                import json
-                                tab_visibility = json.loads(user_setting['tab_visibility'])
-                            else:
-                                # Если индивидуальных настроек нет, используем значения по умолчанию на основе роли
-                                if user_role in ['admin', 'super_admin']:
-                                    tab_visibility = {
-                                        'dashboard': True, 'chats': True, 'buyout': True,
-                                        'deliveries': True, 'quick_replies': True,
-                                        'shops': True, 'analytics': True, 'settings': True
-                                    }
-                                elif user_role == 'manager':
-                                    tab_visibility = {
-                                        'dashboard': True, 'chats': True, 'buyout': True,
-                                        'deliveries': True, 'quick_replies': True,
-                                        'shops': False, 'analytics': False, 'settings': False
-                                    }
-                                else:
-                                    tab_visibility = {}
-                            
-                            # Соединение глобальное, не закрываем
-                        except Exception as e:
-                            app.logger.warning(f"[INJECT_USER] Ошибка загрузки настроек видимости вкладок: {e}")
-                            # Соединение глобальное, не закрываем
-                            # Используем значения по умолчанию при ошибке
-                            tab_visibility = {
-                                'dashboard': True, 'chats': True, 'buyout': True,
-                                'deliveries': True, 'quick_replies': True,
-                                'shops': user_role in ['admin', 'super_admin'],
-                                'analytics': user_role in ['admin', 'super_admin'],
-                                'settings': user_role in ['admin', 'super_admin']
-                            }
-                    except Exception as e:
-                        app.logger.warning(f"[INJECT_USER] Ошибка подключения к БД: {e}")
-                        # Используем значения по умолчанию при ошибке
-                        tab_visibility = {
-                            'dashboard': True, 'chats': True, 'buyout': True,
-                            'deliveries': True, 'quick_replies': True,
-                            'shops': user_role in ['admin', 'super_admin'],
-                            'analytics': user_role in ['admin', 'super_admin'],
-                            'settings': user_role in ['admin', 'super_admin']
-                        }
-            except Exception as e:
-                app.logger.warning(f"[INJECT_USER] Ошибка получения пользователя для шаблона: {e}")
-    except Exception as e:
-        # Критическая ошибка - логируем, но не падаем
-        app.logger.error(f"[INJECT_USER] КРИТИЧЕСКАЯ ОШИБКА в context_processor: {e}", exc_info=True)
     
-    return dict(user=user, tab_visibility=tab_visibility)
-
-# ==================== УТИЛИТЫ И ВАЛИДАЦИЯ ====================
-
-def validate_email(email):
+    Context processor может вызываться вне контекста запроса (например, при
+    рендере из фоновой задачи) - тогда возвращаются пустые значения.
+    Ошибки БД не прерывают рендер: логируются, шаблон получает значения по умолчанию.
     """
-    Валидация email адреса
-    
-    Проверяет корректность формата email с помощью регулярного выражения.
-    Поддерживает стандартный формат: user@domain.com
-    
-    Args:
-        email (str): Email адрес для проверки
+    # has_request_context() не бросает исключений, а внутри запроса
+    # обращение к session безопасно - отдельные try вокруг них не нужны
+    if not has_request_context():
+        return dict(user=None, tab_visibility={})
     
-    Returns:
-        bool: True если email валиден, False в противном случае
-    
-    Примеры:
-        validate_email("user@example.com") -> True
-        validate_email("invalid.email") -> False
-    """
-    # Регулярное выражение для проверки формата email
-    # ^ - начало строки
-    # [a-zA-Z0-9._%+-]+ - имя пользователя (один или более символов)
-    # @ - символ @
-    # [a-zA-Z0-9.-]+ - доменное имя
-    # \. - точка перед доменом верхнего уровня
-    # [a-zA-Z]{2,} - домен верхнего уровня (минимум 2 буквы)
-    # $ - конец строки
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
-
-def validate_phone(phone):
-    """
-    Валидация номера телефона
+    # API, статика и health-check не рендерят страниц с меню - пользователь им не нужен
+    if request.path.startswith(_NO_USER_CONTEXT_PREFIXES):
+        return dict(user=None, tab_visibility={})
     
-    Проверяет корректность формата международного номера телефона.
-    Удаляет пробелы и дефисы перед проверкой.
+    user_id = session.get('user_id')
+    if not user_id:
+        return dict(user=None, tab_visibility={})
     
-    Args:
-        phone (str): Номер телефона для проверки
+    try:
+        # Пользователь и его настройки видимости вкладок - одним запросом, с кэшем
+        user, user_tab_visibility = get_user_bundle(user_id)
+    except Exception as e:
+        app.logger.warning(f"[INJECT_USER] Ошибка получения пользователя для шаблона: {e}")
+        return dict(user=None, tab_visibility={})
     
-    Returns:
-        bool: True если номер валиден, False в противном случае
+    if not user:
+        return dict(user=None, tab_visibility={})
     
-    Примеры:
-        validate_phone("+79161234567") -> True
-        validate_phone("7916-123-45-67") -> True (после удаления дефисов)
-        validate_phone("123") -> False
-    """
-    # Удаляем пробелы и дефисы для унификации формата
-    cleaned_phone = phone.replace(' ', '').replace('-', '')
+    user_role = (user.get('role') or '').strip()
+    if user_tab_visibility:
+        try:
+            tab_visibility = json.loads(user_tab_visibility)
+        except ValueError as e:
+            app.logger.warning(f"[INJECT_USER] Ошибка загрузки настроек видимости вкладок: {e}")
+            # Используем значения по умолчанию при ошибке
+            tab_visibility = _fallback_tab_visibility(user_role)
+    else:
+        # Если индивидуальных настроек нет, используем значения по умолчанию на основе роли
+        tab_visibility = dict(_TAB_VISIBILITY_DEFAULTS.get(user_role, _TAB_VISIBILITY_OTHER))
     
-    # Регулярное выражение для международного формата:
-    # ^\+? - необязательный знак + в начале
-    # [1-9] - первая цифра не может быть 0
-    # \d{1,14} - от 1 до 14 цифр (стандарт E.164)
-    pattern = r'^\+?[1-9]\d{1,14}$'
-    return re.match(pattern, cleaned_phone) is not None
+    return dict(user=user, tab_visibility=tab_visibility)
+
+# ==================== УТИЛИТЫ И ВАЛИДАЦИЯ ====================
 
 def require_auth(f):
     """
@@ -340,42 +352,6 @@ def require_auth(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def require_role(role):
-    """
-    Декоратор для проверки роли пользователя
-    
-    Поддерживает иерархию ролей: super_admin > admin > manager
-    Супер-админ имеет доступ ко всем функциям админа и менеджера.
-    
-    Args:
-        role (str): Требуемая роль ('manager', 'admin', 'super_admin')
-    
-    Returns:
-        decorator: Декоратор для применения к функции
-    """
-    def decorator(f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            user_role = session.get('user_role')
-
-            # Иерархия ролей
-            role_hierarchy = {
-                'manager': 1,
-                'admin': 2,
-                'super_admin': 3
-            }
-
-            required_level = role_hierarchy.get(role, 999)
-            user_level = role_hierarchy.get(user_role, 0)
-
-            if user_level < required_level:
-                if request.is_json:
-                    return jsonify({'error': 'Access denied'}), 403
-                return redirect('/login')
-            return f(*args, **kwargs)
-        return decorated_function
-    return decorator
-
 def handle_errors(f):
     """
     Декоратор для обработки ошибок в функциях-обработчиках
@@ -413,24 +389,115 @@ def handle_errors(f):
             return render_template('error.html', error=str(error)), 500
     return decorated_function
 
-def check_name_columns(conn):
+# Журнал действий пишется пачками в фоновом потоке: запрос только кладет
+# строку в очередь, а поток-писатель вставляет до _ACTIVITY_BATCH_SIZE строк
+# одним executemany и одним commit (не реже раза в _ACTIVITY_FLUSH_INTERVAL секунд)
+_ACTIVITY_BATCH_SIZE = 100
+_ACTIVITY_FLUSH_INTERVAL = 1.0
+_SQL_INSERT_ACTIVITY = '''
+    INSERT INTO activity_logs (user_id, action_type, action_description, target_type, target_id, metadata, ip_address, user_agent)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+# Период PRAGMA optimize в потоке-писателе (при старте его выполняет init_database)
+_DB_OPTIMIZE_INTERVAL = int(os.environ.get('DB_OPTIMIZE_INTERVAL', '3600'))
+# Очередь ограничена: если писатель не успевает (БД заблокирована надолго),
+# записи сверх лимита отбрасываются, а не копятся в памяти и не блокируют запросы
+_ACTIVITY_QUEUE_MAXSIZE = int(os.environ.get('ACTIVITY_QUEUE_MAXSIZE', '10000'))
+_activity_queue = queue.Queue(maxsize=_ACTIVITY_QUEUE_MAXSIZE)
+_activity_thread = None
+_activity_thread_lock = threading.Lock()
+# Маркер остановки потока-писателя
+_ACTIVITY_STOP = object()
+
+
+def _write_activity_batch(conn, batch):
+    """Вставить пачку строк журнала действий одной транзакцией"""
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany(_SQL_INSERT_ACTIVITY, batch)
+        conn.commit()
+    except Exception as e:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        app.logger.error(f'Error logging activity ({len(batch)} rows): {str(e)}')
+
+
+def _optimize_database(conn):
+    """PRAGMA optimize: обновить статистику планировщика там, где она устарела"""
+    try:
+        conn.execute('PRAGMA optimize')
+    except Exception as e:
+        app.logger.warning(f'[DB] Не удалось выполнить PRAGMA optimize: {e}')
+
+
+def _activity_writer():
     """
-    Проверяет, существуют ли колонки first_name и last_name в таблице users.
+    Поток-писатель журнала действий с собственным соединением
     
-    Args:
-        conn: Соединение с базой данных
-        
-    Returns:
-        bool: True если обе колонки существуют, False в противном случае
+    Раз в _DB_OPTIMIZE_INTERVAL секунд он же выполняет PRAGMA optimize:
+    статистика sqlite_stat1 общая для всех соединений, поэтому достаточно
+    обновлять ее через одно соединение-писатель (читатели пула работают
+    в режиме query_only и выполнить ANALYZE не могут).
     """
+    conn = open_writer_connection()
     try:
-        cursor = conn.execute("PRAGMA table_info(users)")
-        columns_info = cursor.fetchall()
-        # PRAGMA table_info возвращает кортежи: (cid, name, type, notnull, dflt_value, pk)
-        user_columns = [row[1] if len(row) > 1 else str(row[0]) for row in columns_info]
-        return 'first_name' in user_columns and 'last_name' in user_columns
-    except Exception:
-        return False
+        next_optimize = time.monotonic() + _DB_OPTIMIZE_INTERVAL
+        stop = False
+        while not stop:
+            try:
+                item = _activity_queue.get(timeout=max(0.0, next_optimize - time.monotonic()))
+            except queue.Empty:
+                _optimize_database(conn)
+                next_optimize = time.monotonic() + _DB_OPTIMIZE_INTERVAL
+                continue
+            if item is _ACTIVITY_STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + _ACTIVITY_FLUSH_INTERVAL
+            while len(batch) < _ACTIVITY_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = _activity_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _ACTIVITY_STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            _write_activity_batch(conn, batch)
+    finally:
+        conn.close()
+
+
+def _ensure_activity_writer():
+    """Запустить поток-писатель журнала действий, если он еще не запущен"""
+    global _activity_thread
+    if _activity_thread is not None and _activity_thread.is_alive():
+        return
+    with _activity_thread_lock:
+        if _activity_thread is None or not _activity_thread.is_alive():
+            _activity_thread = threading.Thread(target=_activity_writer, daemon=True, name="ActivityLogWriter")
+            _activity_thread.start()
+
+
+def flush_activity_log(timeout=5.0):
+    """
+    Дописать накопленные записи журнала действий и остановить поток-писатель
+    
+    Вызывается при завершении процесса; следующий log_activity запустит поток заново.
+    """
+    thread = _activity_thread
+    if thread is None or not thread.is_alive():
+        return
+    _activity_queue.put(_ACTIVITY_STOP)
+    thread.join(timeout)
+
+
+atexit.register(flush_activity_log)
 
 
 def log_activity(user_id, action_type, action_description=None, target_type=None, target_id=None, metadata=None):
@@ -441,6 +508,10 @@ def log_activity(user_id, action_type, action_description=None, target_type=None
     и анализа активности. Используется для отслеживания изменений, входа/выхода,
     отправки сообщений и других операций.
     
+    Запись асинхронная: строка ставится в очередь и вставляется фоновым
+    потоком-писателем пачкой вместе с другими (обычно в течение секунды).
+    Транзакцию вызывающего кода функция не затрагивает.
+    
     Args:
         user_id (int): ID пользователя, выполнившего действие
         action_type (str): Тип действия (login, logout, send_message, update_delivery и т.д.)
@@ -454,35 +525,95 @@ def log_activity(user_id, action_type, action_description=None, target_type=None
         log_activity(user_id, 'send_message', 'Отправлено сообщение', 'chat', chat_id, {'message_length': 50})
         log_activity(user_id, 'update_delivery', 'Обновлена доставка', 'delivery', delivery_id)
     """
-    conn = get_db_connection()
     try:
-        # Вставляем запись о действии в таблицу логов
-        conn.execute('''
-            INSERT INTO activity_logs (user_id, action_type, action_description, target_type, target_id, metadata, ip_address, user_agent)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
+        # IP адрес и браузер берем из запроса здесь: в фоновом потоке контекста запроса нет.
+        # Читаем их один раз за запрос и запоминаем в g для следующих вызовов
+        if has_request_context():
+            client = g.get('_activity_client')
+            if client is None:
+                client = g._activity_client = (request.remote_addr, request.headers.get('User-Agent'))
+            ip_address, user_agent = client
+        else:
+            ip_address = user_agent = None
+        _activity_queue.put_nowait((
             user_id, 
             action_type, 
             action_description, 
             target_type, 
             target_id, 
             # Преобразуем словарь metadata в JSON строку для хранения в БД
-            json.dumps(metadata) if metadata else None,
-            # Получаем IP адрес клиента из запроса
-            request.remote_addr,
-            # Получаем информацию о браузере пользователя
-            request.headers.get('User-Agent')
+            _json_dumps(metadata) if metadata else None,
+            ip_address,
+            user_agent
         ))
-        conn.commit()
+        _ensure_activity_writer()
+    except queue.Full:
+        app.logger.warning(f'Activity log queue is full, dropping {action_type} for user {user_id}')
+        _ensure_activity_writer()
     except Exception as e:
         # Если не удалось записать лог, логируем ошибку, но не прерываем выполнение
         app.logger.error(f'Error logging activity: {str(e)}')
-    finally:
-        # Соединение глобальное, не закрываем
-        pass
+
+
+# Число потоков для параллельного опроса магазинов в get_system_stats
+_STATS_MAX_WORKERS = int(os.environ.get('STATS_MAX_WORKERS', '8'))
+
+# Кэш get_system_stats: дашборды перезагружаются часто, а сбор статистики
+# опрашивает Avito API по каждому магазину. При доступном Redis кэш общий
+# для всех воркеров, иначе хранится в памяти процесса
+_SYSTEM_STATS_TTL = int(os.environ.get('SYSTEM_STATS_TTL', '30'))
+_SYSTEM_STATS_KEY = 'system_stats'
+_system_stats_cache = None  # (момент истечения по time.monotonic(), статистика)
+_system_stats_lock = threading.Lock()
+
+
+def invalidate_system_stats():
+    """Сбросить кэш статистики системы (после добавления, изменения или удаления магазина)"""
+    global _system_stats_cache
+    if redis_conn is not None:
+        try:
+            redis_conn.delete(_SYSTEM_STATS_KEY)
+        except Exception as e:
+            app.logger.warning(f'[STATS] Не удалось сбросить кэш статистики в Redis: {e}')
+    with _system_stats_lock:
+        _system_stats_cache = None
 
 
 def get_system_stats():
+    """
+    Общая статистика системы с кэшированием на SYSTEM_STATS_TTL секунд
+    
+    Returns:
+        dict: Словарь со статистикой (см. _collect_system_stats)
+    """
+    global _system_stats_cache
+    if redis_conn is not None:
+        try:
+            cached = redis_conn.get(_SYSTEM_STATS_KEY)
+            if cached is not None:
+                return json.loads(cached)
+        except Exception as e:
+            app.logger.warning(f'[STATS] Redis недоступен для кэша статистики: {e}')
+    else:
+        with _system_stats_lock:
+            entry = _system_stats_cache
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+    
+    stats = _collect_system_stats()
+    
+    if redis_conn is not None:
+        try:
+            redis_conn.setex(_SYSTEM_STATS_KEY, _SYSTEM_STATS_TTL, _json_dumps(stats))
+        except Exception:
+            pass
+    else:
+        with _system_stats_lock:
+            _system_stats_cache = (time.monotonic() + _SYSTEM_STATS_TTL, stats)
+    return stats
+
+
+def _collect_system_stats():
     """
     Получение общей статистики системы с данными из Avito API
     
@@ -498,44 +629,54 @@ def get_system_stats():
     Returns:
         dict: Словарь со статистикой
     """
-    from avito_api import AvitoAPI
-    from datetime import datetime, timedelta, timezone
-    
-    conn = get_db_connection()
-
-    # Считаем общее количество чатов в системе
-    total_chats = conn.execute('SELECT COUNT(*) as count FROM avito_chats').fetchone()['count']
-
-    # Считаем активные чаты (не завершенные, требующие внимания)
-    active_chats = conn.execute('SELECT COUNT(*) as count FROM avito_chats WHERE status = "active"').fetchone()['count']
+    # Все чтения идут через соединение из пула читателей: запросы дашбордов
+    # не ждут друг друга и не конкурируют с писателем за глобальное соединение
+    with get_db_reader() as conn:
+        # Одним проходом по avito_chats считаем все счетчики чатов:
+        # общее количество, активные, срочные, с непрочитанными, в пуле
+        # (не назначенные менеджерам) и среднее время ответа
+        chats_row = conn.execute('''
+            SELECT COUNT(*) as total,
+                   COALESCE(SUM(status = 'active'), 0) as active,
+                   COALESCE(SUM(priority = 'urgent'), 0) as urgent,
+                   COALESCE(SUM(unread_count > 0), 0) as unread,
+                   COALESCE(SUM(assigned_manager_id IS NULL AND status != 'completed'), 0) as pool,
+                   AVG(response_timer) as avg_response_time
+            FROM avito_chats
+        ''').fetchone()
+        total_chats = chats_row['total']
+        active_chats = chats_row['active']
+        urgent_chats = chats_row['urgent']
+        unread_chats = chats_row['unread']
+        pool_chats = chats_row['pool']
+        # AVG пропускает NULL, поэтому отдельный фильтр response_timer IS NOT NULL не нужен
+        avg_response_time = chats_row['avg_response_time'] or 0
+
+        # Пользователи: все (админы + менеджеры) и только менеджеры
+        users_row = conn.execute('''
+            SELECT COUNT(*) as total,
+                   COALESCE(SUM(role = 'manager'), 0) as managers
+            FROM users
+        ''').fetchone()
+        total_users = users_row['total']
+        total_managers = users_row['managers']
 
-    # Считаем срочные чаты (требующие немедленного ответа)
-    urgent_chats = conn.execute('SELECT COUNT(*) as count FROM avito_chats WHERE priority = "urgent"').fetchone()['count']
-    
-    # Считаем чаты с непрочитанными сообщениями
-    unread_chats = conn.execute('SELECT COUNT(*) as count FROM avito_chats WHERE unread_count > 0').fetchone()['count']
-    
-    # Считаем чаты в пуле (не назначенные менеджерам)
-    pool_chats = conn.execute('SELECT COUNT(*) as count FROM avito_chats WHERE assigned_manager_id IS NULL AND status != "completed"').fetchone()['count']
-    
-    # Среднее время ответа
-    avg_response_time = conn.execute('SELECT AVG(response_timer) as avg FROM avito_chats WHERE response_timer IS NOT NULL').fetchone()['avg'] or 0
+        # Магазины Авито: все подключенные и с настроенными ключами
+        shops_row = conn.execute('''
+            SELECT COUNT(*) as total,
+                   COALESCE(SUM(client_id IS NOT NULL AND client_secret IS NOT NULL AND user_id IS NOT NULL), 0) as with_keys
+            FROM avito_shops
+        ''').fetchone()
+        total_shops = shops_row['total']
+        shops_with_keys = shops_row['with_keys']
 
-    # Считаем общее количество пользователей (админы + менеджеры)
-    total_users = conn.execute('SELECT COUNT(*) as count FROM users').fetchone()['count']
-    
-    # Считаем только менеджеров (исключая администраторов)
-    total_managers = conn.execute('SELECT COUNT(*) as count FROM users WHERE role = "manager"').fetchone()['count']
+        # Магазины с ключами для получения статистики из Avito API
+        shops = conn.execute('''
+            SELECT id, name, client_id, client_secret, user_id 
+            FROM avito_shops 
+            WHERE client_id IS NOT NULL AND client_secret IS NOT NULL AND user_id IS NOT NULL
+        ''').fetchall()
 
-    # Считаем количество магазинов Авито, подключенных к системе
-    total_shops = conn.execute('SELECT COUNT(*) as count FROM avito_shops').fetchone()['count']
-    
-    # Считаем магазины с настроенными ключами
-    shops_with_keys = conn.execute('''
-        SELECT COUNT(*) as count FROM avito_shops 
-        WHERE client_id IS NOT NULL AND client_secret IS NOT NULL AND user_id IS NOT NULL
-    ''').fetchone()['count']
-    
     # Статистика из Avito API
     avito_stats = {
         'total_chats_avito': 0,
@@ -546,13 +687,6 @@ def get_system_stats():
     }
     
     try:
-        # Получаем магазины с ключами для получения статистики из Avito API
-        shops = conn.execute('''
-            SELECT id, name, client_id, client_secret, user_id 
-            FROM avito_shops 
-            WHERE client_id IS NOT NULL AND client_secret IS NOT NULL AND user_id IS NOT NULL
-        ''').fetchall()
-        
         total_avito_chats = 0
         total_unread = 0
         synced_shops = 0
@@ -568,12 +702,36 @@ def get_system_stats():
         date_to = datetime.now().strftime('%Y-%m-%d')
         date_from = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
         
-        for shop in shops:
+        def fetch_shop_stats(shop):
+            """Запросы к Avito API по одному магазину: чаты и статистика аккаунта"""
+            api = get_avito_api(shop['client_id'], shop['client_secret'])
+            
+            # Получаем чаты из Avito API
+            response = api.get_chats(user_id=str(shop['user_id']), limit=100, offset=0)
+            
+            # Получаем статистику аккаунта из Avito API
             try:
-                api = AvitoAPI(shop['client_id'], shop['client_secret'], shop_id=str(shop['id']))
-                
-                # Получаем чаты из Avito API
-                response = api.get_chats(user_id=str(shop['user_id']), limit=100, offset=0)
+                account_stats = api.get_account_statistics(
+                    user_id=str(shop['user_id']),
+                    date_from=date_from,
+                    date_to=date_to
+                )
+            except Exception as stats_err:
+                app.logger.debug(f'Не удалось получить статистику аккаунта для магазина {shop["id"]}: {stats_err}')
+                account_stats = None
+            return response, account_stats
+        
+        # Магазины независимы, а запросы к API упираются в сеть, поэтому опрашиваем
+        # их параллельно: общее время ограничено самым медленным магазином, а не суммой
+        with ThreadPoolExecutor(max_workers=max(1, min(_STATS_MAX_WORKERS, len(shops)))) as executor:
+            futures = {executor.submit(fetch_shop_stats, shop): shop for shop in shops}
+            for future in as_completed(futures):
+                shop = futures[future]
+                try:
+                    response, account_stats = future.result()
+                except Exception as e:
+                    app.logger.warning(f'Ошибка получения статистики из Avito API для магазина {shop["id"]}: {e}')
+                    continue
                 
                 if isinstance(response, dict):
                     chats_data = response.get('chats', []) or response.get('data', {}).get('chats', [])
@@ -584,67 +742,49 @@ def get_system_stats():
                 
                 if chats_data:
                     total_avito_chats += len(chats_data)
-                    # Считаем непрочитанные сообщения и активные чаты
-                    for chat in chats_data:
-                        unread = chat.get('unread_count', 0) or chat.get('unreadCount', 0)
-                        total_unread += unread
-                        
-                        # Активный чат - не заблокирован и не архивирован
-                        if not chat.get('is_blocked', False) and not chat.get('is_archived', False):
-                            active_avito_chats += 1
-                        elif chat.get('is_blocked', False):
-                            blocked_avito_chats += 1
-                        elif chat.get('is_archived', False):
-                            archived_avito_chats += 1
+                    # Считаем непрочитанные сообщения и чаты по состоянию за один проход на счетчик:
+                    # активный - не заблокирован и не архивирован, заблокированный имеет приоритет над архивным
+                    total_unread += sum((chat.get('unread_count') or chat.get('unreadCount') or 0) for chat in chats_data)
+                    blocked = sum(1 for chat in chats_data if chat.get('is_blocked'))
+                    archived = sum(1 for chat in chats_data if chat.get('is_archived') and not chat.get('is_blocked'))
+                    blocked_avito_chats += blocked
+                    archived_avito_chats += archived
+                    active_avito_chats += len(chats_data) - blocked - archived
                     
                     synced_shops += 1
-                
-                # Получаем статистику аккаунта из Avito API
-                try:
-                    account_stats = api.get_account_statistics(
-                        user_id=str(shop['user_id']),
-                        date_from=date_from,
-                        date_to=date_to
-                    )
-                    
-                    # Обрабатываем статистику аккаунта
-                    if isinstance(account_stats, dict):
-                        # Статистика может быть в разных форматах
-                        stats_data = account_stats.get('result', account_stats.get('data', account_stats))
-                        
-                        if isinstance(stats_data, dict):
-                            # Суммируем просмотры, контакты, избранное
-                            views = stats_data.get('views', 0) or stats_data.get('total_views', 0)
-                            contacts = stats_data.get('contacts', 0) or stats_data.get('total_contacts', 0)
-                            favorites = stats_data.get('favorites', 0) or stats_data.get('total_favorites', 0)
-                            
-                            if isinstance(views, (int, float)):
-                                total_views += views
-                            if isinstance(contacts, (int, float)):
-                                total_contacts += contacts
-                            if isinstance(favorites, (int, float)):
-                                total_favorites += favorites
-                        
-                        # Если статистика в виде массива (по дням/неделям)
-                        elif isinstance(stats_data, list):
-                            for day_stat in stats_data:
-                                if isinstance(day_stat, dict):
-                                    views = day_stat.get('views', 0) or day_stat.get('total_views', 0)
-                                    contacts = day_stat.get('contacts', 0) or day_stat.get('total_contacts', 0)
-                                    favorites = day_stat.get('favorites', 0) or day_stat.get('total_favorites', 0)
-                                    
-                                    if isinstance(views, (int, float)):
-                                        total_views += views
-                                    if isinstance(contacts, (int, float)):
-                                        total_contacts += contacts
-                                    if isinstance(favorites, (int, float)):
-                                        total_favorites += favorites
-                except Exception as stats_err:
-                    app.logger.debug(f'Не удалось получить статистику аккаунта для магазина {shop["id"]}: {stats_err}')
-                    
-            except Exception as e:
-                app.logger.warning(f'Ошибка получения статистики из Avito API для магазина {shop["id"]}: {e}')
-                continue
+
+                # Обрабатываем статистику аккаунта
+                if isinstance(account_stats, dict):
+                    # Статистика может быть в разных форматах
+                    stats_data = account_stats.get('result', account_stats.get('data', account_stats))
+
+                    if isinstance(stats_data, dict):
+                        # Суммируем просмотры, контакты, избранное
+                        views = stats_data.get('views', 0) or stats_data.get('total_views', 0)
+                        contacts = stats_data.get('contacts', 0) or stats_data.get('total_contacts', 0)
+                        favorites = stats_data.get('favorites', 0) or stats_data.get('total_favorites', 0)
+
+                        if isinstance(views, (int, float)):
+                            total_views += views
+                        if isinstance(contacts, (int, float)):
+                            total_contacts += contacts
+                        if isinstance(favorites, (int, float)):
+                            total_favorites += favorites
+
+                    # Если статистика в виде массива (по дням/неделям)
+                    elif isinstance(stats_data, list):
+                        for day_stat in stats_data:
+                            if isinstance(day_stat, dict):
+                                views = day_stat.get('views', 0) or day_stat.get('total_views', 0)
+                                contacts = day_stat.get('contacts', 0) or day_stat.get('total_contacts', 0)
+                                favorites = day_stat.get('favorites', 0) or day_stat.get('total_favorites', 0)
+
+                                if isinstance(views, (int, float)):
+                                    total_views += views
+                                if isinstance(contacts, (int, float)):
+                                    total_contacts += contacts
+                                if isinstance(favorites, (int, float)):
+                                    total_favorites += favorites
         
         avito_stats = {
             'total_chats_avito': total_avito_chats,
@@ -664,8 +804,6 @@ def get_system_stats():
     except Exception as e:
         app.logger.warning(f'Ошибка получения статистики из Avito API: {e}')
 
-            # Соединение глобальное, не закрываем
-
     # Возвращаем словарь со всей статистикой
     return {
         'total_chats': total_chats,
@@ -725,13 +863,11 @@ def change_password():
 
         # Проверяем текущий пароль только если это не первый вход
         if not is_first_login:
-            from auth import authenticate_user
             auth_result = authenticate_user(user['email'], current_password)
             if not auth_result:
                 return render_template('change_password.html', error='Текущий пароль неверен', hide_header=True, is_first_login=is_first_login)
 
         # Обновляем пароль
-        from auth import update_user_password
         if update_user_password(session['user_id'], new_password):
             # Логируем изменение пароля
             log_activity(session['user_id'], 'change_password',
@@ -765,18 +901,19 @@ def login():
 
         user = authenticate_user(email, password)
         if user:
+            # Новый идентификатор серверной сессии после входа (защита от фиксации сессии)
+            if isinstance(app.session_interface, RedisSessionInterface):
+                app.session_interface.regenerate(session)
             session['user_id'] = user['id']
             session['user_role'] = user['role']
-            session['login_time'] = datetime.now().isoformat()
+            session['login_time'] = int(time.time())
             session.permanent = True  # Делаем сессию постоянной (живет 7 дней согласно PERMANENT_SESSION_LIFETIME)
             
             # Логируем создание сессии для диагностики
-            app.logger.info(f"[LOGIN] Сессия создана для пользователя {user['id']} ({user.get('username', 'unknown')})")
-            app.logger.info(f"[LOGIN] Session keys после логина: {list(session.keys())}")
-            app.logger.info(f"[LOGIN] Session permanent: {session.permanent}")
-            
-            # Принудительно помечаем сессию как измененную
-            session.modified = True
+            if app.logger.isEnabledFor(logging.DEBUG):
+                app.logger.debug("[LOGIN] Сессия создана для пользователя %s (%s)", user['id'], user.get('username', 'unknown'))
+                app.logger.debug("[LOGIN] Session keys после логина: %s", list(session.keys()))
+                app.logger.debug("[LOGIN] Session permanent: %s", session.permanent)
 
             # Проверяем, нужно ли менять пароль (первый вход или одноразовый пароль)
             temp_password_used = user.get('temp_password_used', False)
@@ -829,6 +966,83 @@ def webhooks_page():
     return render_template('webhooks.html', user=user)
 
 
+# Ключи магазина для управления webhook v3 меняются редко, поэтому
+# кэшируются на _WEBHOOK_SHOP_TTL секунд; сброс - invalidate_webhook_shop()
+_WEBHOOK_SHOP_TTL = 60
+_webhook_shop = None  # (момент истечения по time.monotonic(), (client_id, client_secret) или None)
+_webhook_shop_lock = threading.Lock()
+
+
+def _get_webhook_api():
+    """
+    Клиент Avito API первого магазина с ключами (для управления webhook v3)
+    
+    Returns:
+        AvitoAPI: Общий клиент из get_avito_api() или None, если магазинов с ключами нет
+    """
+    global _webhook_shop
+    with _webhook_shop_lock:
+        entry = _webhook_shop
+    if entry is not None and entry[0] > time.monotonic():
+        credentials = entry[1]
+    else:
+        with get_db_reader() as conn:
+            shop = conn.execute('''
+                SELECT client_id, client_secret
+                FROM avito_shops
+                WHERE client_id IS NOT NULL AND client_secret IS NOT NULL
+                LIMIT 1
+            ''').fetchone()
+        credentials = (shop['client_id'], shop['client_secret']) if shop else None
+        with _webhook_shop_lock:
+            _webhook_shop = (time.monotonic() + _WEBHOOK_SHOP_TTL, credentials)
+    return get_avito_api(*credentials) if credentials else None
+
+
+def invalidate_webhook_shop():
+    """Сбросить кэш ключей магазина для webhook (после изменения ключей или удаления магазина)"""
+    global _webhook_shop
+    with _webhook_shop_lock:
+        _webhook_shop = None
+
+
+# Типы событий webhook v3 (порядок - для текста ошибки)
+_WEBHOOK_TYPES = ('message', 'chat', 'user')
+_VALID_WEBHOOK_TYPES = frozenset(_WEBHOOK_TYPES)
+
+
+def _validate_webhook_payload(data):
+    """
+    Проверка тела запроса регистрации/обновления webhook v3
+    
+    Args:
+        data (dict): JSON тела запроса
+    
+    Returns:
+        tuple: (ответ с ошибкой или None, url, types)
+    """
+    if not data:
+        return (jsonify({'error': 'No data provided'}), 400), None, None
+    
+    url = data.get('url', '').strip()
+    types = data.get('types', ['message', 'chat'])
+    
+    if not url:
+        return (jsonify({'error': 'URL is required'}), 400), None, None
+    
+    if not url.startswith('https://'):
+        return (jsonify({'error': 'URL must start with https://'}), 400), None, None
+    
+    if not isinstance(types, list) or len(types) == 0:
+        return (jsonify({'error': 'Types must be a non-empty list'}), 400), None, None
+    
+    for t in types:
+        if not isinstance(t, str) or t not in _VALID_WEBHOOK_TYPES:
+            return (jsonify({'error': f'Invalid type: {t}. Valid types: {list(_WEBHOOK_TYPES)}'}), 400), None, None
+    
+    return None, url, types
+
+
 # API для получения информации о webhook
 @app.route('/api/admin/webhooks', methods=['GET'])
 @require_auth
@@ -837,27 +1051,16 @@ def webhooks_page():
 def get_webhook_info():
     """Получение информации о текущем webhook v3"""
     try:
-        # Получаем первый магазин для получения credentials
-        conn = get_db_connection()
-        shop = conn.execute('''
-            SELECT client_id, client_secret, user_id
-            FROM avito_shops
-            WHERE client_id IS NOT NULL AND client_secret IS NOT NULL
-            LIMIT 1
-        ''').fetchone()
+        # Клиент Avito API первого магазина с ключами (ключи кэшируются)
+        api = _get_webhook_api()
         
-        if not shop:
+        if api is None:
             return jsonify({
                 'webhook': None,
                 'error': 'No shops with API credentials found'
             }), 404
         
-        shop = dict(shop) if not isinstance(shop, dict) else shop
-        
         # Получаем информацию о webhook через Avito API
-        from avito_api import AvitoAPI
-        api = AvitoAPI(shop['client_id'], shop['client_secret'])
-        
         webhook = api.get_webhook_v3()
         
         return jsonify({
@@ -866,14 +1069,11 @@ def get_webhook_info():
         
     except Exception as e:
         app.logger.error(f"Ошибка получения информации о webhook: {e}")
-        import traceback
         traceback.print_exc()
         return jsonify({
             'webhook': None,
             'error': str(e)
         }), 500
-    finally:
-        pass  # Соединение глобальное, не закрываем
 
 
 # API для регистрации webhook
@@ -883,48 +1083,18 @@ def get_webhook_info():
 @handle_errors
 def register_webhook():
     """Регистрация нового webhook v3"""
-    data = request.get_json()
-    
-    if not data:
-        return jsonify({'error': 'No data provided'}), 400
-    
-    url = data.get('url', '').strip()
-    types = data.get('types', ['message', 'chat'])
-    
-    if not url:
-        return jsonify({'error': 'URL is required'}), 400
-    
-    if not url.startswith('https://'):
-        return jsonify({'error': 'URL must start with https://'}), 400
-    
-    if not isinstance(types, list) or len(types) == 0:
-        return jsonify({'error': 'Types must be a non-empty list'}), 400
-    
-    # Валидация типов
-    valid_types = ['message', 'chat', 'user']
-    for t in types:
-        if t not in valid_types:
-            return jsonify({'error': f'Invalid type: {t}. Valid types: {valid_types}'}), 400
+    error, url, types = _validate_webhook_payload(request.get_json())
+    if error:
+        return error
     
     try:
-        # Получаем первый магазин для получения credentials
-        conn = get_db_connection()
-        shop = conn.execute('''
-            SELECT client_id, client_secret, user_id
-            FROM avito_shops
-            WHERE client_id IS NOT NULL AND client_secret IS NOT NULL
-            LIMIT 1
-        ''').fetchone()
+        # Клиент Avito API первого магазина с ключами (ключи кэшируются)
+        api = _get_webhook_api()
         
-        if not shop:
+        if api is None:
             return jsonify({'error': 'No shops with API credentials found'}), 404
         
-        shop = dict(shop) if not isinstance(shop, dict) else shop
-        
         # Регистрируем webhook через Avito API
-        from avito_api import AvitoAPI
-        api = AvitoAPI(shop['client_id'], shop['client_secret'])
-        
         result = api.register_webhook_v3(url=url, types=types)
         
         # Логируем действие
@@ -938,11 +1108,8 @@ def register_webhook():
         
     except Exception as e:
         app.logger.error(f"Ошибка регистрации webhook: {e}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
-    finally:
-        pass  # Соединение глобальное, не закрываем
 
 
 # API для обновления webhook
@@ -952,48 +1119,18 @@ def register_webhook():
 @handle_errors
 def update_webhook():
     """Обновление webhook v3"""
-    data = request.get_json()
-    
-    if not data:
-        return jsonify({'error': 'No data provided'}), 400
-    
-    url = data.get('url', '').strip()
-    types = data.get('types', ['message', 'chat'])
-    
-    if not url:
-        return jsonify({'error': 'URL is required'}), 400
-    
-    if not url.startswith('https://'):
-        return jsonify({'error': 'URL must start with https://'}), 400
-    
-    if not isinstance(types, list) or len(types) == 0:
-        return jsonify({'error': 'Types must be a non-empty list'}), 400
-    
-    # Валидация типов
-    valid_types = ['message', 'chat', 'user']
-    for t in types:
-        if t not in valid_types:
-            return jsonify({'error': f'Invalid type: {t}. Valid types: {valid_types}'}), 400
+    error, url, types = _validate_webhook_payload(request.get_json())
+    if error:
+        return error
     
     try:
-        # Получаем первый магазин для получения credentials
-        conn = get_db_connection()
-        shop = conn.execute('''
-            SELECT client_id, client_secret, user_id
-            FROM avito_shops
-            WHERE client_id IS NOT NULL AND client_secret IS NOT NULL
-            LIMIT 1
-        ''').fetchone()
+        # Клиент Avito API первого магазина с ключами (ключи кэшируются)
+        api = _get_webhook_api()
         
-        if not shop:
+        if api is None:
             return jsonify({'error': 'No shops with API credentials found'}), 404
         
-        shop = dict(shop) if not isinstance(shop, dict) else shop
-        
         # Обновляем webhook через Avito API
-        from avito_api import AvitoAPI
-        api = AvitoAPI(shop['client_id'], shop['client_secret'])
-        
         result = api.update_webhook_v3(url=url, types=types)
         
         # Логируем действие
@@ -1007,11 +1144,8 @@ def update_webhook():
         
     except Exception as e:
         app.logger.error(f"Ошибка обновления webhook: {e}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
-    finally:
-        pass  # Соединение глобальное, не закрываем
 
 
 # API для удаления webhook
@@ -1022,24 +1156,13 @@ def update_webhook():
 def delete_webhook():
     """Удаление webhook v3"""
     try:
-        # Получаем первый магазин для получения credentials
-        conn = get_db_connection()
-        shop = conn.execute('''
-            SELECT client_id, client_secret, user_id
-            FROM avito_shops
-            WHERE client_id IS NOT NULL AND client_secret IS NOT NULL
-            LIMIT 1
-        ''').fetchone()
+        # Клиент Avito API первого магазина с ключами (ключи кэшируются)
+        api = _get_webhook_api()
         
-        if not shop:
+        if api is None:
             return jsonify({'error': 'No shops with API credentials found'}), 404
         
-        shop = dict(shop) if not isinstance(shop, dict) else shop
-        
         # Удаляем webhook через Avito API
-        from avito_api import AvitoAPI
-        api = AvitoAPI(shop['client_id'], shop['client_secret'])
-        
         success = api.delete_webhook_v3()
         
         if success:
@@ -1056,11 +1179,8 @@ def delete_webhook():
         
     except Exception as e:
         app.logger.error(f"Ошибка удаления webhook: {e}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
-    finally:
-        pass  # Соединение глобальное, не закрываем
 
 
 # Панель менеджера
@@ -1111,10 +1231,8 @@ def get_users():
         FROM users 
         ORDER BY created_at DESC
     ''').fetchall()
-            # Соединение глобальное, не закрываем
 
-    users_list = [dict(user) for user in users]
-    return jsonify(users_list)
+    return _json_response([dict(user) for user in users])
 
 
 # API для получения настроек видимости вкладок пользователя
@@ -1135,13 +1253,10 @@ def get_user_tab_visibility(user_id):
         
         tab_visibility = None
         if user_settings and user_settings['tab_visibility']:
-            import json
             tab_visibility = json.loads(user_settings['tab_visibility'])
         
-        # Соединение глобальное, не закрываем
         return jsonify({'tab_visibility': tab_visibility})
     except Exception as e:
-        # Соединение глобальное, не закрываем
         app.logger.error(f"[TAB VISIBILITY] Ошибка получения настроек: {e}")
         return jsonify({'error': str(e)}), 400
 
@@ -1162,22 +1277,16 @@ def save_user_tab_visibility(user_id):
     
     conn = get_db_connection()
     try:
-        import json
-        tab_visibility_json = json.dumps(data['tab_visibility'])
+        tab_visibility_json = _json_dumps(data['tab_visibility'])
         
-        # Проверяем, существует ли запись user_settings для этого пользователя
-        existing = conn.execute('SELECT id FROM user_settings WHERE user_id = ?', (user_id,)).fetchone()
-        
-        if existing:
-            conn.execute('''
-                UPDATE user_settings SET tab_visibility = ? WHERE user_id = ?
-            ''', (tab_visibility_json, user_id))
-        else:
-            conn.execute('''
-                INSERT INTO user_settings (user_id, tab_visibility) VALUES (?, ?)
-            ''', (user_id, tab_visibility_json))
+        # Создаем или обновляем запись user_settings одним запросом (user_id уникален)
+        conn.execute('''
+            INSERT INTO user_settings (user_id, tab_visibility) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET tab_visibility = excluded.tab_visibility
+        ''', (user_id, tab_visibility_json))
         
         conn.commit()
+        invalidate_user_cache(user_id)
         
         # Логируем действие
         user_info = conn.execute('SELECT username, role FROM users WHERE id = ?', (user_id,)).fetchone()
@@ -1185,10 +1294,8 @@ def save_user_tab_visibility(user_id):
             log_activity(session['user_id'], 'update_tab_visibility', 
                         f'Обновлена видимость вкладок для пользователя: {user_info["username"]} ({user_info["role"]})', 'user', user_id)
         
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True, 'message': 'Настройки видимости вкладок сохранены'})
     except Exception as e:
-        # Соединение глобальное, не закрываем
         app.logger.error(f"[TAB VISIBILITY] Ошибка сохранения настроек: {e}", exc_info=True)
         return jsonify({'error': str(e)}), 400
 
@@ -1230,8 +1337,6 @@ def get_shops():
             ORDER BY s.created_at DESC
         ''', (session['user_id'],)).fetchall()
 
-            # Соединение глобальное, не закрываем
-
     shops_list = []
     user_role = session.get('user_role')
     for shop in shops:
@@ -1242,13 +1347,39 @@ def get_shops():
             d.pop('client_secret', None)
             d.pop('user_id', None)
         shops_list.append(d)
-    return jsonify(shops_list)
+    return _json_response(shops_list)
+
+
+# Пустой словарь только для чтения - подстановка вместо отсутствующего profile
+_EMPTY = MappingProxyType({})
+
+
+def _extract_client(user_info):
+    """
+    Имя, телефон и ID клиента из элемента users чата Avito
+
+    Поля берутся с верхнего уровня, а при их отсутствии - из вложенного profile.
+
+    Returns:
+        tuple: (client_name, client_phone, customer_id)
+    """
+    profile = user_info.get('profile') or _EMPTY
+    return (
+        user_info.get('name') or profile.get('name', 'Неизвестно'),
+        user_info.get('phone') or profile.get('phone', ''),
+        user_info.get('id') or profile.get('id', ''),
+    )
+
+
+# Параллельные запросы страниц чатов одного магазина в sync_chats_from_avito
+# (ограничивает нагрузку на Avito API) и предельный offset пагинации
+_SYNC_PAGE_WORKERS = int(os.environ.get('SYNC_PAGE_WORKERS', '4'))
+_SYNC_MAX_OFFSET = 1000
 
 
 # API для получения чатов
 def sync_chats_from_avito(shop_id: Optional[int] = None) -> Dict[str, Any]:
     # Логируем путь к базе данных для диагностики
-    import os
     db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'osagaming_crm.db')
     app.logger.info(f"[SYNC] Используется база данных: {db_path}")
     app.logger.info(f"[SYNC] База данных существует: {os.path.exists(db_path)}")
@@ -1261,7 +1392,6 @@ def sync_chats_from_avito(shop_id: Optional[int] = None) -> Dict[str, Any]:
     Returns:
         Dict с результатами синхронизации
     """
-    from avito_api import AvitoAPI
     
     conn = get_db_connection()
     synced_count = 0
@@ -1295,549 +1425,559 @@ def sync_chats_from_avito(shop_id: Optional[int] = None) -> Dict[str, Any]:
             # Добавляем задержку между запросами к разным магазинам
             # чтобы избежать rate limiting от Avito API
             if idx > 0:
-                import time
                 delay = 2  # 2 секунды задержки между магазинами
                 app.logger.info(f"[SYNC] Задержка {delay} сек перед синхронизацией магазина {shop['id']}...")
                 time.sleep(delay)
             
             try:
-                api = AvitoAPI(shop['client_id'], shop['client_secret'], shop_id=str(shop['id']))
+                # Общий клиент процесса для ключей магазина (токен и keep-alive переиспользуются)
+                api = get_avito_api(shop['client_id'], shop['client_secret'])
                 
                 # Получаем чаты из Avito API
                 offset = 0
                 limit = 100
                 total_synced = 0
+                # Если Avito вернул total, следующие страницы запрашиваются заранее
+                # параллельно (см. _SYNC_PAGE_WORKERS); обрабатываются они по порядку
+                page_futures = {}
+                page_executor = None
                 
-                while True:
-                    try:
-                        response = api.get_chats(user_id=str(shop['user_id']), limit=limit, offset=offset)
+                try:
+                    while True:
+                        try:
+                            response = None
+                            page_future = page_futures.pop(offset, None)
+                            if page_future is not None:
+                                try:
+                                    response = page_future.result()
+                                except Exception as page_err:
+                                    # Например, 429 из-за параллельных запросов - повторяем страницу последовательно
+                                    app.logger.warning(f"[SYNC] Ошибка заранее запрошенной страницы offset={offset}: {page_err}, повторяем запрос")
+                            if response is None:
+                                response = api.get_chats(user_id=str(shop['user_id']), limit=limit, offset=offset)
                         
-                        # Логируем структуру ответа для отладки
-                        app.logger.info(f"[SYNC] Ответ от Avito API для магазина {shop['id']}: тип={type(response)}")
-                        if isinstance(response, dict):
-                            app.logger.info(f"[SYNC] Ключи в ответе: {list(response.keys())}")
+                            # Логируем структуру ответа для отладки
+                            app.logger.info(f"[SYNC] Ответ от Avito API для магазина {shop['id']}: тип={type(response)}")
+                            if isinstance(response, dict):
+                                app.logger.info(f"[SYNC] Ключи в ответе: {list(response.keys())}")
                         
-                        # Avito API возвращает данные в разных форматах
-                        # Проверяем разные варианты структуры ответа
-                        if isinstance(response, dict):
-                            # Пробуем разные варианты ключей
-                            chats_data = response.get('chats', [])
-                            if not chats_data:
-                                chats_data = response.get('items', [])
-                            if not chats_data and 'data' in response:
-                                data = response['data']
-                                if isinstance(data, dict):
-                                    chats_data = data.get('chats', []) or data.get('items', [])
-                                elif isinstance(data, list):
-                                    chats_data = data
-                        elif isinstance(response, list):
-                            chats_data = response
-                        else:
-                            chats_data = []
+                            # Avito API возвращает данные в разных форматах
+                            # Проверяем разные варианты структуры ответа
+                            if isinstance(response, dict):
+                                # Пробуем разные варианты ключей
+                                chats_data = response.get('chats', [])
+                                if not chats_data:
+                                    chats_data = response.get('items', [])
+                                if not chats_data and 'data' in response:
+                                    data = response['data']
+                                    if isinstance(data, dict):
+                                        chats_data = data.get('chats', []) or data.get('items', [])
+                                    elif isinstance(data, list):
+                                        chats_data = data
+                            elif isinstance(response, list):
+                                chats_data = response
+                            else:
+                                chats_data = []
                         
-                        chats_count = len(chats_data) if isinstance(chats_data, list) else 0
-                        app.logger.info(f"[SYNC] Извлечено чатов: {chats_count}")
+                            chats_count = len(chats_data) if isinstance(chats_data, list) else 0
+                            app.logger.info(f"[SYNC] Извлечено чатов: {chats_count}")
                         
-                        # Проверяем метаданные для пагинации
-                        if isinstance(response, dict) and 'meta' in response:
-                            meta = response['meta']
-                            total = meta.get('total', meta.get('count', 0))
-                            has_more = meta.get('has_more', False)
-                            app.logger.info(f"[SYNC] Метаданные: total={total}, has_more={has_more}, offset={offset}, limit={limit}")
-                            if total > 0:
-                                app.logger.info(f"[SYNC] Всего чатов в Avito: {total}, будет обработано страниц: {(total + limit - 1) // limit}")
-                            elif has_more:
-                                # Если has_more=True, но total=0, значит нужно продолжать пагинацию
-                                app.logger.info(f"[SYNC] has_more=True, продолжаем пагинацию (total может быть не указан)")
+                            # Проверяем метаданные для пагинации
+                            if isinstance(response, dict) and 'meta' in response:
+                                meta = response['meta']
+                                total = meta.get('total', meta.get('count', 0))
+                                has_more = meta.get('has_more', False)
+                                app.logger.info(f"[SYNC] Метаданные: total={total}, has_more={has_more}, offset={offset}, limit={limit}")
+                                if total > 0:
+                                    app.logger.info(f"[SYNC] Всего чатов в Avito: {total}, будет обработано страниц: {(total + limit - 1) // limit}")
+                                    if offset == 0 and total > limit and page_executor is None:
+                                        page_executor = ThreadPoolExecutor(max_workers=_SYNC_PAGE_WORKERS, thread_name_prefix='SyncPages')
+                                        for page_offset in range(limit, min(total, _SYNC_MAX_OFFSET + 1), limit):
+                                            page_futures[page_offset] = page_executor.submit(
+                                                api.get_chats, user_id=str(shop['user_id']), limit=limit, offset=page_offset
+                                            )
+                                elif has_more:
+                                    # Если has_more=True, но total=0, значит нужно продолжать пагинацию
+                                    app.logger.info(f"[SYNC] has_more=True, продолжаем пагинацию (total может быть не указан)")
                         
-                        if not chats_data or chats_count == 0:
-                            app.logger.info(f"[SYNC] Нет чатов для обработки, завершаем пагинацию")
-                            break
+                            if not chats_data or chats_count == 0:
+                                app.logger.info(f"[SYNC] Нет чатов для обработки, завершаем пагинацию")
+                                break
                         
-                        chats_processed = 0
-                        chats_created = 0
-                        chats_updated = 0
-                        chats_errors = 0
+                            chats_processed = 0
+                            chats_created = 0
+                            chats_updated = 0
+                            chats_errors = 0
                         
-                        app.logger.info(f"[SYNC] Начинаем обработку {chats_count} чатов...")
+                            app.logger.info(f"[SYNC] Начинаем обработку {chats_count} чатов...")
                         
-                        for idx, chat_data in enumerate(chats_data):
-                            try:
-                                # Извлекаем данные чата
-                                avito_chat_id = chat_data.get('id')
-                                if not avito_chat_id:
-                                    if idx < 3:  # Логируем только первые 3 для отладки
-                                        app.logger.warning(f"[SYNC] Чат {idx}: нет ID, пропускаем. Данные: {list(chat_data.keys())}")
-                                    continue
-                                
-                                # Преобразуем chat_id в строку для сравнения
-                                avito_chat_id_str = str(avito_chat_id)
-                                
-                                # Проверяем, существует ли чат
-                                # Проверяем и по shop_id+chat_id, и просто по chat_id (на случай если shop_id изменился)
-                                existing = conn.execute(
-                                    'SELECT id, shop_id, chat_id FROM avito_chats WHERE shop_id = ? AND chat_id = ?',
-                                    (shop['id'], avito_chat_id_str)
-                                ).fetchone()
-                                # Конвертируем Row в dict для безопасного доступа
-                                if existing:
-                                    existing = dict(existing)
+                            # Одним запросом загружаем уже известные чаты страницы
+                            # (chat_id уникален, поэтому ищем без учета shop_id)
+                            page_chat_ids = list({str(c.get('id')) for c in chats_data if isinstance(c, dict) and c.get('id')})
+                            existing_by_chat_id = {}
+                            if page_chat_ids:
+                                placeholders_in = ','.join('?' * len(page_chat_ids))
+                                existing_by_chat_id = {
+                                    row['chat_id']: dict(row)
+                                    for row in conn.execute(
+                                        f'SELECT id, shop_id, chat_id FROM avito_chats WHERE chat_id IN ({placeholders_in})',
+                                        page_chat_ids
+                                    )
+                                }
+                        
+                            for idx, chat_data in enumerate(chats_data):
+                                try:
+                                    # Извлекаем данные чата
+                                    avito_chat_id = chat_data.get('id')
+                                    if not avito_chat_id:
+                                        if idx < 3:  # Логируем только первые 3 для отладки
+                                            app.logger.warning(f"[SYNC] Чат {idx}: нет ID, пропускаем. Данные: {list(chat_data.keys())}")
+                                        continue
                                 
+                                    # Преобразуем chat_id в строку для сравнения
+                                    avito_chat_id_str = str(avito_chat_id)
                                 
-                                # Если не нашли по shop_id+chat_id, проверяем только по chat_id
-                                if not existing:
-                                    existing_by_chat_id = conn.execute(
-                                        'SELECT id, shop_id, chat_id FROM avito_chats WHERE chat_id = ?',
-                                        (avito_chat_id_str,)
-                                    ).fetchone()
-                                    if existing_by_chat_id:
-                                        existing_by_chat_id = dict(existing_by_chat_id)
-                                        app.logger.warning(f"[SYNC] Чат {avito_chat_id_str} найден с другим shop_id: БД={existing_by_chat_id.get('shop_id')}, текущий={shop['id']}")
+                                    # Проверяем, существует ли чат (по предзагруженным чатам страницы)
+                                    existing = existing_by_chat_id.get(avito_chat_id_str)
+                                    if existing and existing.get('shop_id') != shop['id']:
+                                        app.logger.warning(f"[SYNC] Чат {avito_chat_id_str} найден с другим shop_id: БД={existing.get('shop_id')}, текущий={shop['id']}")
                                         # Обновляем shop_id если он изменился
                                         conn.execute(
                                             'UPDATE avito_chats SET shop_id = ? WHERE id = ?',
-                                            (shop['id'], existing_by_chat_id.get('id'))
+                                            (shop['id'], existing.get('id'))
                                         )
-                                        existing = existing_by_chat_id
-                                    else:
-                                        app.logger.info(f"[SYNC] Чат {idx}: НЕ найден в БД - будет создан новый чат")
+                                        existing['shop_id'] = shop['id']
+                                    elif not existing:
+                                        app.logger.debug("[SYNC] Чат %s: НЕ найден в БД - будет создан новый чат", idx)
                                 
-                                # Получаем информацию о пользователе
-                                # Avito API может возвращать users как массив или объект
-                                users_data = chat_data.get('users', [])
-                                if isinstance(users_data, list) and len(users_data) > 0:
-                                    user_info = users_data[0] if isinstance(users_data[0], dict) else {}
-                                elif isinstance(users_data, dict):
-                                    user_info = users_data
-                                else:
-                                    user_info = {}
+                                    # Получаем информацию о пользователе
+                                    # Avito API может возвращать users как массив или объект
+                                    users_data = chat_data.get('users', [])
+                                    if isinstance(users_data, list) and len(users_data) > 0:
+                                        user_info = users_data[0] if isinstance(users_data[0], dict) else {}
+                                    elif isinstance(users_data, dict):
+                                        user_info = users_data
+                                    else:
+                                        user_info = {}
                                 
-                                client_name = user_info.get('name') or user_info.get('profile', {}).get('name', 'Неизвестно')
-                                client_phone = user_info.get('phone') or user_info.get('profile', {}).get('phone', '')
-                                customer_id = user_info.get('id') or user_info.get('profile', {}).get('id', '')
+                                    client_name, client_phone, customer_id = _extract_client(user_info)
                                 
-                                # Получаем последнее сообщение
-                                last_message_data = chat_data.get('last_message', {})
-                                if isinstance(last_message_data, dict):
-                                    # Проверяем разные форматы структуры сообщения
-                                    if 'content' in last_message_data:
-                                        content = last_message_data['content']
-                                        if isinstance(content, dict):
-                                            last_message = content.get('text', '') or content.get('message', '')
+                                    # Получаем последнее сообщение
+                                    last_message_data = chat_data.get('last_message', {})
+                                    if isinstance(last_message_data, dict):
+                                        # Проверяем разные форматы структуры сообщения
+                                        if 'content' in last_message_data:
+                                            content = last_message_data['content']
+                                            if isinstance(content, dict):
+                                                last_message = content.get('text', '') or content.get('message', '')
+                                            else:
+                                                last_message = str(content)
+                                        elif 'text' in last_message_data:
+                                            last_message = last_message_data['text']
+                                        elif 'message' in last_message_data:
+                                            last_message = last_message_data['message']
                                         else:
-                                            last_message = str(content)
-                                    elif 'text' in last_message_data:
-                                        last_message = last_message_data['text']
-                                    elif 'message' in last_message_data:
-                                        last_message = last_message_data['message']
+                                            last_message = str(last_message_data)
                                     else:
-                                        last_message = str(last_message_data)
-                                else:
-                                    last_message = ''
+                                        last_message = ''
                                 
-                                # Получаем информацию об объявлении
-                                # ВАЖНО: Avito API возвращает context.value, а не context.item!
-                                # Структура: {"context": {"type": "item", "value": {"id": 123, "url": "..."}}}
-                                product_url = None
+                                    # Получаем информацию об объявлении
+                                    # ВАЖНО: Avito API возвращает context.value, а не context.item!
+                                    # Структура: {"context": {"type": "item", "value": {"id": 123, "url": "..."}}}
+                                    product_url = None
                                 
-                                # ВАЖНО: Avito API v3 возвращает context.value, а не context.item!
-                                # Структура: {"context": {"type": "item", "value": {"id": 123, "url": "..."}}}
-                                context = chat_data.get('context', {})
-                                if isinstance(context, dict):
-                                    # Приоритет: context.value (API v3), затем context.item (старая версия)
-                                    item_data = (context.get('value') or 
-                                               context.get('item') or 
-                                               context.get('listing') or 
-                                               context.get('ad', {}))
-                                else:
-                                    # Fallback на прямые поля в chat_data
-                                    item_data = chat_data.get('item', chat_data.get('listing', chat_data.get('ad', {})))
+                                    # ВАЖНО: Avito API v3 возвращает context.value, а не context.item!
+                                    # Структура: {"context": {"type": "item", "value": {"id": 123, "url": "..."}}}
+                                    context = chat_data.get('context', {})
+                                    if isinstance(context, dict):
+                                        # Приоритет: context.value (API v3), затем context.item (старая версия)
+                                        item_data = (context.get('value') or 
+                                                   context.get('item') or 
+                                                   context.get('listing') or 
+                                                   context.get('ad', {}))
+                                    else:
+                                        # Fallback на прямые поля в chat_data
+                                        item_data = chat_data.get('item', chat_data.get('listing', chat_data.get('ad', {})))
                                 
-                                # Логируем структуру для первых чатов и чатов без product_url
-                                should_log = idx < 3
-                                if not should_log and not product_url:
-                                    # Логируем чаты без product_url для диагностики
-                                    should_log = True
+                                    # Логируем структуру для первых чатов и чатов без product_url
+                                    should_log = idx < 3
+                                    if not should_log and not product_url:
+                                        # Логируем чаты без product_url для диагностики
+                                        should_log = True
                                 
-                                if should_log:
-                                    app.logger.info(f"[SYNC] Чат {idx} (chat_id={avito_chat_id_str}): проверяем наличие context/item/listing/ad в chat_data, ключи: {list(chat_data.keys())}")
-                                    if 'context' in chat_data:
-                                        app.logger.info(f"[SYNC] Чат {idx}: context тип={type(chat_data.get('context'))}, ключи: {list(chat_data.get('context', {}).keys()) if isinstance(chat_data.get('context'), dict) else 'не dict'}")
-                                        if isinstance(chat_data.get('context'), dict):
-                                            app.logger.info(f"[SYNC] Чат {idx}: context содержимое: {str(chat_data.get('context'))[:500]}")
-                                    if item_data:
-                                        app.logger.info(f"[SYNC] Чат {idx}: item_data тип={type(item_data)}, значение={str(item_data)[:500]}")
-                                    else:
-                                        app.logger.warning(f"[SYNC] Чат {idx}: item_data отсутствует! Все ключи chat_data: {list(chat_data.keys())}")
+                                    if should_log:
+                                        if app.logger.isEnabledFor(logging.DEBUG):
+                                            app.logger.debug("[SYNC] Чат %s (chat_id=%s): проверяем наличие context/item/listing/ad в chat_data, ключи: %s", idx, avito_chat_id_str, list(chat_data.keys()))
+                                            if 'context' in chat_data:
+                                                app.logger.debug("[SYNC] Чат %s: context тип=%s, ключи: %s", idx, type(chat_data.get('context')), list(chat_data.get('context', {}).keys()) if isinstance(chat_data.get('context'), dict) else 'не dict')
+                                                if isinstance(chat_data.get('context'), dict):
+                                                    app.logger.debug("[SYNC] Чат %s: context содержимое: %.500s", idx, chat_data.get('context'))
+                                            if item_data:
+                                                app.logger.debug("[SYNC] Чат %s: item_data тип=%s, значение=%.500s", idx, type(item_data), item_data)
+                                        if not item_data:
+                                            app.logger.warning(f"[SYNC] Чат {idx}: item_data отсутствует! Все ключи chat_data: {list(chat_data.keys())}")
                                 
-                                # Сохраняем данные объявления из context.value в listing_data
-                                listing_data_json = None
-                                if isinstance(item_data, dict) and item_data:
-                                    # Сохраняем все данные из item_data в listing_data
-                                    import json
-                                    listing_data_json = json.dumps(item_data, ensure_ascii=False)
-                                    app.logger.info(f"[SYNC] Чат {idx}: Сохраняем listing_data из context.value (ключи: {list(item_data.keys())[:10]})")
+                                    # Сохраняем данные объявления из context.value в listing_data
+                                    listing_data_json = None
+                                    if isinstance(item_data, dict) and item_data:
+                                        # Сохраняем все данные из item_data в listing_data
+                                        listing_data_json = json.dumps(item_data, ensure_ascii=False)
+                                        app.logger.debug("[SYNC] Чат %s: Сохраняем listing_data из context.value (ключи: %s)", idx, list(item_data)[:10])
                                     
-                                    # Пробуем разные варианты ключей для URL
-                                    # Согласно документации, item может содержать: id, url, или другие поля
-                                    item_id = item_data.get('id')
-                                    product_url = (item_data.get('url') or 
-                                                 item_data.get('link') or 
-                                                 item_data.get('href') or
-                                                 item_data.get('value') or
-                                                 item_data.get('uri'))
+                                        # Пробуем разные варианты ключей для URL
+                                        # Согласно документации, item может содержать: id, url, или другие поля
+                                        item_id = item_data.get('id')
+                                        product_url = (item_data.get('url') or 
+                                                     item_data.get('link') or 
+                                                     item_data.get('href') or
+                                                     item_data.get('value') or
+                                                     item_data.get('uri'))
                                     
-                                    # Если URL не найден, но есть ID, формируем URL из ID
-                                    if not product_url and item_id:
-                                        item_id_str = str(item_id)
-                                        # Формируем URL на основе ID объявления
-                                        shop_url_part = shop.get('shop_url', '').split('/')[-1] if shop.get('shop_url') else ''
-                                        if shop_url_part:
-                                            product_url = f"https://www.avito.ru/{shop_url_part}/items/{item_id_str}"
-                                        else:
-                                            product_url = f"https://www.avito.ru/items/{item_id_str}"
+                                        # Если URL не найден, но есть ID, формируем URL из ID
+                                        if not product_url and item_id:
+                                            item_id_str = str(item_id)
+                                            # Формируем URL на основе ID объявления
+                                            shop_url_part = shop.get('shop_url', '').split('/')[-1] if shop.get('shop_url') else ''
+                                            if shop_url_part:
+                                                product_url = f"https://www.avito.ru/{shop_url_part}/items/{item_id_str}"
+                                            else:
+                                                product_url = f"https://www.avito.ru/items/{item_id_str}"
                                     
-                                    # Если URL относительный, делаем его абсолютным
-                                    if product_url and isinstance(product_url, str):
-                                        if product_url.startswith('/'):
-                                            product_url = f"https://www.avito.ru{product_url}"
-                                        elif not product_url.startswith('http'):
+                                        # Если URL относительный, делаем его абсолютным
+                                        if product_url and isinstance(product_url, str):
+                                            if product_url.startswith('/'):
+                                                product_url = f"https://www.avito.ru{product_url}"
+                                            elif not product_url.startswith('http'):
+                                                # Если это ID объявления, формируем URL
+                                                shop_url_part = shop.get('shop_url', '').split('/')[-1] if shop.get('shop_url') else ''
+                                                if shop_url_part:
+                                                    product_url = f"https://www.avito.ru/{shop_url_part}/items/{product_url}"
+                                                else:
+                                                    product_url = f"https://www.avito.ru/items/{product_url}"
+                                    elif isinstance(item_data, str):
+                                        # Если item_data - это просто строка (ID или URL)
+                                        if item_data.startswith('http'):
+                                            product_url = item_data
+                                        elif item_data.isdigit():
                                             # Если это ID объявления, формируем URL
                                             shop_url_part = shop.get('shop_url', '').split('/')[-1] if shop.get('shop_url') else ''
                                             if shop_url_part:
-                                                product_url = f"https://www.avito.ru/{shop_url_part}/items/{product_url}"
+                                                product_url = f"https://www.avito.ru/{shop_url_part}/items/{item_data}"
                                             else:
-                                                product_url = f"https://www.avito.ru/items/{product_url}"
-                                elif isinstance(item_data, str):
-                                    # Если item_data - это просто строка (ID или URL)
-                                    if item_data.startswith('http'):
-                                        product_url = item_data
-                                    elif item_data.isdigit():
-                                        # Если это ID объявления, формируем URL
-                                        shop_url_part = shop.get('shop_url', '').split('/')[-1] if shop.get('shop_url') else ''
-                                        if shop_url_part:
-                                            product_url = f"https://www.avito.ru/{shop_url_part}/items/{item_data}"
-                                        else:
-                                            product_url = f"https://www.avito.ru/items/{item_data}"
+                                                product_url = f"https://www.avito.ru/items/{item_data}"
                                 
-                                # Также проверяем прямые поля в chat_data (для обратной совместимости)
-                                if not product_url:
-                                    product_url = (chat_data.get('item_url') or 
-                                                 chat_data.get('listing_url') or 
-                                                 chat_data.get('ad_url') or
-                                                 chat_data.get('product_url'))
+                                    # Также проверяем прямые поля в chat_data (для обратной совместимости)
+                                    if not product_url:
+                                        product_url = first_present(chat_data, DIRECT_PRODUCT_URL_KEYS)
                                 
-                                # Если product_url все еще не найден, пытаемся получить через get_chat_by_id
-                                if not product_url and shop.get('client_id') and shop.get('client_secret') and shop.get('user_id'):
-                                    try:
-                                        from avito_api import AvitoAPI
-                                        api = AvitoAPI(
-                                            client_id=shop['client_id'],
-                                            client_secret=shop['client_secret']
-                                        )
-                                        # Получаем детальную информацию о чате
-                                        chat_details = api.get_chat_by_id(
-                                            user_id=shop['user_id'],
-                                            chat_id=avito_chat_id_str
-                                        )
-                                        if isinstance(chat_details, dict):
-                                            # ВАЖНО: Avito API v3 возвращает context.value, а не context.item!
-                                            # Структура: {"context": {"type": "item", "value": {"id": 123, "url": "..."}}}
-                                            detail_context = chat_details.get('context', {})
-                                            if isinstance(detail_context, dict):
-                                                # Приоритет: context.value (API v3), затем context.item (старая версия)
-                                                detail_item = (detail_context.get('value') or 
-                                                              detail_context.get('item') or 
-                                                              detail_context.get('listing') or 
-                                                              detail_context.get('ad', {}))
-                                                if isinstance(detail_item, dict) and detail_item:
-                                                    # Сохраняем данные из detail_item в listing_data
-                                                    if not listing_data_json:
-                                                        import json
-                                                        listing_data_json = json.dumps(detail_item, ensure_ascii=False)
-                                                        app.logger.info(f"[SYNC] Чат {idx}: Сохраняем listing_data из get_chat_by_id context.value (ключи: {list(detail_item.keys())[:10]})")
+                                    # Если product_url все еще не найден, пытаемся получить через get_chat_by_id
+                                    if not product_url and shop.get('client_id') and shop.get('client_secret') and shop.get('user_id'):
+                                        try:
+                                            # Получаем детальную информацию о чате (клиент магазина создан выше)
+                                            chat_details = api.get_chat_by_id(
+                                                user_id=shop['user_id'],
+                                                chat_id=avito_chat_id_str
+                                            )
+                                            if isinstance(chat_details, dict):
+                                                # ВАЖНО: Avito API v3 возвращает context.value, а не context.item!
+                                                # Структура: {"context": {"type": "item", "value": {"id": 123, "url": "..."}}}
+                                                detail_context = chat_details.get('context', {})
+                                                if isinstance(detail_context, dict):
+                                                    # Приоритет: context.value (API v3), затем context.item (старая версия)
+                                                    detail_item = (detail_context.get('value') or 
+                                                                  detail_context.get('item') or 
+                                                                  detail_context.get('listing') or 
+                                                                  detail_context.get('ad', {}))
+                                                    if isinstance(detail_item, dict) and detail_item:
+                                                        # Сохраняем данные из detail_item в listing_data
+                                                        if not listing_data_json:
+                                                            listing_data_json = json.dumps(detail_item, ensure_ascii=False)
+                                                            app.logger.debug("[SYNC] Чат %s: Сохраняем listing_data из get_chat_by_id context.value (ключи: %s)", idx, list(detail_item)[:10])
                                                     
-                                                    detail_item_id = detail_item.get('id')
-                                                    detail_url = (detail_item.get('url') or 
-                                                                 detail_item.get('link') or 
-                                                                 detail_item.get('href') or
-                                                                 detail_item.get('value') or
-                                                                 detail_item.get('uri'))
-                                                    if detail_url:
-                                                        product_url = detail_url
-                                                        if product_url.startswith('/'):
-                                                            product_url = f"https://www.avito.ru{product_url}"
-                                                        elif not product_url.startswith('http'):
-                                                            product_url = f"https://www.avito.ru{product_url}"
-                                                        app.logger.info(f"[SYNC] ✅ Чат {idx}: product_url найден через get_chat_by_id context.value (url): {product_url}")
-                                                    elif detail_item_id:
-                                                        item_id_str = str(detail_item_id)
-                                                        shop_url_part = shop.get('shop_url', '').split('/')[-1] if shop.get('shop_url') else ''
-                                                        if shop_url_part:
-                                                            product_url = f"https://www.avito.ru/{shop_url_part}/items/{item_id_str}"
-                                                        else:
-                                                            product_url = f"https://www.avito.ru/items/{item_id_str}"
-                                                        app.logger.info(f"[SYNC] ✅ Чат {idx}: product_url найден через get_chat_by_id context.value (id): {product_url}")
+                                                        detail_item_id = detail_item.get('id')
+                                                        detail_url = (detail_item.get('url') or 
+                                                                     detail_item.get('link') or 
+                                                                     detail_item.get('href') or
+                                                                     detail_item.get('value') or
+                                                                     detail_item.get('uri'))
+                                                        if detail_url:
+                                                            product_url = detail_url
+                                                            if product_url.startswith('/'):
+                                                                product_url = f"https://www.avito.ru{product_url}"
+                                                            elif not product_url.startswith('http'):
+                                                                product_url = f"https://www.avito.ru{product_url}"
+                                                            app.logger.debug("[SYNC] ✅ Чат %s: product_url найден через get_chat_by_id context.value (url): %s", idx, product_url)
+                                                        elif detail_item_id:
+                                                            item_id_str = str(detail_item_id)
+                                                            shop_url_part = shop.get('shop_url', '').split('/')[-1] if shop.get('shop_url') else ''
+                                                            if shop_url_part:
+                                                                product_url = f"https://www.avito.ru/{shop_url_part}/items/{item_id_str}"
+                                                            else:
+                                                                product_url = f"https://www.avito.ru/items/{item_id_str}"
+                                                            app.logger.debug("[SYNC] ✅ Чат %s: product_url найден через get_chat_by_id context.value (id): %s", idx, product_url)
                                             
-                                            # Если не нашли в context, проверяем прямые поля
-                                            if not product_url:
-                                                product_url = (chat_details.get('item_url') or 
-                                                             chat_details.get('listing_url') or 
-                                                             chat_details.get('ad_url') or
-                                                             chat_details.get('product_url'))
-                                                if product_url:
-                                                    app.logger.info(f"[SYNC] ✅ Чат {idx}: product_url найден через get_chat_by_id (прямые поля): {product_url}")
+                                                # Если не нашли в context, проверяем прямые поля
+                                                if not product_url:
+                                                    product_url = first_present(chat_details, DIRECT_PRODUCT_URL_KEYS)
+                                                    if product_url:
+                                                        app.logger.debug("[SYNC] ✅ Чат %s: product_url найден через get_chat_by_id (прямые поля): %s", idx, product_url)
                                             
-                                            if not product_url:
-                                                app.logger.warning(f"[SYNC] ⚠️ Чат {idx}: product_url не найден даже через get_chat_by_id. Ключи chat_details: {list(chat_details.keys())}")
-                                                if 'context' in chat_details:
-                                                    app.logger.warning(f"[SYNC] ⚠️ Чат {idx}: context = {str(chat_details.get('context'))[:500]}")
-                                    except Exception as api_error:
-                                        app.logger.warning(f"[SYNC] Чат {idx}: ошибка при попытке получить product_url через get_chat_by_id: {api_error}")
+                                                if not product_url:
+                                                    app.logger.warning(f"[SYNC] ⚠️ Чат {idx}: product_url не найден даже через get_chat_by_id. Ключи chat_details: {list(chat_details.keys())}")
+                                                    if 'context' in chat_details:
+                                                        app.logger.warning(f"[SYNC] ⚠️ Чат {idx}: context = {str(chat_details.get('context'))[:500]}")
+                                        except Exception as api_error:
+                                            app.logger.warning(f"[SYNC] Чат {idx}: ошибка при попытке получить product_url через get_chat_by_id: {api_error}")
                                 
-                                if product_url:
-                                    app.logger.info(f"[SYNC] Чат {idx} (chat_id={avito_chat_id_str}): найден product_url={product_url}")
-                                else:
-                                    app.logger.warning(f"[SYNC] Чат {idx} (chat_id={avito_chat_id_str}): product_url НЕ найден. Возможно, чат не связан с объявлением или объявление было удалено.")
-                                    # Логируем структуру chat_data для диагностики
-                                    if idx < 5:  # Логируем первые 5 чатов без product_url
-                                        app.logger.warning(f"[SYNC] Чат {idx}: структура chat_data - ключи: {list(chat_data.keys())}")
-                                        if 'context' in chat_data:
-                                            app.logger.warning(f"[SYNC] Чат {idx}: context = {str(chat_data.get('context'))[:300]}")
+                                    if product_url:
+                                        app.logger.debug("[SYNC] Чат %s (chat_id=%s): найден product_url=%s", idx, avito_chat_id_str, product_url)
+                                    else:
+                                        app.logger.warning(f"[SYNC] Чат {idx} (chat_id={avito_chat_id_str}): product_url НЕ найден. Возможно, чат не связан с объявлением или объявление было удалено.")
+                                        # Логируем структуру chat_data для диагностики
+                                        if idx < 5:  # Логируем первые 5 чатов без product_url
+                                            app.logger.warning(f"[SYNC] Чат {idx}: структура chat_data - ключи: {list(chat_data.keys())}")
+                                            if 'context' in chat_data:
+                                                app.logger.warning(f"[SYNC] Чат {idx}: context = {str(chat_data.get('context'))[:300]}")
                                 
-                                # Получаем метаданные
-                                unread_count = chat_data.get('unread_count', 0) or chat_data.get('unreadCount', 0)
-                                is_blocked = chat_data.get('is_blocked', False) or chat_data.get('isBlocked', False)
-                                is_archived = chat_data.get('is_archived', False) or chat_data.get('isArchived', False)
+                                    # Получаем метаданные
+                                    unread_count = chat_data.get('unread_count', 0) or chat_data.get('unreadCount', 0)
+                                    is_blocked = chat_data.get('is_blocked', False) or chat_data.get('isBlocked', False)
+                                    is_archived = chat_data.get('is_archived', False) or chat_data.get('isArchived', False)
                                 
-                                # Определяем статус
-                                status = 'archived' if is_archived else 'active'
-                                if is_blocked:
-                                    status = 'blocked'
+                                    # Определяем статус
+                                    status = 'archived' if is_archived else 'active'
+                                    if is_blocked:
+                                        status = 'blocked'
                                 
-                                # Определяем приоритет на основе времени последнего сообщения
-                                priority = 'normal'
-                                if last_message_data and isinstance(last_message_data, dict):
-                                    last_message_time = last_message_data.get('created') or last_message_data.get('created_at')
-                                    if last_message_time:
-                                        try:
-                                            if isinstance(last_message_time, (int, float)):
-                                                msg_time = datetime.fromtimestamp(last_message_time)
-                                            else:
-                                                msg_time = datetime.fromisoformat(str(last_message_time).replace('Z', '+00:00'))
-                                            time_diff = datetime.now() - msg_time
-                                            if time_diff.total_seconds() < 3600:  # Меньше часа
-                                                priority = 'urgent'
-                                            elif time_diff.total_seconds() < 86400:  # Меньше суток
-                                                priority = 'new'
-                                        except Exception as time_err:
-                                            app.logger.warning(f"[SYNC] Ошибка парсинга времени сообщения: {time_err}")
-                                            pass
+                                    # Определяем приоритет на основе времени последнего сообщения
+                                    priority = 'normal'
+                                    if last_message_data and isinstance(last_message_data, dict):
+                                        last_message_time = last_message_data.get('created') or last_message_data.get('created_at')
+                                        if last_message_time:
+                                            try:
+                                                if isinstance(last_message_time, (int, float)):
+                                                    msg_time = datetime.fromtimestamp(last_message_time)
+                                                else:
+                                                    msg_time = datetime.fromisoformat(str(last_message_time).replace('Z', '+00:00'))
+                                                time_diff = datetime.now() - msg_time
+                                                if time_diff.total_seconds() < 3600:  # Меньше часа
+                                                    priority = 'urgent'
+                                                elif time_diff.total_seconds() < 86400:  # Меньше суток
+                                                    priority = 'new'
+                                            except Exception as time_err:
+                                                app.logger.warning(f"[SYNC] Ошибка парсинга времени сообщения: {time_err}")
+                                                pass
                                 
-                                if existing:
-                                    # Конвертируем existing в dict если это Row
-                                    if not isinstance(existing, dict):
-                                        existing = dict(existing)
+                                    if existing:
+                                        # Конвертируем existing в dict если это Row
+                                        if not isinstance(existing, dict):
+                                            existing = dict(existing)
                                     
-                                    # Обновляем существующий чат
-                                    try:
-                                        existing_id = existing.get('id')
-                                        if product_url:
-                                            app.logger.info(f"[SYNC] Обновление чата {existing_id} с product_url={product_url}")
+                                        # Обновляем существующий чат
+                                        try:
+                                            existing_id = existing.get('id')
+                                            if product_url:
+                                                app.logger.debug("[SYNC] Обновление чата %s с product_url=%s", existing_id, product_url)
                                         
-                                        # Формируем SQL запрос с listing_data если есть
-                                        update_fields = [
-                                            'client_name = ?',
-                                            'client_phone = ?',
-                                            'customer_id = ?',
-                                            'product_url = ?',
-                                            'last_message = ?',
-                                            'unread_count = ?',
-                                            'status = ?',
-                                            'priority = ?',
-                                            'updated_at = CURRENT_TIMESTAMP'
-                                        ]
-                                        update_values = [
-                                            client_name,
-                                            client_phone,
-                                            customer_id if customer_id else None,
-                                            product_url if product_url else None,
-                                            last_message,
-                                            unread_count,
-                                            status,
-                                            priority
-                                        ]
+                                            # Формируем SQL запрос с listing_data если есть
+                                            update_fields = [
+                                                'client_name = ?',
+                                                'client_phone = ?',
+                                                'customer_id = ?',
+                                                'product_url = ?',
+                                                'last_message = ?',
+                                                'unread_count = ?',
+                                                'status = ?',
+                                                'priority = ?',
+                                                'updated_at = CURRENT_TIMESTAMP'
+                                            ]
+                                            update_values = [
+                                                client_name,
+                                                client_phone,
+                                                customer_id if customer_id else None,
+                                                product_url if product_url else None,
+                                                last_message,
+                                                unread_count,
+                                                status,
+                                                priority
+                                            ]
                                         
-                                        # Добавляем listing_data если есть
-                                        if listing_data_json:
-                                            update_fields.append('listing_data = ?')
-                                            update_values.append(listing_data_json)
+                                            # Добавляем listing_data если есть
+                                            if listing_data_json:
+                                                update_fields.append('listing_data = ?')
+                                                update_values.append(listing_data_json)
                                         
-                                        update_values.append(existing_id)
+                                            update_values.append(existing_id)
                                         
-                                        conn.execute(f'''
-                                            UPDATE avito_chats 
-                                            SET {', '.join(update_fields)}
-                                            WHERE id = ?
-                                        ''', tuple(update_values))
-                                        chats_updated += 1
-                                        total_synced += 1
+                                            conn.execute(f'''
+                                                UPDATE avito_chats 
+                                                SET {', '.join(update_fields)}
+                                                WHERE id = ?
+                                            ''', tuple(update_values))
+                                            chats_updated += 1
+                                            total_synced += 1
                                         
-                                        # Проверяем, что product_url действительно сохранился
-                                        if product_url:
-                                            conn.commit()  # Убеждаемся, что изменения сохранены
-                                            verify_chat = conn.execute('''
-                                                SELECT product_url FROM avito_chats WHERE id = ?
-                                            ''', (existing_id,)).fetchone()
-                                            if verify_chat:
-                                                # Конвертируем sqlite3.Row в dict для безопасного доступа
-                                                verify_chat = dict(verify_chat)
-                                                saved_url = verify_chat.get('product_url')
-                                                app.logger.info(f"[SYNC] Проверка сохранения для чата {existing_id}: product_url в БД = {saved_url}")
-                                                if saved_url != product_url:
-                                                    app.logger.error(f"[SYNC] ОШИБКА: product_url не совпадает! Ожидалось: {product_url}, Сохранено: {saved_url}")
+                                            # Проверяем, что product_url действительно сохранился
+                                            if product_url:
+                                                conn.commit()  # Убеждаемся, что изменения сохранены
+                                                verify_chat = conn.execute('''
+                                                    SELECT product_url FROM avito_chats WHERE id = ?
+                                                ''', (existing_id,)).fetchone()
+                                                if verify_chat:
+                                                    # Конвертируем sqlite3.Row в dict для безопасного доступа
+                                                    verify_chat = dict(verify_chat)
+                                                    saved_url = verify_chat.get('product_url')
+                                                    app.logger.debug("[SYNC] Проверка сохранения для чата %s: product_url в БД = %s", existing_id, saved_url)
+                                                    if saved_url != product_url:
+                                                        app.logger.error(f"[SYNC] ОШИБКА: product_url не совпадает! Ожидалось: {product_url}, Сохранено: {saved_url}")
+                                                else:
+                                                    app.logger.error(f"[SYNC] ОШИБКА: не удалось проверить сохранение product_url для чата {existing_id}")
+                                        except Exception as update_err:
+                                            app.logger.error(f"[SYNC] Ошибка обновления чата {avito_chat_id_str}: {update_err}", exc_info=True)
+                                            if 'chats_errors' in locals():
+                                                chats_errors += 1
                                             else:
-                                                app.logger.error(f"[SYNC] ОШИБКА: не удалось проверить сохранение product_url для чата {existing_id}")
-                                    except Exception as update_err:
-                                        app.logger.error(f"[SYNC] Ошибка обновления чата {avito_chat_id_str}: {update_err}", exc_info=True)
-                                        if 'chats_errors' in locals():
-                                            chats_errors += 1
-                                        else:
-                                            chats_errors = 1
-                                else:
-                                    # Создаем новый чат
-                                    try:
-                                        if product_url:
-                                            app.logger.info(f"[SYNC] Создание нового чата с product_url={product_url}")
-                                        # Формируем SQL запрос с listing_data если есть
-                                        insert_fields = [
-                                            'shop_id', 'chat_id', 'customer_id', 'client_name', 'client_phone', 
-                                            'product_url', 'last_message', 'unread_count', 'status', 'priority', 
-                                            'created_at', 'updated_at'
-                                        ]
-                                        insert_values = [
-                                            shop['id'],
-                                            avito_chat_id_str,
-                                            customer_id if customer_id else None,
-                                            client_name,
-                                            client_phone,
-                                            product_url if product_url else None,
-                                            last_message,
-                                            unread_count,
-                                            status,
-                                            priority,
-                                            'CURRENT_TIMESTAMP',
-                                            'CURRENT_TIMESTAMP'
-                                        ]
+                                                chats_errors = 1
+                                    else:
+                                        # Создаем новый чат
+                                        try:
+                                            if product_url:
+                                                app.logger.debug("[SYNC] Создание нового чата с product_url=%s", product_url)
+                                            # Формируем SQL запрос с listing_data если есть
+                                            insert_fields = [
+                                                'shop_id', 'chat_id', 'customer_id', 'client_name', 'client_phone', 
+                                                'product_url', 'last_message', 'unread_count', 'status', 'priority', 
+                                                'created_at', 'updated_at'
+                                            ]
+                                            insert_values = [
+                                                shop['id'],
+                                                avito_chat_id_str,
+                                                customer_id if customer_id else None,
+                                                client_name,
+                                                client_phone,
+                                                product_url if product_url else None,
+                                                last_message,
+                                                unread_count,
+                                                status,
+                                                priority,
+                                                'CURRENT_TIMESTAMP',
+                                                'CURRENT_TIMESTAMP'
+                                            ]
                                         
-                                        # Добавляем listing_data если есть
-                                        if listing_data_json:
-                                            insert_fields.append('listing_data')
-                                            insert_values.append(listing_data_json)
+                                            # Добавляем listing_data если есть
+                                            if listing_data_json:
+                                                insert_fields.append('listing_data')
+                                                insert_values.append(listing_data_json)
                                         
-                                        # Заменяем CURRENT_TIMESTAMP на ? для параметризованного запроса
-                                        placeholders = ['?' for _ in insert_values]
-                                        placeholders[-2] = 'CURRENT_TIMESTAMP'  # created_at
-                                        placeholders[-1] = 'CURRENT_TIMESTAMP'  # updated_at
+                                            # Заменяем CURRENT_TIMESTAMP на ? для параметризованного запроса
+                                            placeholders = ['?' for _ in insert_values]
+                                            placeholders[-2] = 'CURRENT_TIMESTAMP'  # created_at
+                                            placeholders[-1] = 'CURRENT_TIMESTAMP'  # updated_at
                                         
-                                        # Убираем CURRENT_TIMESTAMP из значений
-                                        final_values = insert_values[:-2]  # Все кроме created_at и updated_at
+                                            # Убираем CURRENT_TIMESTAMP из значений
+                                            final_values = insert_values[:-2]  # Все кроме created_at и updated_at
                                         
-                                        cursor = conn.execute(f'''
-                                            INSERT INTO avito_chats 
-                                                ({', '.join(insert_fields)})
-                                            VALUES ({', '.join(placeholders)})
-                                        ''', tuple(final_values))
-                                        new_chat_id = cursor.lastrowid
-                                        chats_created += 1
-                                        total_synced += 1
-                                        app.logger.info(f"[SYNC] ✅ Создан новый чат: БД_id={new_chat_id}, shop_id={shop['id']}, chat_id={avito_chat_id_str}, client_name={client_name}, product_url={product_url}")
+                                            cursor = conn.execute(f'''
+                                                INSERT INTO avito_chats 
+                                                    ({', '.join(insert_fields)})
+                                                VALUES ({', '.join(placeholders)})
+                                            ''', tuple(final_values))
+                                            new_chat_id = cursor.lastrowid
+                                            existing_by_chat_id[avito_chat_id_str] = {'id': new_chat_id, 'shop_id': shop['id'], 'chat_id': avito_chat_id_str}
+                                            chats_created += 1
+                                            total_synced += 1
+                                            app.logger.debug("[SYNC] ✅ Создан новый чат: БД_id=%s, shop_id=%s, chat_id=%s, client_name=%s, product_url=%s", new_chat_id, shop['id'], avito_chat_id_str, client_name, product_url)
                                         
-                                        # Проверяем, что product_url действительно сохранился
-                                        if product_url:
-                                            verify_chat = conn.execute('''
-                                                SELECT product_url FROM avito_chats WHERE id = ?
-                                            ''', (new_chat_id,)).fetchone()
-                                            if verify_chat:
-                                                # Конвертируем sqlite3.Row в dict для безопасного доступа
-                                                verify_chat = dict(verify_chat)
-                                                app.logger.info(f"[SYNC] Проверка сохранения для нового чата {new_chat_id}: product_url в БД = {verify_chat.get('product_url')}")
-                                    except Exception as insert_err:
-                                        app.logger.error(f"[SYNC] ❌ Ошибка создания чата {avito_chat_id_str}: {insert_err}", exc_info=True)
-                                        app.logger.error(f"[SYNC] Данные чата: shop_id={shop['id']}, client_name={client_name}, customer_id={customer_id}")
-                                        if 'chats_errors' in locals():
-                                            chats_errors += 1
-                                        else:
-                                            chats_errors = 1
+                                            # Проверяем, что product_url действительно сохранился
+                                            # (запрос нужен только для отладочного лога)
+                                            if product_url and app.logger.isEnabledFor(logging.DEBUG):
+                                                verify_chat = conn.execute('''
+                                                    SELECT product_url FROM avito_chats WHERE id = ?
+                                                ''', (new_chat_id,)).fetchone()
+                                                if verify_chat:
+                                                    app.logger.debug("[SYNC] Проверка сохранения для нового чата %s: product_url в БД = %s", new_chat_id, verify_chat['product_url'])
+                                        except Exception as insert_err:
+                                            app.logger.error(f"[SYNC] ❌ Ошибка создания чата {avito_chat_id_str}: {insert_err}", exc_info=True)
+                                            app.logger.error(f"[SYNC] Данные чата: shop_id={shop['id']}, client_name={client_name}, customer_id={customer_id}")
+                                            if 'chats_errors' in locals():
+                                                chats_errors += 1
+                                            else:
+                                                chats_errors = 1
                                 
-                                chats_processed += 1
+                                    chats_processed += 1
                                 
-                                # Логируем каждые 10 чатов для отслеживания прогресса
-                                if chats_processed % 10 == 0:
-                                    app.logger.info(f"[SYNC] Обработано {chats_processed}/{chats_count} чатов (создано: {chats_created}, обновлено: {chats_updated})")
+                                    # Логируем каждые 10 чатов для отслеживания прогресса
+                                    if chats_processed % 10 == 0:
+                                        app.logger.info(f"[SYNC] Обработано {chats_processed}/{chats_count} чатов (создано: {chats_created}, обновлено: {chats_updated})")
                                 
-                            except Exception as e:
-                                if 'chats_errors' in locals():
-                                    chats_errors += 1
-                                else:
-                                    chats_errors = 1
-                                try:
-                                    chat_id_str = str(chat_data.get('id', 'unknown'))
-                                except:
-                                    chat_id_str = 'unknown'
-                                app.logger.error(f"[SYNC] Ошибка обработки чата {chat_id_str}: {e}", exc_info=True)
-                                errors.append(f"Ошибка обработки чата {chat_id_str}: {str(e)}")
-                                continue
+                                except Exception as e:
+                                    if 'chats_errors' in locals():
+                                        chats_errors += 1
+                                    else:
+                                        chats_errors = 1
+                                    try:
+                                        chat_id_str = str(chat_data.get('id', 'unknown'))
+                                    except:
+                                        chat_id_str = 'unknown'
+                                    app.logger.error(f"[SYNC] Ошибка обработки чата {chat_id_str}: {e}", exc_info=True)
+                                    errors.append(f"Ошибка обработки чата {chat_id_str}: {str(e)}")
+                                    continue
                         
-                        chats_errors = chats_errors if 'chats_errors' in locals() else 0
-                        app.logger.info(f"[SYNC] Страница завершена: обработано={chats_processed}, создано={chats_created}, обновлено={chats_updated}, ошибок={chats_errors}")
+                            chats_errors = chats_errors if 'chats_errors' in locals() else 0
+                            app.logger.info(f"[SYNC] Страница завершена: обработано={chats_processed}, создано={chats_created}, обновлено={chats_updated}, ошибок={chats_errors}")
                         
-                        # Коммитим изменения после каждой страницы
-                        conn.commit()
-                        # Проверяем реальное количество чатов в БД после коммита
-                        actual_count = conn.execute('SELECT COUNT(*) as cnt FROM avito_chats WHERE shop_id = ?', (shop['id'],)).fetchone()
-                        if actual_count:
-                            actual_count = dict(actual_count)
-                            app.logger.info(f"[SYNC] Изменения сохранены в БД (всего синхронизировано: {total_synced}, реально чатов в БД для shop_id={shop['id']}: {actual_count.get('cnt', 0)})")
-                        else:
-                            app.logger.info(f"[SYNC] Изменения сохранены в БД (всего синхронизировано: {total_synced}, реально чатов в БД для shop_id={shop['id']}: 0)")
+                            # Коммитим изменения после каждой страницы
+                            conn.commit()
+                            # Проверяем реальное количество чатов в БД после коммита
+                            actual_count = conn.execute('SELECT COUNT(*) as cnt FROM avito_chats WHERE shop_id = ?', (shop['id'],)).fetchone()
+                            if actual_count:
+                                actual_count = dict(actual_count)
+                                app.logger.info(f"[SYNC] Изменения сохранены в БД (всего синхронизировано: {total_synced}, реально чатов в БД для shop_id={shop['id']}: {actual_count.get('cnt', 0)})")
+                            else:
+                                app.logger.info(f"[SYNC] Изменения сохранены в БД (всего синхронизировано: {total_synced}, реально чатов в БД для shop_id={shop['id']}: 0)")
                         
-                        # Проверяем, есть ли еще чаты
-                        # Для v2 API проверяем has_more в метаданных
-                        has_more = False
-                        if isinstance(response, dict) and 'meta' in response:
-                            has_more = response['meta'].get('has_more', False)
+                            # Проверяем, есть ли еще чаты
+                            # Для v2 API проверяем has_more в метаданных
+                            has_more = False
+                            if isinstance(response, dict) and 'meta' in response:
+                                has_more = response['meta'].get('has_more', False)
                         
-                        # Если получили меньше лимита И has_more=False - завершаем
-                        if chats_count < limit and not has_more:
-                            app.logger.info(f"[SYNC] Получено меньше лимита ({chats_count} < {limit}) и has_more=False, завершаем пагинацию")
-                            break
-                        elif chats_count == 0 and not has_more:
-                            app.logger.info(f"[SYNC] Нет чатов и has_more=False, завершаем пагинацию")
-                            break
-                        elif has_more:
-                            app.logger.info(f"[SYNC] has_more=True, продолжаем пагинацию (offset={offset + limit})")
+                            # Если получили меньше лимита И has_more=False - завершаем
+                            if chats_count < limit and not has_more:
+                                app.logger.info(f"[SYNC] Получено меньше лимита ({chats_count} < {limit}) и has_more=False, завершаем пагинацию")
+                                break
+                            elif chats_count == 0 and not has_more:
+                                app.logger.info(f"[SYNC] Нет чатов и has_more=False, завершаем пагинацию")
+                                break
+                            elif has_more:
+                                app.logger.info(f"[SYNC] has_more=True, продолжаем пагинацию (offset={offset + limit})")
                         
-                        # Защита от бесконечного цикла: если total=0, но продолжаем получать чаты,
-                        # ограничиваем максимальное количество страниц (максимум 1000 чатов = 10 страниц)
-                        if offset >= 1000:
-                            app.logger.warning(f"[SYNC] Достигнут лимит offset={offset}, завершаем пагинацию для защиты от бесконечного цикла")
-                            break
+                            # Защита от бесконечного цикла: если total=0, но продолжаем получать чаты,
+                            # ограничиваем максимальное количество страниц (максимум 1000 чатов = 10 страниц)
+                            if offset >= _SYNC_MAX_OFFSET:
+                                app.logger.warning(f"[SYNC] Достигнут лимит offset={offset}, завершаем пагинацию для защиты от бесконечного цикла")
+                                break
                         
-                        offset += limit
-                        app.logger.info(f"[SYNC] Переходим к следующей странице: offset={offset}")
+                            offset += limit
+                            app.logger.info(f"[SYNC] Переходим к следующей странице: offset={offset}")
                         
-                    except Exception as e:
-                        error_str = str(e)
-                        # Проверяем тип ошибки для более детального логирования
-                        if '403' in error_str or 'Forbidden' in error_str:
-                            app.logger.warning(f"[SYNC] ⚠️  Магазин {shop['id']} ({shop['name']}): 403 Forbidden - ключи не работают или нет доступа")
-                            app.logger.warning(f"[SYNC] Пропускаем магазин {shop['id']} и продолжаем с другими магазинами")
-                            errors.append(f"Магазин {shop['name']}: 403 Forbidden - ключи не работают или нет доступа")
-                        else:
-                            app.logger.error(f"[SYNC] Ошибка получения чатов для магазина {shop['name']}: {error_str}")
-                            errors.append(f"Ошибка получения чатов для магазина {shop['name']}: {error_str}")
-                        break
+                        except Exception as e:
+                            error_str = str(e)
+                            # Проверяем тип ошибки для более детального логирования
+                            if '403' in error_str or 'Forbidden' in error_str:
+                                app.logger.warning(f"[SYNC] ⚠️  Магазин {shop['id']} ({shop['name']}): 403 Forbidden - ключи не работают или нет доступа")
+                                app.logger.warning(f"[SYNC] Пропускаем магазин {shop['id']} и продолжаем с другими магазинами")
+                                errors.append(f"Магазин {shop['name']}: 403 Forbidden - ключи не работают или нет доступа")
+                            else:
+                                app.logger.error(f"[SYNC] Ошибка получения чатов для магазина {shop['name']}: {error_str}")
+                                errors.append(f"Ошибка получения чатов для магазина {shop['name']}: {error_str}")
+                            break
+                finally:
+                    if page_executor is not None:
+                        # Пагинация могла завершиться раньше - незапущенные запросы отменяем,
+                        # а выполняющиеся дожидаемся, чтобы пауза перед следующим магазином
+                        # начиналась уже без запросов к Avito API
+                        page_executor.shutdown(wait=True, cancel_futures=True)
                 
                 synced_count += total_synced
                 conn.commit()
@@ -1901,7 +2041,6 @@ def sync_chats_from_avito(shop_id: Optional[int] = None) -> Dict[str, Any]:
             'errors': errors
         }
     finally:
-        # Соединение глобальное, не закрываем
         pass
 
 
@@ -1917,7 +2056,6 @@ def get_chats():
         return _get_chats_impl()
     except Exception as flask_exception:
         # Логируем ошибку с полной информацией
-        import traceback
         error_traceback = traceback.format_exc()
         app.logger.error(f"[API/CHATS] Критическая ошибка: {flask_exception}")
         app.logger.error(f"[API/CHATS] Traceback: {error_traceback}")
@@ -2385,8 +2523,6 @@ def _get_chats_impl():
         app.logger.error(f"[API/CHATS] Критическая ошибка при обработке результатов: {process_error}", exc_info=True)
         return jsonify({'error': 'Internal server error', 'message': str(process_error)}), 500
     
-    # Соединение глобальное, не закрываем
-    
     return jsonify(chats_list)
 
 
@@ -2398,7 +2534,6 @@ def update_all_timers():
     """Обновить response_timer для всех чатов"""
     try:
         from services.messenger_service import MessengerService
-        from avito_api import AvitoAPI
         
         conn = get_db_connection()
         # Создаем фиктивный API объект (не используется для обновления таймеров)
@@ -2426,7 +2561,6 @@ def auto_complete_chats():
     """Автоматически завершить чаты старше 2 дней"""
     try:
         from services.messenger_service import MessengerService
-        from avito_api import AvitoAPI
         
         days = request.json.get('days', 2) if request.is_json else 2
         
@@ -2534,10 +2668,8 @@ def update_chat(chat_id):
             conn.execute(query, tuple(update_values))
             conn.commit()
         
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 
@@ -2568,7 +2700,6 @@ def chats_page():
         return response
     except Exception as e:
         app.logger.error(f'[CHATS PAGE] Ошибка при рендеринге страницы чатов: {e}', exc_info=True)
-        import traceback
         traceback.print_exc()
         return f'Ошибка загрузки страницы чатов: {str(e)}', 500
 
@@ -2630,7 +2761,6 @@ def settings_page():
         return render_template('settings.html', user=user)
     except Exception as e:
         app.logger.error(f'[SETTINGS] Ошибка при рендеринге страницы настроек: {e}', exc_info=True)
-        import traceback
         traceback.print_exc()
         return f'Ошибка загрузки страницы настроек: {str(e)}', 500
 
@@ -2706,10 +2836,9 @@ def create_shop():
         ''', (name, shop_url, api_key, data.get('is_active', True)))
         shop_id = cursor.lastrowid
         conn.commit()
-        # Соединение глобальное, не закрываем
+        invalidate_system_stats()
         return jsonify({'success': True, 'id': shop_id}), 201
     except Exception as e:
-        # Соединение глобальное, не закрываем
         if 'UNIQUE constraint' in str(e):
             return jsonify({'error': 'Shop with this URL already exists'}), 400
         return jsonify({'error': str(e)}), 400
@@ -2739,14 +2868,11 @@ def get_shop(shop_id):
         ''', (shop_id,)).fetchone()
         
         if not shop:
-            # Соединение глобальное, не закрываем
             return jsonify({'error': 'Магазин не найден'}), 404
         
         shop_dict = dict(shop)
-        # Соединение глобальное, не закрываем
         return jsonify(shop_dict), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         app.logger.error(f'[GET SHOP] Ошибка: {e}', exc_info=True)
         return jsonify({'error': str(e)}), 500
 
@@ -2780,7 +2906,6 @@ def update_shop(shop_id):
         # Проверяем существование магазина
         exists = conn.execute('SELECT id FROM avito_shops WHERE id = ?', (shop_id,)).fetchone()
         if not exists:
-            # Соединение глобальное, не закрываем
             return jsonify({'error': 'Магазин не найден'}), 404
         
         conn.execute('''
@@ -2789,10 +2914,9 @@ def update_shop(shop_id):
             WHERE id = ?
         ''', (name, shop_url, api_key, is_active, shop_id))
         conn.commit()
-        # Соединение глобальное, не закрываем
+        invalidate_system_stats()
         return jsonify({'success': True}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         app.logger.error(f'[UPDATE SHOP] Ошибка: {e}', exc_info=True)
         return jsonify({'error': str(e)}), 400
 
@@ -2823,7 +2947,6 @@ def update_shop_credentials(shop_id):
     try:
         exists = conn.execute('SELECT id, name FROM avito_shops WHERE id = ?', (shop_id,)).fetchone()
         if not exists:
-            # Соединение глобальное, не закрываем
             return jsonify({'error': 'Shop not found'}), 404
 
         # Проверяем текущие значения перед обновлением
@@ -2846,11 +2969,12 @@ def update_shop_credentials(shop_id):
         app.logger.info(f'[UPDATE CREDENTIALS] Обновлено строк: {rows_affected} для магазина {shop_id}')
         
         if rows_affected == 0:
-            # Соединение глобальное, не закрываем
             app.logger.error(f'[UPDATE CREDENTIALS] Магазин {shop_id} не найден для обновления')
             return jsonify({'error': 'Магазин не найден'}), 404
         
         conn.commit()
+        invalidate_system_stats()
+        invalidate_webhook_shop()
         app.logger.info(f'[UPDATE CREDENTIALS] Изменения зафиксированы в БД для магазина {shop_id}')
         
         # Проверяем, что данные действительно сохранились
@@ -2870,7 +2994,6 @@ def update_shop_credentials(shop_id):
         
         if verify_client_id != expected_client_id or verify_user_id != expected_user_id:
             app.logger.error(f'[UPDATE CREDENTIALS] Данные не сохранились! Ожидалось: client_id={expected_client_id[:10] if expected_client_id else "None"}..., user_id={expected_user_id}, получено: client_id={verify_client_id[:10] if verify_client_id else "None"}..., user_id={verify_user_id}')
-            # Соединение глобальное, не закрываем
             return jsonify({'error': 'Данные не были сохранены. Попробуйте еще раз.'}), 500
         
         app.logger.info(f'[UPDATE CREDENTIALS] Ключи успешно сохранены для магазина {shop_id}')
@@ -2878,8 +3001,6 @@ def update_shop_credentials(shop_id):
         # Регистрируем webhook для магазина
         webhook_registered = False
         try:
-            from avito_api import AvitoAPI
-            import os
             
             # Получаем URL для webhook из переменных окружения или используем osagaming.store
             webhook_url = os.getenv('AVITO_WEBHOOK_URL')
@@ -2932,8 +3053,6 @@ def update_shop_credentials(shop_id):
         except Exception as log_err:
             app.logger.warning(f'[UPDATE CREDENTIALS] Не удалось залогировать действие: {log_err}')
         
-        # Соединение глобальное, не закрываем
-        
         message = 'Ключи успешно сохранены'
         if webhook_registered:
             message += '. Webhook зарегистрирован'
@@ -2947,9 +3066,7 @@ def update_shop_credentials(shop_id):
             'chats_synced': sync_result.get('synced_count', 0)
         })
     except Exception as e:
-        # Соединение глобальное, не закрываем
         app.logger.error(f'[UPDATE CREDENTIALS] Ошибка сохранения ключей Avito: {e}', exc_info=True)
-        import traceback
         traceback.print_exc()
         return jsonify({'error': f'Ошибка сохранения: {str(e)}'}), 500
 
@@ -2977,7 +3094,6 @@ def shops_analytics():
         GROUP BY s.id, s.name, s.is_active, s.token_status, s.webhook_registered
         ORDER BY s.name
     ''').fetchall()
-            # Соединение глобальное, не закрываем
     return jsonify([dict(row) for row in data])
 
 
@@ -2996,7 +3112,6 @@ def delete_shop(shop_id):
         # Проверяем существование магазина
         shop = conn.execute('SELECT id, name FROM avito_shops WHERE id = ?', (shop_id,)).fetchone()
         if not shop:
-            # Соединение глобальное, не закрываем
             return jsonify({'error': 'Shop not found'}), 404
         
         # Удаляем назначения менеджеров на этот магазин
@@ -3005,15 +3120,15 @@ def delete_shop(shop_id):
         # Удаляем магазин
         conn.execute('DELETE FROM avito_shops WHERE id = ?', (shop_id,))
         conn.commit()
+        invalidate_system_stats()
+        invalidate_webhook_shop()
         
         # Логируем действие
         log_activity(session['user_id'], 'delete_shop', 
                     f'Удален магазин ID: {shop_id} ({shop["name"]})', 'shop', shop_id)
         
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True, 'message': 'Магазин успешно удален'}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         app.logger.error(f"Ошибка удаления магазина: {e}", exc_info=True)
         return jsonify({'error': f'Ошибка удаления: {str(e)}'}), 400
 
@@ -3034,10 +3149,8 @@ def assign_manager(shop_id):
             VALUES (?, ?)
         ''', (manager_id, shop_id))
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 
@@ -3053,7 +3166,6 @@ def get_shop_stats(shop_id):
         'active_chats': conn.execute('SELECT COUNT(*) as count FROM avito_chats WHERE shop_id = ? AND status = "active"', (shop_id,)).fetchone()['count'],
         'urgent_chats': conn.execute('SELECT COUNT(*) as count FROM avito_chats WHERE shop_id = ? AND priority = "urgent"', (shop_id,)).fetchone()['count'],
     }
-            # Соединение глобальное, не закрываем
     return jsonify(stats)
 
 
@@ -3069,7 +3181,6 @@ def avito_shop_health(shop_id):
         FROM avito_shops
         WHERE id = ?
     ''', (shop_id,)).fetchone()
-            # Соединение глобальное, не закрываем
 
     if not shop:
         return jsonify({'error': 'Shop not found'}), 404
@@ -3080,7 +3191,6 @@ def avito_shop_health(shop_id):
             'details': 'Отсутствуют client_id/client_secret/user_id'
         }), 400
 
-    from avito_api import AvitoAPI
     api = AvitoAPI(shop['client_id'], shop['client_secret'], shop_id=str(shop_id))
     health = api.health_check()
     status_code = 200 if health.get('status') == 'ok' else 502
@@ -3110,7 +3220,6 @@ def avito_test_send():
         FROM avito_shops
         WHERE id = ?
     ''', (shop_id,)).fetchone()
-            # Соединение глобальное, не закрываем
 
     if not shop:
         return jsonify({'error': 'Shop not found'}), 404
@@ -3118,7 +3227,6 @@ def avito_test_send():
     if not shop['client_id'] or not shop['client_secret'] or not shop['user_id']:
         return jsonify({'error': 'Отсутствуют OAuth ключи для магазина'}), 400
 
-    from avito_api import AvitoAPI
     api = AvitoAPI(shop['client_id'], shop['client_secret'], shop_id=str(shop_id))
     try:
         api.send_message(user_id=shop['user_id'], chat_id=str(chat_id), message=message)
@@ -3140,7 +3248,6 @@ def get_shop_managers(shop_id):
         JOIN manager_assignments ma ON u.id = ma.manager_id
         WHERE ma.shop_id = ?
     ''', (shop_id,)).fetchall()
-            # Соединение глобальное, не закрываем
     
     return jsonify([dict(manager) for manager in managers])
 
@@ -3204,7 +3311,6 @@ def get_deliveries():
         
         return jsonify(result)
     finally:
-        # Соединение глобальное, не закрываем
         pass
 
 
@@ -3235,10 +3341,8 @@ def create_delivery():
                     f'Создана доставка ID: {cursor.lastrowid}', 'delivery', cursor.lastrowid)
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True, 'id': cursor.lastrowid}), 201
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 
@@ -3258,7 +3362,6 @@ def update_delivery(delivery_id):
         valid_statuses = ['free', 'in_work', 'on_delivery', 'closed', 'refused']
         new_status = data.get('status')
         if new_status and new_status not in valid_statuses:
-            # Соединение глобальное, не закрываем
             return jsonify({'error': 'Invalid status'}), 400
         
         # Обновляем поля доставки
@@ -3296,10 +3399,8 @@ def update_delivery(delivery_id):
                     f'Обновлена доставка ID: {delivery_id}', 'delivery', delivery_id)
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 
@@ -3370,7 +3471,6 @@ def batch_update_deliveries():
                 updated_count += 1
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         
         # Логируем batch операцию
         log_activity(session['user_id'], 'batch_update_deliveries', 
@@ -3378,7 +3478,6 @@ def batch_update_deliveries():
         
         return jsonify({'success': True, 'updated': updated_count}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 
@@ -3428,7 +3527,6 @@ def get_chat_messages(chat_id):
         ''', (chat_id,)).fetchone()
         
         if not chat:
-            # Соединение глобальное, не закрываем
             return jsonify({'error': 'Chat not found'}), 404
     
         # Преобразуем Row в dict для удобства
@@ -3443,7 +3541,6 @@ def get_chat_messages(chat_id):
         app.logger.info(f"[API/MESSAGES] Условие синхронизации: sync={sync}, client_id={bool(chat_dict.get('client_id'))}, client_secret={bool(chat_dict.get('client_secret'))}, user_id={bool(chat_dict.get('user_id'))}")
         
         # Троттлинг: проверяем, когда была последняя синхронизация для этого чата
-        import time
         SYNC_COOLDOWN = 5  # Минимум 5 секунд между синхронизациями одного чата
         last_sync_key = f"last_sync_{chat_id}"
         last_sync_time = getattr(get_chat_messages, last_sync_key, 0)
@@ -3469,7 +3566,6 @@ def get_chat_messages(chat_id):
                     app.logger.error(f"[API/MESSAGES] ❌ avito_chat_id не найден в chat_dict! Доступные ключи: {list(chat_dict.keys())}")
                     raise ValueError(f"avito_chat_id не найден для чата {chat_id}")
                 app.logger.info(f"[API/MESSAGES] Начинаем синхронизацию сообщений для чата {chat_id}, user_id={chat_dict.get('user_id')}, avito_chat_id={avito_chat_id}")
-                from avito_api import AvitoAPI
                 from services.messenger_service import MessengerService
                 
                 api = AvitoAPI(
@@ -3487,7 +3583,6 @@ def get_chat_messages(chat_id):
                 app.logger.info(f"[API/MESSAGES] Синхронизация завершена: {new_messages_count} новых сообщений для чата {chat_id}")
             except Exception as sync_error:
                 app.logger.error(f"[API/MESSAGES] Ошибка синхронизации сообщений для чата {chat_id}: {sync_error}", exc_info=True)
-                import traceback
                 app.logger.error(f"[API/MESSAGES] Traceback: {traceback.format_exc()}")
         else:
             if sync:
@@ -3496,9 +3591,7 @@ def get_chat_messages(chat_id):
                 app.logger.info(f"[API/MESSAGES] Синхронизация не запрошена (sync=false)")
     except Exception as messages_error:
         app.logger.error(f"[API/MESSAGES] Критическая ошибка при получении данных чата {chat_id}: {messages_error}", exc_info=True)
-        import traceback
         app.logger.error(f"[API/MESSAGES] Traceback: {traceback.format_exc()}")
-        # Соединение глобальное, не закрываем
         return jsonify({'error': 'Internal server error', 'message': str(messages_error)}), 500
     
     # Базовый запрос сообщений из БД
@@ -3567,8 +3660,6 @@ def get_chat_messages(chat_id):
             if chat_info_check and chat_info_check['last_message']:
                 app.logger.warning(f"[API/MESSAGES] ⚠️ В avito_chats.last_message есть данные, но в avito_messages нет! chat_id={chat_info_check['chat_id']}")
         
-        # Соединение глобальное, не закрываем
-        
         # Возвращаем сообщения в правильном порядке (старые первыми для отображения в чате)
         # В БД они отсортированы по timestamp DESC (новые первыми), поэтому переворачиваем
         messages_list = [dict(msg) for msg in reversed(messages)]
@@ -3582,9 +3673,7 @@ def get_chat_messages(chat_id):
         })
     except Exception as query_error:
         app.logger.error(f"[API/MESSAGES] Ошибка при запросе сообщений для чата {chat_id}: {query_error}", exc_info=True)
-        import traceback
         app.logger.error(f"[API/MESSAGES] Traceback: {traceback.format_exc()}")
-        # Соединение глобальное, не закрываем
         return jsonify({'error': 'Internal server error', 'message': str(query_error)}), 500
 
 
@@ -3598,8 +3687,6 @@ def extract_product_url_legacy(chat_id):
     """
     Извлечь product_url для чата (legacy endpoint для обратной совместимости)
     """
-    from avito_api import AvitoAPI
-    import re
     
     app.logger.info(f"[EXTRACT PRODUCT URL] Запрос на извлечение product_url для чата {chat_id}")
     user_id = session.get('user_id')
@@ -3617,7 +3704,6 @@ def extract_product_url_legacy(chat_id):
         
         if not chat:
             app.logger.warning(f"[EXTRACT PRODUCT URL] Чат {chat_id} не найден в базе данных")
-            # Соединение глобальное, не закрываем
             return jsonify({
                 'success': False,
                 'error': 'Chat not found',
@@ -3676,10 +3762,7 @@ def extract_product_url_legacy(chat_id):
                     
                     # Если не нашли в context, проверяем прямые поля
                     if not product_url:
-                        product_url = (chat_details.get('item_url') or 
-                                     chat_details.get('listing_url') or 
-                                     chat_details.get('ad_url') or
-                                     chat_details.get('product_url'))
+                        product_url = first_present(chat_details, DIRECT_PRODUCT_URL_KEYS)
                         if product_url:
                             source = 'api_direct'
                             app.logger.info(f"[EXTRACT PRODUCT URL] Найден через API прямые поля: {product_url}")
@@ -3768,14 +3851,12 @@ def extract_product_url_legacy(chat_id):
             conn.commit()
             
             app.logger.info(f"[EXTRACT PRODUCT URL] Для чата {chat_id} найден product_url: {product_url} (источник: {source})")
-            # Соединение глобальное, не закрываем
             return jsonify({
                 'success': True,
                 'product_url': product_url,
                 'source': source or 'unknown'
             }), 200
         
-        # Соединение глобальное, не закрываем
         app.logger.info(f"[EXTRACT PRODUCT URL] Для чата {chat_id} product_url не найден ни в API, ни в сообщениях")
         # Возвращаем 200 с success: false, а не 404, так как это не ошибка маршрута
         return jsonify({
@@ -3785,7 +3866,6 @@ def extract_product_url_legacy(chat_id):
         }), 200
     except Exception as e:
         app.logger.error(f"[EXTRACT PRODUCT URL] Ошибка для чата {chat_id}: {e}", exc_info=True)
-        # Соединение глобальное, не закрываем
         return jsonify({
             'success': False,
             'error': str(e),
@@ -3820,7 +3900,6 @@ def get_chat_listing(chat_id):
             )
         except Exception as service_error:
             app.logger.error(f"[CHAT LISTING] Ошибка в сервисе get_chat_listing: {service_error}", exc_info=True)
-            import traceback
             app.logger.error(f"[CHAT LISTING] Traceback: {traceback.format_exc()}")
             # Пытаемся получить хотя бы базовую информацию
             try:
@@ -3887,7 +3966,6 @@ def get_chat_listing(chat_id):
     except Exception as e:
         # Прочие ошибки (API ошибки и т.д.)
         app.logger.error(f"[CHAT LISTING] ОШИБКА получения информации об объявлении: {str(e)}", exc_info=True)
-        import traceback
         app.logger.error(f"[CHAT LISTING] Traceback: {traceback.format_exc()}")
         
         # Получаем product_url и item_id для ответа
@@ -3935,7 +4013,6 @@ def send_message(chat_id):
         ''', (chat_id,)).fetchone()
         
         if not chat:
-            # Соединение глобальное, не закрываем
             return jsonify({'error': 'Chat not found'}), 404
         
         # Преобразуем sqlite3.Row в словарь для безопасного доступа
@@ -3943,7 +4020,6 @@ def send_message(chat_id):
         
         user = get_user_by_id(session['user_id'])
         if not user:
-            # Соединение глобальное, не закрываем
             return jsonify({'error': 'User not found'}), 404
         
         # Отправляем сообщение через Avito API, если есть ключи
@@ -3962,7 +4038,6 @@ def send_message(chat_id):
             app.logger.info(f"[SEND MESSAGE] ✅ Все условия выполнены, начинаем отправку через Avito API")
             app.logger.info(f"[SEND MESSAGE] Начало отправки: chat_id={chat_id}, avito_chat_id={chat.get('chat_id')}, user_id={chat.get('shop_user_id')}, message_len={len(message)}")
             try:
-                from avito_api import AvitoAPI
                 app.logger.info(f"[SEND MESSAGE] Создание экземпляра AvitoAPI...")
                 api = AvitoAPI(
                     client_id=chat.get('client_id'),
@@ -3983,7 +4058,6 @@ def send_message(chat_id):
                 avito_error = str(e)
                 # Если ошибка 405, логируем для диагностики
                 if '405' in str(e) or 'HTTP 405' in str(e):
-                    import traceback
                     app.logger.error("=" * 80)
                     app.logger.error(f"[SEND MESSAGE] ОШИБКА 405 ПРИ ОТПРАВКЕ СООБЩЕНИЯ")
                     app.logger.error(f"[SEND MESSAGE] Chat ID (БД): {chat_id}")
@@ -3995,7 +4069,6 @@ def send_message(chat_id):
                     app.logger.error("=" * 80)
                 app.logger.error(f"[SEND MESSAGE] ❌ Ошибка отправки для чата {chat_id}: {e}")
                 app.logger.error(f"[SEND MESSAGE] Тип ошибки: {type(e).__name__}")
-                import traceback
                 app.logger.error(f"[SEND MESSAGE] Traceback: {traceback.format_exc()}")
                 # Продолжаем выполнение - сохраним сообщение в БД даже если Avito API не сработал
         else:
@@ -4047,7 +4120,6 @@ def send_message(chat_id):
                     {'message_length': len(message), 'avito_sent': avito_message_sent})
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         
         # Синхронизируем сообщения после отправки, если сообщение было отправлено через Avito
         if avito_message_sent:
@@ -4087,9 +4159,7 @@ def send_message(chat_id):
         
         return jsonify(response_data), 201
     except Exception as e:
-        # Соединение глобальное, не закрываем
         app.logger.error(f"Ошибка отправки сообщения: {e}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 400
 
@@ -4140,53 +4210,46 @@ def upload_image():
         if not shop_user_id:
             # Пытаемся получить из сессии или последнего чата
             conn = get_db_connection()
-            try:
-                # Получаем последний активный чат пользователя
-                last_chat = conn.execute('''
-                    SELECT s.user_id as shop_user_id, s.client_id, s.client_secret
-                    FROM avito_chats c
-                    LEFT JOIN avito_shops s ON c.shop_id = s.id
-                    WHERE c.id IN (
-                        SELECT id FROM avito_chats 
-                        ORDER BY updated_at DESC LIMIT 1
-                    )
-                    LIMIT 1
-                ''').fetchone()
+            # Получаем последний активный чат пользователя
+            last_chat = conn.execute('''
+                SELECT s.user_id as shop_user_id, s.client_id, s.client_secret
+                FROM avito_chats c
+                LEFT JOIN avito_shops s ON c.shop_id = s.id
+                WHERE c.id IN (
+                    SELECT id FROM avito_chats 
+                    ORDER BY updated_at DESC LIMIT 1
+                )
+                LIMIT 1
+            ''').fetchone()
                 
-                if last_chat:
-                    last_chat = dict(last_chat) if not isinstance(last_chat, dict) else last_chat
-                    shop_user_id = last_chat.get('shop_user_id')
-                    client_id = last_chat.get('client_id')
-                    client_secret = last_chat.get('client_secret')
-                else:
-                    return jsonify({'error': 'No shop user_id found. Please select a chat first.'}), 400
-            finally:
-                pass  # Соединение глобальное, не закрываем
+            if last_chat:
+                last_chat = dict(last_chat) if not isinstance(last_chat, dict) else last_chat
+                shop_user_id = last_chat.get('shop_user_id')
+                client_id = last_chat.get('client_id')
+                client_secret = last_chat.get('client_secret')
+            else:
+                return jsonify({'error': 'No shop user_id found. Please select a chat first.'}), 400
         else:
             # Получаем client_id и client_secret для этого user_id
             conn = get_db_connection()
-            try:
-                shop = conn.execute('''
-                    SELECT client_id, client_secret, user_id
-                    FROM avito_shops
-                    WHERE user_id = ?
-                    LIMIT 1
-                ''', (shop_user_id,)).fetchone()
+            shop = conn.execute('''
+                SELECT client_id, client_secret, user_id
+                FROM avito_shops
+                WHERE user_id = ?
+                LIMIT 1
+            ''', (shop_user_id,)).fetchone()
                 
-                if not shop:
-                    return jsonify({'error': 'Shop not found'}), 404
+            if not shop:
+                return jsonify({'error': 'Shop not found'}), 404
                 
-                shop = dict(shop) if not isinstance(shop, dict) else shop
-                client_id = shop.get('client_id')
-                client_secret = shop.get('client_secret')
-            finally:
-                pass  # Соединение глобальное, не закрываем
+            shop = dict(shop) if not isinstance(shop, dict) else shop
+            client_id = shop.get('client_id')
+            client_secret = shop.get('client_secret')
         
         if not client_id or not client_secret:
             return jsonify({'error': 'Avito API credentials not configured for this shop'}), 400
         
         # Загружаем изображение через Avito API
-        from avito_api import AvitoAPI
         api = AvitoAPI(client_id, client_secret)
         
         upload_results = api.upload_images(str(shop_user_id), [temp_path])
@@ -4214,7 +4277,6 @@ def upload_image():
         
     except Exception as e:
         app.logger.error(f"Ошибка загрузки изображения: {e}")
-        import traceback
         traceback.print_exc()
         # Удаляем временный файл при ошибке
         try:
@@ -4310,7 +4372,6 @@ def upload_media():
             return jsonify({'error': 'Avito API credentials not configured for this shop'}), 400
         
         # Загружаем медиа через Avito API
-        from avito_api import AvitoAPI
         api = AvitoAPI(client_id, client_secret)
         
         upload_result = api.upload_media(str(shop_user_id), temp_path, file_type=file_type)
@@ -4334,7 +4395,6 @@ def upload_media():
         
     except Exception as e:
         app.logger.error(f"Ошибка загрузки медиа: {e}")
-        import traceback
         traceback.print_exc()
         try:
             if 'temp_path' in locals():
@@ -4378,7 +4438,6 @@ def send_image_message(chat_id):
             return jsonify({'error': 'Avito API credentials not configured for this shop'}), 400
         
         # Отправляем изображение через Avito API
-        from avito_api import AvitoAPI
         api = AvitoAPI(chat['client_id'], chat['client_secret'])
         
         result = api.send_image_message_direct(
@@ -4416,11 +4475,8 @@ def send_image_message(chat_id):
         
     except Exception as e:
         app.logger.error(f"Ошибка отправки изображения: {e}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 400
-    finally:
-        pass  # Соединение глобальное, не закрываем
 
 
 # API для получения шаблонов ответов
@@ -4436,7 +4492,6 @@ def get_templates():
         WHERE is_active = 1 
         ORDER BY category, name
     ''').fetchall()
-            # Соединение глобальное, не закрываем
     
     return jsonify([dict(template) for template in templates])
 
@@ -4454,7 +4509,6 @@ def get_quick_replies():
         WHERE is_active = 1 
         ORDER BY shortcut
     ''').fetchall()
-            # Соединение глобальное, не закрываем
     
     return jsonify([dict(reply) for reply in replies])
 
@@ -4470,7 +4524,6 @@ def get_all_quick_replies():
         FROM quick_replies 
         ORDER BY is_active DESC, shortcut
     ''').fetchall()
-            # Соединение глобальное, не закрываем
     
     return jsonify([dict(reply) for reply in replies])
 
@@ -4507,10 +4560,8 @@ def create_quick_reply():
                     f'Создан быстрый ответ: {shortcut}', 'quick_reply', reply_id)
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True, 'id': reply_id}), 201
     except Exception as e:
-        # Соединение глобальное, не закрываем
         if 'UNIQUE constraint' in str(e):
             return jsonify({'error': 'Quick reply with this shortcut already exists'}), 400
         return jsonify({'error': str(e)}), 400
@@ -4554,10 +4605,8 @@ def update_quick_reply(reply_id):
             
             conn.commit()
         
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 # API для удаления быстрого ответа
@@ -4574,10 +4623,8 @@ def delete_quick_reply(reply_id):
                     f'Удален быстрый ответ ID: {reply_id}', 'quick_reply', reply_id)
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 
@@ -4644,8 +4691,6 @@ def get_analytics():
         LEFT JOIN client_orders o ON c.id = o.chat_id
     ''').fetchone()
     
-            # Соединение глобальное, не закрываем
-    
     return jsonify({
         'response_stats': dict(response_stats),
         'kpi_stats': [dict(stat) for stat in kpi_stats],
@@ -4668,7 +4713,6 @@ def get_automation_rules():
         WHERE is_active = 1 
         ORDER BY created_at DESC
     ''').fetchall()
-            # Соединение глобальное, не закрываем
     
     return jsonify([dict(rule) for rule in rules])
 
@@ -4689,10 +4733,8 @@ def create_automation_rule():
         ''', (data.get('name'), data.get('trigger_type'), json.dumps(data.get('trigger_condition')),
               data.get('action_type'), json.dumps(data.get('action_data')), session['user_id']))
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True, 'id': cursor.lastrowid}), 201
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 
@@ -4718,7 +4760,6 @@ def avito_webhook():
     Автоматически синхронизирует чаты при получении уведомлений.
     """
     try:
-        from avito_api import AvitoAPI
 
         # Получаем данные webhook
         data = request.get_json()
@@ -4987,7 +5028,6 @@ def avito_webhook():
                 metadata={'webhook_data': data}
             )
 
-        # Соединение глобальное, не закрываем
         return jsonify({'status': 'ok'}), 200
 
     except Exception as e:
@@ -5024,8 +5064,6 @@ def get_manager_kpi(user_id):
     # Получаем текущие показатели
     user = conn.execute('SELECT kpi_score FROM users WHERE id = ?', (user_id,)).fetchone()
     
-            # Соединение глобальное, не закрываем
-    
     return jsonify({
         'settings': [dict(setting) for setting in kpi_settings],
         'history': [dict(record) for record in kpi_history],
@@ -5043,7 +5081,6 @@ def get_system_settings():
 
     conn = get_db_connection()
     settings = conn.execute('SELECT id, setting_key, setting_value, setting_type, description, updated_at FROM system_settings').fetchall()
-            # Соединение глобальное, не закрываем
     
     settings_dict = {}
     for setting in settings:
@@ -5092,10 +5129,8 @@ def update_system_settings():
             ''', (str(value), setting_type, key))
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 
@@ -5128,11 +5163,9 @@ def get_user_profile():
             return jsonify({'error': 'User not found'}), 404
         
         user_dict = dict(user)
-        # Соединение глобальное, не закрываем
         return jsonify(user_dict), 200
     except Exception as e:
         app.logger.error(f'[GET USER PROFILE] Ошибка: {e}', exc_info=True)
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 500
 
 
@@ -5158,7 +5191,6 @@ def update_user_profile():
         return jsonify({'error': 'Username and email are required'}), 400
 
     # Проверка формата email
-    import re
     email_pattern = r'^[^\s@]+@[^\s@]+\.[^\s@]+$'
     if not re.match(email_pattern, email):
         return jsonify({'error': 'Invalid email format'}), 400
@@ -5197,17 +5229,16 @@ def update_user_profile():
             ''', (username, email, session['user_id']))
         
         conn.commit()
+        invalidate_user_cache(session['user_id'])
         
         # Логируем изменение профиля
         log_activity(session['user_id'], 'update_profile',
                     f'Пользователь обновил профиль: username={username}, email={email}', 'user', session['user_id'])
         
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True, 'message': 'Profile updated successfully'}), 200
     except Exception as e:
         conn.rollback()
         app.logger.error(f'[UPDATE USER PROFILE] Ошибка: {e}', exc_info=True)
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 500
 
 
@@ -5251,10 +5282,8 @@ def update_user_settings():
                   data.get('sound_alerts', True), data.get('push_notifications', True)))
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 
@@ -5375,7 +5404,6 @@ def export_data(data_type):
     
     elif data_type == 'analytics':
         if session.get('user_role') != 'admin':
-            # Соединение глобальное, не закрываем
             return jsonify({'error': 'Access denied'}), 403
         
         logs = conn.execute('''
@@ -5392,10 +5420,7 @@ def export_data(data_type):
                 log['metadata'] or '', log['created_at']
             ])
     
-            # Соединение глобальное, не закрываем
-    
     output.seek(0)
-    from flask import Response
     return Response(
         output.getvalue(),
         mimetype='text/csv',
@@ -5439,8 +5464,6 @@ def get_notifications():
             WHERE ma.manager_id = ? AND c.unread_count > 0 AND c.status != 'completed'
         ''', (session['user_id'],)).fetchone()['count']
     
-            # Соединение глобальное, не закрываем
-    
     notifications = []
     if urgent_chats > 0:
         notifications.append({
@@ -5527,8 +5550,6 @@ def get_analytics_charts():
             ORDER BY hour
         ''', (user_id,)).fetchall()
     
-            # Соединение глобальное, не закрываем
-    
     return jsonify({
         'daily_chats': [{'date': str(row['date']), 'count': row['count']} for row in daily_chats],
         'priority_stats': [{'priority': row['priority'], 'count': row['count']} for row in priority_stats],
@@ -5597,7 +5618,6 @@ def search():
         ''', (f'%{query}%', f'%{query}%')).fetchall()
         results['shops'] = [dict(shop) for shop in shops]
     
-            # Соединение глобальное, не закрываем
     return jsonify(results)
 
 
@@ -5659,7 +5679,6 @@ def create_manager():
                 'error': f'Пользователь с email {email} уже существует (ID: {existing_dict.get("id")}, статус: {status_text})'
             }), 400
         
-        from auth import generate_temp_password, hash_password
         
         # Генерируем одноразовый пароль для нового пользователя
         temp_password = generate_temp_password()
@@ -5687,7 +5706,7 @@ def create_manager():
                         f'Создан пользователь: {username} ({email}) с ролью {role}', 'user', manager_id)
             
             conn.commit()
-            # Соединение глобальное, не закрываем
+            invalidate_system_stats()
 
             app.logger.info(f'[CREATE USER] Пользователь успешно создан: ID={manager_id}, username={username}, email={email}')
             return jsonify({
@@ -5698,7 +5717,6 @@ def create_manager():
             }), 201
         except Exception as e:
             app.logger.error(f'[CREATE USER] Ошибка при создании пользователя в БД: {e}', exc_info=True)
-            # Соединение глобальное, не закрываем
             if 'UNIQUE constraint' in str(e):
                 return jsonify({'error': 'User with this email already exists'}), 400
             return jsonify({'error': str(e)}), 400
@@ -5773,7 +5791,6 @@ def update_manager(manager_id):
         if 'password' in data and data['password']:
             if len(data['password']) < 6:
                 return jsonify({'error': 'Password must be at least 6 characters'}), 400
-            from auth import hash_password
             hashed_password = hash_password(data['password'])
             update_fields.append('password = ?')
             update_values.append(hashed_password)
@@ -5807,13 +5824,14 @@ def update_manager(manager_id):
                         f'Обновлен пользователь ID: {manager_id} (роль: {target_role})', 'user', manager_id)
             
             conn.commit()
+            invalidate_user_cache(manager_id)
+            # Роль могла измениться - счетчик менеджеров в статистике устарел
+            invalidate_system_stats()
         
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True}), 200
     except Exception as e:
         conn.rollback()
         app.logger.error(f'[UPDATE MANAGER] Ошибка: {e}', exc_info=True)
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 # API для удаления менеджера или админа
@@ -5863,14 +5881,13 @@ def delete_manager(manager_id):
                     f'Деактивирован {role_text}: {target_username} (ID: {manager_id})', 'user', manager_id)
         
         conn.commit()
-        # Соединение глобальное, не закрываем
+        invalidate_user_cache(manager_id)
         return jsonify({
             'success': True,
             'message': f'Пользователь {target_username} успешно деактивирован'
         }), 200
     except Exception as e:
         app.logger.error(f'[DELETE USER] Ошибка удаления пользователя {manager_id}: {e}', exc_info=True)
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 # API для сброса пароля пользователя (только для админа/супер админа)
@@ -5916,7 +5933,6 @@ def reset_user_password(manager_id):
             return jsonify({'error': 'Нельзя сбросить пароль неактивному пользователю'}), 400
         
         # Генерируем новый одноразовый пароль
-        from auth import generate_temp_password, hash_password
         
         temp_password = generate_temp_password()
         hashed_password = hash_password(temp_password)
@@ -5934,7 +5950,7 @@ def reset_user_password(manager_id):
                     f'Сброшен пароль {role_text}: {target_username} (ID: {manager_id})', 'user', manager_id)
         
         conn.commit()
-        # Соединение глобальное, не закрываем
+        invalidate_user_cache(manager_id)
         
         app.logger.info(f'[RESET PASSWORD] Пароль сброшен для пользователя ID={manager_id}, username={target_username}')
         return jsonify({
@@ -5944,7 +5960,6 @@ def reset_user_password(manager_id):
         }), 200
     except Exception as e:
         app.logger.error(f'[RESET PASSWORD] Ошибка сброса пароля пользователя {manager_id}: {e}', exc_info=True)
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 # ==================== МОДУЛЬ ГРАФИКА РАБОТЫ ====================
@@ -5966,7 +5981,6 @@ def get_work_schedule(user_id):
         WHERE user_id = ?
         ORDER BY day_of_week
     ''', (user_id,)).fetchall()
-            # Соединение глобальное, не закрываем
     
     return jsonify([dict(schedule) for schedule in schedules])
 
@@ -5984,7 +5998,6 @@ def get_all_work_schedules():
         JOIN users u ON ws.user_id = u.id
         ORDER BY u.username, ws.day_of_week
     ''').fetchall()
-            # Соединение глобальное, не закрываем
     
     return jsonify([dict(schedule) for schedule in schedules])
 
@@ -6045,10 +6058,8 @@ def save_work_schedule():
                     'work_schedule', user_id)
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 # API для массового обновления графика работы (только админ)
@@ -6091,10 +6102,8 @@ def bulk_update_work_schedules():
                     'work_schedule', user_id)
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 # API для получения менеджеров, назначенных на день недели
@@ -6111,7 +6120,6 @@ def get_day_managers(day_of_week):
         WHERE dma.day_of_week = ?
         ORDER BY dma.start_time, u.username
     ''', (day_of_week,)).fetchall()
-            # Соединение глобальное, не закрываем
     
     return jsonify([dict(manager) for manager in managers])
 
@@ -6128,7 +6136,6 @@ def get_all_day_managers_public():
         JOIN users u ON dma.manager_id = u.id
         ORDER BY dma.day_of_week, dma.start_time, u.username
     ''').fetchall()
-            # Соединение глобальное, не закрываем
     
     return jsonify([dict(assignment) for assignment in assignments])
 
@@ -6146,7 +6153,6 @@ def get_all_day_managers():
         JOIN users u ON dma.manager_id = u.id
         ORDER BY dma.day_of_week, dma.start_time, u.username
     ''').fetchall()
-            # Соединение глобальное, не закрываем
     
     return jsonify([dict(assignment) for assignment in assignments])
 
@@ -6198,10 +6204,8 @@ def assign_day_manager():
                     'day_manager_assignment', manager_id)
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 # API для удаления назначения менеджера на день недели
@@ -6221,10 +6225,8 @@ def remove_day_manager(assignment_id):
                     'day_manager_assignment', assignment_id)
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 # API для массового обновления назначений менеджеров на дни недели
@@ -6263,10 +6265,8 @@ def bulk_update_day_managers():
                     'day_manager_assignment', None)
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 # ==================== МОДУЛЬ СМЕН ====================
@@ -6293,7 +6293,6 @@ def start_shift():
     ''', (manager_id, today)).fetchone()
     
     if existing_shift:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': 'Shift already started today'}), 400
     
     # Проверяем опоздание (смена должна начаться до 10:00)
@@ -6326,7 +6325,6 @@ def start_shift():
                     'shift', shift_id, {'is_late': is_late, 'late_minutes': late_minutes})
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         
         return jsonify({
             'success': True, 
@@ -6335,7 +6333,6 @@ def start_shift():
             'late_minutes': late_minutes
         }), 201
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 # API для закрытия смены
@@ -6358,7 +6355,6 @@ def end_shift():
         ''', (manager_id, today)).fetchone()
         
         if not shift:
-            # Соединение глобальное, не закрываем
             return jsonify({'error': 'No active shift found'}), 404
         
         conn.execute('''
@@ -6371,10 +6367,8 @@ def end_shift():
         log_activity(manager_id, 'end_shift', 'Закрыта смена', 'shift', shift['id'])
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 # API для получения текущей смены
@@ -6394,8 +6388,6 @@ def get_current_shift():
         WHERE manager_id = ? AND shift_date = ? AND status = "active"
     ''', (manager_id, today)).fetchone()
     
-            # Соединение глобальное, не закрываем
-    
     if shift:
         return jsonify({'shift': dict(shift)})
     return jsonify({'shift': None})
@@ -6432,7 +6424,6 @@ def get_shifts():
             ORDER BY shift_date DESC, shift_start_time DESC
         ''', (session['user_id'],)).fetchall()
     
-            # Соединение глобальное, не закрываем
     return jsonify([dict(shift) for shift in shifts])
 
 # ==================== МОДУЛЬ ШТРАФОВ ====================
@@ -6500,7 +6491,6 @@ def get_penalties():
                 ORDER BY p.created_at DESC
             ''', (session['user_id'],)).fetchall()
     
-            # Соединение глобальное, не закрываем
     return jsonify([dict(penalty) for penalty in penalties])
 
 # API для создания штрафа (админ)
@@ -6538,10 +6528,8 @@ def create_penalty():
                     'penalty', penalty_id, {'manager_id': manager_id, 'amount': penalty_amount})
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True, 'id': penalty_id}), 201
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 # ==================== МОДУЛЬ ЛОГОВ ДЕЙСТВИЙ ====================
@@ -6576,7 +6564,6 @@ def get_activity_logs():
             LIMIT ?
         ''', (limit,)).fetchall()
     
-            # Соединение глобальное, не закрываем
     return jsonify([dict(log) for log in logs])
 
 # API для получения списка менеджеров (для фильтра)
@@ -6625,7 +6612,6 @@ def get_managers_list():
                 ORDER BY username
             ''').fetchall()
 
-            # Соединение глобальное, не закрываем
     return jsonify([dict(m) for m in managers])
 
 # API для смены пароля пользователя
@@ -6652,7 +6638,6 @@ def change_user_password():
     if len(new_password) < 6:
         return jsonify({'error': 'Password must be at least 6 characters'}), 400
 
-    from auth import authenticate_user, update_user_password
 
     user = get_user_by_id(session['user_id'])
     if not user:
@@ -6733,7 +6718,6 @@ def get_user_activity_logs():
                 LIMIT ? OFFSET ?
             ''', (limit, offset)).fetchall()
 
-            # Соединение глобальное, не закрываем
     return jsonify([dict(log) for log in logs])
 
 # ==================== МОДУЛЬ ПУЛА ЧАТОВ ====================
@@ -7020,10 +7004,8 @@ def move_delivery_status(delivery_id):
                         f'Перенесена доставка на статус: {new_status}', 'delivery', delivery_id)
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 # API для удаления доставки (только админ)
@@ -7037,7 +7019,6 @@ def delete_delivery(delivery_id):
     try:
         delivery = conn.execute('SELECT id, chat_id, manager_id, delivery_status, address, tracking_number, notes, created_at, updated_at FROM deliveries WHERE id = ?', (delivery_id,)).fetchone()
         if not delivery:
-            # Соединение глобальное, не закрываем
             return jsonify({'error': 'Delivery not found'}), 404
         
         conn.execute('DELETE FROM deliveries WHERE id = ?', (delivery_id,))
@@ -7046,19 +7027,14 @@ def delete_delivery(delivery_id):
                     f'Удалена доставка ID: {delivery_id}', 'delivery', delivery_id)
         
         conn.commit()
-        # Соединение глобальное, не закрываем
         return jsonify({'success': True}), 200
     except Exception as e:
-        # Соединение глобальное, не закрываем
         return jsonify({'error': str(e)}), 400
 
 # ==================== АВТОМАТИЧЕСКАЯ СИНХРОНИЗАЦИЯ И ВЕБХУКИ ====================
 
 def start_background_sync():
     """Запуск фоновой синхронизации чатов"""
-    import threading
-    import time
-    import os
     
     def sync_worker():
         """Рабочий поток для периодической синхронизации"""
@@ -7089,8 +7065,6 @@ def start_background_sync():
 
 def register_webhooks_for_all_shops():
     """Регистрация вебхуков для всех активных магазинов при старте"""
-    import os
-    from avito_api import AvitoAPI
     
     try:
         conn = get_db_connection()
@@ -7167,6 +7141,8 @@ if not hasattr(app, '_background_tasks_started'):
         register_webhooks_for_all_shops()
         # Запускаем автоматическую синхронизацию
         start_background_sync()
+        # Поток-писатель журнала действий заодно периодически выполняет PRAGMA optimize
+        _ensure_activity_writer()
         app._background_tasks_started = True
         app.logger.info("[INIT] Фоновые задачи запущены")
     except Exception as e:
@@ -20,7 +20,18 @@ OSAGAMING CRM - Модуль аутентификации и авторизац
 import hashlib
 import secrets
 import string
-from database import get_db_connection
+import threading
+import time
+from collections import OrderedDict
+from database import get_db_connection, get_db_reader
+
+# Кэш пользователя и его видимости вкладок для шаблонов (inject_user):
+# страница не ходит в БД на каждый рендер. Запись сбрасывается через
+# invalidate_user_cache() при изменении пользователя или его настроек
+_USER_BUNDLE_TTL = 60
+_USER_BUNDLE_MAXSIZE = 1024
+_user_bundle_cache = OrderedDict()  # user_id -> (момент истечения, (user, tab_visibility))
+_user_bundle_lock = threading.Lock()
 
 
 def hash_password(password):
@@ -85,11 +96,11 @@ def update_user_password(user_id, new_password):
             WHERE id = ?
         ''', (hash_password(new_password), user_id))
         conn.commit()
+        invalidate_user_cache(user_id)
         return True
     except Exception as e:
         print(f"Ошибка обновления пароля: {e}")
         return False
-    # Соединение глобальное, не закрываем
 
 
 def verify_password(password, hashed):
@@ -146,7 +157,6 @@ def authenticate_user(email, password):
     ).fetchone()
 
     if not user:
-        # Соединение глобальное, не закрываем
         return None
 
     user_dict = dict(user)
@@ -162,10 +172,8 @@ def authenticate_user(email, password):
         temp_password_used = True
         user_dict['temp_password_used'] = True
     else:
-        # Соединение глобальное, не закрываем
         return None
 
-    # Соединение глобальное, не закрываем
     return user_dict
 
 
@@ -207,12 +215,62 @@ def get_user_by_id(user_id):
         'SELECT id, username, email, role, is_active, kpi_score, password_changed FROM users WHERE id = ?',
         (user_id,)
     ).fetchone()
-    # Соединение глобальное, не закрываем
 
     # Преобразуем в словарь или возвращаем None
     return dict(user) if user else None
 
 
+def get_user_bundle(user_id):
+    """
+    Пользователь и его настройки видимости вкладок одним запросом
+    
+    Результат кэшируется в памяти процесса на _USER_BUNDLE_TTL секунд.
+    Поля пользователя те же, что у get_user_by_id().
+    
+    Args:
+        user_id (int): ID пользователя
+    
+    Returns:
+        tuple: (user, tab_visibility) - словарь пользователя или None, если он
+               не найден, и JSON строка tab_visibility из user_settings или None
+    """
+    now = time.monotonic()
+    with _user_bundle_lock:
+        entry = _user_bundle_cache.get(user_id)
+        if entry is not None and entry[0] > now:
+            _user_bundle_cache.move_to_end(user_id)
+            user, tab_visibility = entry[1]
+            return (dict(user) if user else None), tab_visibility
+    
+    with get_db_reader() as conn:
+        row = conn.execute('''
+            SELECT u.id, u.username, u.email, u.role, u.is_active, u.kpi_score, u.password_changed,
+                   s.tab_visibility
+            FROM users u
+            LEFT JOIN user_settings s ON s.user_id = u.id
+            WHERE u.id = ?
+        ''', (user_id,)).fetchone()
+    
+    if row:
+        user = dict(row)
+        tab_visibility = user.pop('tab_visibility')
+    else:
+        user, tab_visibility = None, None
+    
+    with _user_bundle_lock:
+        _user_bundle_cache[user_id] = (now + _USER_BUNDLE_TTL, (user, tab_visibility))
+        _user_bundle_cache.move_to_end(user_id)
+        while len(_user_bundle_cache) > _USER_BUNDLE_MAXSIZE:
+            _user_bundle_cache.popitem(last=False)
+    return (dict(user) if user else None), tab_visibility
+
+
+def invalidate_user_cache(user_id):
+    """Сбросить кэш get_user_bundle() для пользователя"""
+    with _user_bundle_lock:
+        _user_bundle_cache.pop(user_id, None)
+
+
 def get_user_settings(user_id):
     """
     Получение настроек пользователя
@@ -246,7 +304,6 @@ def get_user_settings(user_id):
         'SELECT id, user_id, theme, colors, sound_alerts, push_notifications, tab_visibility FROM user_settings WHERE user_id = ?',
         (user_id,)
     ).fetchone()
-    # Соединение глобальное, не закрываем
 
     # Преобразуем в словарь или возвращаем None
     return dict(settings) if settings else None
\ No newline at end of file
@@ -14,7 +14,7 @@ from datetime import datetime
 # Добавляем путь к backend
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from avito_api import AvitoAPI
+from avito_api import get_avito_api
 from services.sync_service import SyncService
 
 # Настройка логирования
@@ -67,10 +67,7 @@ def sync_shop_chats(shop, conn):
     logger.info(f"Синхронизация магазина: {shop['name']} (ID: {shop['id']})")
     
     try:
-        api = AvitoAPI(
-            client_id=shop['client_id'],
-            client_secret=shop['client_secret']
-        )
+        api = get_avito_api(shop['client_id'], shop['client_secret'])
         
         # Используем SyncService для правильного сохранения listing_data из context.value
         sync_service = SyncService(conn, api)
@@ -108,9 +108,13 @@ WEBHOOK:
 - v3/v2: остальные методы с fallback для обратной совместимости
 """
 
+import os
 import requests
+from requests.adapters import HTTPAdapter
+import threading
 import time
 import logging
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any
 import hashlib
@@ -119,6 +123,11 @@ from urllib.parse import urlencode
 
 logger = logging.getLogger('app')  # Используем тот же logger, что и в app.py для консистентности
 
+# Размер пула соединений сессии: клиент разделяется потоками пула в
+# extract-all-product-urls (EXTRACT_MAX_WORKERS), при стандартных 10 соединениях
+# лишние сокеты закрывались бы после каждого запроса
+HTTP_POOL_SIZE = int(os.environ.get('AVITO_HTTP_POOL_SIZE', '16'))
+
 
 class AvitoAPI:
     """
@@ -147,6 +156,11 @@ class AvitoAPI:
         self.access_token = None
         self.token_expires_at = None
         self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Клиент разделяется между потоками (см. get_avito_api) - токен обновляет один поток
+        self._token_lock = threading.Lock()
         # Быстрый флаг наличия корректных ключей
         self._has_credentials = bool(self.client_id and self.client_secret)
 
@@ -168,10 +182,22 @@ class AvitoAPI:
             raise ValueError("Отсутствуют client_id/client_secret для Avito API")
 
         # Проверяем, не истек ли текущий токен
-        if self.access_token and self.token_expires_at:
-            if datetime.now() < self.token_expires_at - timedelta(minutes=5):
-                return self.access_token
+        if self._token_is_fresh():
+            return self.access_token
         
+        with self._token_lock:
+            # Пока ждали блокировку, токен мог обновить другой поток
+            if self._token_is_fresh():
+                return self.access_token
+            return self._request_access_token()
+
+    def _token_is_fresh(self) -> bool:
+        """Текущий токен есть и до его истечения больше 5 минут"""
+        return bool(self.access_token and self.token_expires_at
+                    and datetime.now() < self.token_expires_at - timedelta(minutes=5))
+
+    def _request_access_token(self) -> str:
+        """Запросить новый access_token у Avito и сохранить его вместе со сроком действия"""
         try:
             # Запрос токена
             response = self.session.post(
@@ -3165,3 +3191,40 @@ class AvitoAPI:
             logger.error(f"Ошибка отправки изображения с image_id={image_id}: {e}")
             raise
 
+
+# Кэш клиентов на процесс: один AvitoAPI (и его requests.Session с keep-alive
+# соединениями и access_token) на пару ключей вместо нового клиента на каждый запрос.
+# Ограничен по размеру (LRU): ключи магазинов меняются и удаляются, а клиенты
+# со старыми ключами не должны копиться до перезапуска процесса
+_API_CACHE_SIZE = int(os.environ.get('AVITO_API_CACHE_SIZE', '64'))
+_api_cache: "OrderedDict[tuple, AvitoAPI]" = OrderedDict()
+_api_cache_lock = threading.Lock()
+
+
+def get_avito_api(client_id: str, client_secret: str) -> AvitoAPI:
+    """
+    Получить общий для процесса клиент AvitoAPI для пары ключей
+    
+    При смене client_secret клиент со старым секретом удаляется из кэша;
+    сверх _API_CACHE_SIZE вытесняется давно не использованный клиент.
+    
+    Args:
+        client_id: Client ID магазина
+        client_secret: Client Secret магазина
+    
+    Returns:
+        AvitoAPI: Клиент, переиспользуемый между запросами и потоками
+    """
+    key = (client_id, client_secret)
+    with _api_cache_lock:
+        api = _api_cache.get(key)
+        if api is not None:
+            _api_cache.move_to_end(key)
+            return api
+        # Ключи магазина изменились - клиент со старым секретом больше не нужен
+        for stale_key in [k for k in _api_cache if k[0] == client_id]:
+            del _api_cache[stale_key]
+        api = _api_cache[key] = AvitoAPI(client_id=client_id, client_secret=client_secret)
+        while len(_api_cache) > _API_CACHE_SIZE:
+            _api_cache.popitem(last=False)
+    return api
@@ -17,6 +17,9 @@ OSAGAMING CRM - Модуль работы с базой данных
 import sqlite3
 import json
 import os
+import queue
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 import hashlib
 
@@ -253,6 +256,12 @@ def init_database():
     except Exception:
         pass
 
+    # Время последней синхронизации сообщений чата (GET /messages?sync=true)
+    try:
+        cursor.execute('ALTER TABLE avito_chats ADD COLUMN last_sync_at TIMESTAMP')
+    except Exception:
+        pass
+
     # Таблица сообщений
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS avito_messages (
@@ -275,6 +284,42 @@ def init_database():
     except:
         pass  # Колонка уже существует
 
+    # Счетчик сообщений чата: total в GET /messages читается одной строкой
+    # avito_chats вместо COUNT(*) по avito_messages. Поддерживается триггерами.
+    try:
+        cursor.execute('ALTER TABLE avito_chats ADD COLUMN message_count INTEGER DEFAULT 0')
+        cursor.execute('''
+            UPDATE avito_chats
+            SET message_count = (SELECT COUNT(*) FROM avito_messages m WHERE m.chat_id = avito_chats.id)
+        ''')
+        print("[MIGRATION] ✅ Добавлена колонка message_count в таблицу avito_chats")
+    except sqlite3.OperationalError:
+        pass  # Колонка уже существует
+    
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_messages_count_insert
+    AFTER INSERT ON avito_messages
+    BEGIN
+        UPDATE avito_chats SET message_count = message_count + 1 WHERE id = NEW.chat_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_messages_count_delete
+    AFTER DELETE ON avito_messages
+    BEGIN
+        UPDATE avito_chats SET message_count = message_count - 1 WHERE id = OLD.chat_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_messages_count_move
+    AFTER UPDATE OF chat_id ON avito_messages
+    WHEN OLD.chat_id IS NOT NEW.chat_id
+    BEGIN
+        UPDATE avito_chats SET message_count = message_count - 1 WHERE id = OLD.chat_id;
+        UPDATE avito_chats SET message_count = message_count + 1 WHERE id = NEW.chat_id;
+    END
+    ''')
+
     # Таблица объявлений
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS avito_listings (
@@ -897,6 +942,20 @@ def init_database():
         "CREATE INDEX IF NOT EXISTS idx_chats_updated_at ON avito_chats(updated_at DESC)",
         "CREATE INDEX IF NOT EXISTS idx_chats_client_phone ON avito_chats(client_phone)",
         "CREATE INDEX IF NOT EXISTS idx_chats_shop_status ON avito_chats(shop_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_chats_shop_updated_id ON avito_chats(shop_id, updated_at DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_chats_updated_id ON avito_chats(updated_at DESC, id DESC)",
+        # Частичный индекс для выборок extract-all-product-urls(-internal): страница
+        # и COUNT читают только чаты без URL. Условие запросов должно совпадать
+        # с условием индекса, иначе SQLite его не применит
+        "CREATE INDEX IF NOT EXISTS idx_chats_without_product_url ON avito_chats(id) WHERE product_url IS NULL OR product_url = ''",
+        # Покрывающий индекс для счетчиков get_system_stats: агрегат по всем чатам
+        # читает узкий индекс вместо строк таблицы с текстами сообщений
+        "CREATE INDEX IF NOT EXISTS idx_chats_stats ON avito_chats(status, priority, assigned_manager_id, unread_count, response_timer)",
+        # Покрывающий индекс для предзагрузки страницы в sync_chats_from_avito
+        # (SELECT id, shop_id, chat_id ... WHERE chat_id IN (...)): поиск по chat_id
+        # отвечает из индекса, не читая строки таблицы. Отдельный индекс по
+        # chat_id не нужен - его дает ограничение UNIQUE
+        "CREATE INDEX IF NOT EXISTS idx_chats_chat_shop ON avito_chats(chat_id, shop_id)",
         
         # Индексы для таблицы сообщений
         "CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON avito_messages(chat_id)",
@@ -925,7 +984,12 @@ def init_database():
 
         # Индексы для магазинов (OAuth)
         "CREATE INDEX IF NOT EXISTS idx_shops_user_id ON avito_shops(user_id)",
-        "CREATE INDEX IF NOT EXISTS idx_shops_status ON avito_shops(is_active, token_status)"
+        "CREATE INDEX IF NOT EXISTS idx_shops_status ON avito_shops(is_active, token_status)",
+
+        # Индексы для сохраненных объявлений: страница get_saved_listings с фильтром
+        # по менеджеру/статусу читается диапазоном индекса, а не полным сканом таблицы
+        "CREATE INDEX IF NOT EXISTS idx_listings_manager_status_id ON avito_listings(assigned_manager_id, status, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_listings_status_id ON avito_listings(status, id DESC)"
     ]
     
     for index_sql in indexes:
@@ -935,62 +999,239 @@ def init_database():
             print(f"[WARNING] Не удалось создать индекс: {e}")
     
     conn.commit()
+    
+    # Статистика для планировщика запросов: без нее SQLite выбирает индексы
+    # наугад. Полный ANALYZE (с ограничением выборки) - только если статистики
+    # еще нет, дальше PRAGMA optimize обновляет ее лишь при необходимости
+    try:
+        has_stats = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+        ).fetchone()
+        if not has_stats:
+            cursor.execute('PRAGMA analysis_limit=400')
+            cursor.execute('ANALYZE')
+        cursor.execute('PRAGMA optimize')
+        conn.commit()
+    except Exception as e:
+        print(f"[WARNING] Не удалось обновить статистику планировщика: {e}")
+    
     conn.close()
     print("[OK] CRM база данных инициализирована с индексами")
 
 
-# Глобальное соединение с базой данных (всегда открыто)
-_global_db_connection = None
+# Первичный код SQLITE_IOERR. Расширенные коды (SQLITE_IOERR_READ = 266,
+# SQLITE_IOERR_FSYNC = 1034 и т.д.) отличаются только старшими байтами
+SQLITE_IOERR = 10
 
-def get_db_connection():
+
+def is_sqlite_io_error(error) -> bool:
+    """
+    Проверка, что ошибка SQLite - disk I/O error (любой код семейства SQLITE_IOERR)
+
+    Использует структурированный sqlite_errorcode (Python 3.11+) вместо
+    сопоставления текста ошибки; текст проверяется, только если кода нет.
+    """
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return (code & 0xFF) == SQLITE_IOERR
+    return 'i/o error' in str(error).lower()
+
+
+# Размер кэша подготовленных выражений на соединение (по умолчанию в sqlite3 - 128):
+# запросы-константы обработчиков не вытесняют друг друга и не парсятся повторно
+_STATEMENT_CACHE_SIZE = 256
+
+# Соединение для записи закрепляется за потоком (threading.local): обработчики
+# разных запросов не делят одно соединение и его мьютекс, а конкурентную запись
+# SQLite разводит через busy_timeout. По завершении запроса соединение
+# возвращается в пул release_db_connection(); чтение в горячих GET-запросах
+# идет через отдельный пул get_db_reader()
+_thread_db = threading.local()
+_DB_POOL_SIZE = max(1, int(os.environ.get('DB_POOL_SIZE', '8')))
+_db_pool = queue.LifoQueue(maxsize=_DB_POOL_SIZE)
+
+# Пул соединений только для чтения. В WAL режиме читатели не блокируют
+# писателя и друг друга, поэтому несколько GET-запросов выполняются параллельно.
+_READ_POOL_SIZE = max(1, int(os.environ.get('DB_READ_POOL_SIZE', '4')))
+_read_pool = queue.LifoQueue(maxsize=_READ_POOL_SIZE)
+_read_pool_slots = threading.BoundedSemaphore(_READ_POOL_SIZE)
+
+
+def _apply_connection_pragmas(conn):
+    """
+    Настройка соединения для конкурентной работы
+    
+    - journal_mode=WAL: читатели не блокируют писателя
+    - synchronous=NORMAL: безопасно в WAL и заметно быстрее FULL
+    - busy_timeout: ждать освобождения блокировки вместо "database is locked"
+    - cache_size/temp_store: больше кэша страниц, временные таблицы в памяти
+    """
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=30000')  # 30 секунд timeout
+        conn.execute('PRAGMA cache_size=-64000')  # ~64MB
+        conn.execute('PRAGMA temp_store=MEMORY')
+    except Exception:
+        pass  # Игнорируем ошибки при установке PRAGMA
+
+
+def _open_reader_connection():
+    """Открыть новое соединение только для чтения для пула"""
+    conn = sqlite3.connect(_DB_PATH, timeout=30.0, check_same_thread=False,
+                       cached_statements=_STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row
+    _apply_connection_pragmas(conn)
+    try:
+        conn.execute('PRAGMA query_only=ON')
+    except Exception:
+        pass
+    return conn
+
+
+def open_writer_connection():
+    """
+    Открыть отдельное соединение для записи из фонового потока
+    
+    В отличие от get_db_connection(), соединение не разделяется с обработчиками
+    запросов, поэтому commit/rollback фонового потока не затрагивает их
+    незавершенные транзакции. Блокировку записи SQLite такое соединение
+    ожидает через busy_timeout. Закрывать соединение должен владелец.
+    
+    Returns:
+        sqlite3.Connection: Новое соединение с базой данных
+    """
+    conn = sqlite3.connect(_DB_PATH, timeout=30.0, check_same_thread=False,
+                           cached_statements=_STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row
+    _apply_connection_pragmas(conn)
+    return conn
+
+
+@contextmanager
+def get_db_reader():
     """
-    Получение глобального соединения с базой данных
+    Получение соединения только для чтения из пула
+    
+    Используется в GET-обработчиках, которые ничего не пишут в БД.
+    Количество одновременно выданных соединений ограничено DB_READ_POOL_SIZE
+    (по умолчанию 4); соединение возвращается в пул при выходе из блока.
+    Соединение, на котором произошла ошибка SQLite, закрывается.
     
-    Использует одно глобальное соединение, которое всегда открыто.
-    Это предотвращает ошибки "database is locked" при быстрых запросах.
+    Использование:
+        with get_db_reader() as conn:
+            rows = conn.execute('SELECT ...').fetchall()
     
+    Yields:
+        sqlite3.Connection: Соединение с PRAGMA query_only=ON
+    """
+    _read_pool_slots.acquire()
+    conn = None
+    try:
+        try:
+            conn = _read_pool.get_nowait()
+        except queue.Empty:
+            conn = _open_reader_connection()
+        yield conn
+    except sqlite3.Error:
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            conn = None
+        raise
+    finally:
+        if conn is not None:
+            try:
+                # Завершаем неявную транзакцию чтения, чтобы не удерживать снимок WAL
+                conn.rollback()
+                _read_pool.put_nowait(conn)
+            except Exception:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        _read_pool_slots.release()
+
+def _is_connection_alive(conn):
+    """Проверить, что соединение не закрыто (без запроса к БД)"""
+    try:
+        # total_changes не требует чтения с диска, только проверяет состояние соединения
+        _ = conn.total_changes
+        return True
+    except (sqlite3.ProgrammingError, sqlite3.OperationalError, AttributeError):
+        return False
+
+
+def get_db_connection():
+    """
+    Получение соединения с базой данных текущего потока
+
+    Каждый поток (обработчик запроса, фоновая синхронизация) получает свое
+    соединение; повторные вызовы в том же потоке возвращают то же соединение.
+    Соединения переиспользуются через пул, поэтому открытие файла БД и PRAGMA
+    не повторяются на каждый запрос.
+
     Настройки:
         - row_factory = sqlite3.Row: Позволяет обращаться к колонкам по имени
         - WAL режим: Включается для лучшей параллельной работы
         - timeout: 30 секунд для операций с БД
-    
+
     Важно:
-        - Соединение создается один раз и переиспользуется
         - НЕ закрывайте соединение вручную (conn.close())
+        - В конце запроса соединение возвращается в пул (release_db_connection)
         - Соединение автоматически переподключается при ошибках
-    
+
     Returns:
-        sqlite3.Connection: Глобальное соединение с базой данных
+        sqlite3.Connection: Соединение с базой данных текущего потока
     """
-    global _global_db_connection
-    
-    # Если соединение существует, проверяем его валидность
-    if _global_db_connection is not None:
-        # Проверяем, что соединение не закрыто (простая проверка без запроса к БД)
-        # Это избегает проблем с disk I/O при проверке
+    conn = getattr(_thread_db, 'conn', None)
+    if conn is not None:
+        if _is_connection_alive(conn):
+            return conn
+        # Соединение закрыто или повреждено, создаем новое
+        _thread_db.conn = None
+
+    while True:
         try:
-            # Простая проверка - пытаемся получить total_changes
-            # Это не требует чтения с диска, только проверяет состояние соединения
-            _ = _global_db_connection.total_changes
-            return _global_db_connection
-        except (sqlite3.ProgrammingError, sqlite3.OperationalError, AttributeError) as e:
-            # Соединение закрыто или повреждено, создаем новое
-            error_msg = str(e).lower()
-            # Если это disk I/O error, закрываем соединение и создаем новое
-            if "disk i/o error" in error_msg or "i/o error" in error_msg:
-                try:
-                    _global_db_connection.close()
-                except:
-                    pass
-                # Сбрасываем глобальное соединение
-                _global_db_connection = None
-                # Небольшая задержка перед повторной попыткой
-                import time
-                time.sleep(0.1)
-            else:
-                # Для других ошибок тоже сбрасываем соединение
-            _global_db_connection = None
-    
+            conn = _db_pool.get_nowait()
+        except queue.Empty:
+            break
+        if _is_connection_alive(conn):
+            _thread_db.conn = conn
+            return conn
+
+    conn = _open_db_connection()
+    _thread_db.conn = conn
+    return conn
+
+
+def release_db_connection():
+    """
+    Вернуть соединение текущего потока в пул
+
+    Незавершенная транзакция (обработчик упал до commit) откатывается, чтобы
+    не попасть в чужой commit. Если пул заполнен, соединение закрывается.
+    Вызывается в teardown_appcontext приложения.
+    """
+    conn = getattr(_thread_db, 'conn', None)
+    if conn is None:
+        return
+    _thread_db.conn = None
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        _db_pool.put_nowait(conn)
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def _open_db_connection():
+    """Открыть новое соединение с базой данных для записи"""
     # Убеждаемся, что директория существует
     db_dir = os.path.dirname(_DB_PATH)
     if not os.path.exists(db_dir):
@@ -1020,7 +1261,8 @@ def get_db_connection():
     
     # Подключаемся к базе данных с обработкой ошибок
     try:
-        conn = sqlite3.connect(_DB_PATH, timeout=30.0, check_same_thread=False)
+        conn = sqlite3.connect(_DB_PATH, timeout=30.0, check_same_thread=False,
+                        cached_statements=_STATEMENT_CACHE_SIZE)
     except sqlite3.OperationalError as e:
         error_msg = str(e).lower()
         if "unable to open database file" in error_msg:
@@ -1048,7 +1290,7 @@ def get_db_connection():
                 f"4. Check disk space: df -h {db_dir}"
             )
             raise RuntimeError(error_details) from e
-        elif "disk i/o error" in error_msg or "i/o error" in error_msg:
+        elif is_sqlite_io_error(e):
             # Disk I/O error - может быть временной проблемой
             # Пробуем переподключиться после небольшой задержки
             import time
@@ -1057,7 +1299,8 @@ def get_db_connection():
             logger.warning(f"Disk I/O error detected, attempting to reconnect: {e}")
             time.sleep(0.1)  # Небольшая задержка перед повторной попыткой
             try:
-                conn = sqlite3.connect(_DB_PATH, timeout=30.0, check_same_thread=False)
+                conn = sqlite3.connect(_DB_PATH, timeout=30.0, check_same_thread=False,
+                                cached_statements=_STATEMENT_CACHE_SIZE)
             except sqlite3.OperationalError as retry_error:
                 error_details = (
                     f"Disk I/O error when connecting to database: {_DB_PATH}\n"
@@ -1083,19 +1326,28 @@ def get_db_connection():
     conn.row_factory = sqlite3.Row
     
     # Включаем WAL режим для лучшей параллельной работы
-    try:
-        conn.execute('PRAGMA journal_mode=WAL')
-        conn.execute('PRAGMA synchronous=NORMAL')
-        conn.execute('PRAGMA busy_timeout=30000')  # 30 секунд timeout
-    except:
-        pass  # Игнорируем ошибки при установке PRAGMA
-    
-    # Сохраняем глобальное соединение
-    _global_db_connection = conn
+    _apply_connection_pragmas(conn)
     
     return conn
 
 
+def reset_db_connection():
+    """
+    Закрыть и сбросить соединение текущего потока с базой данных
+    
+    Следующий вызов get_db_connection() откроет новое соединение.
+    Используется после disk I/O ошибок, когда соединение формально открыто,
+    но дальнейшие запросы через него будут падать.
+    """
+    conn = getattr(_thread_db, 'conn', None)
+    if conn is not None:
+        _thread_db.conn = None
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
 def execute_with_retry(query_func, max_retries=3, retry_delay=0.1):
     """
     Выполнить функцию с запросом к БД с повторными попытками при disk I/O ошибках
@@ -1119,16 +1371,9 @@ def execute_with_retry(query_func, max_retries=3, retry_delay=0.1):
         try:
             return query_func()
         except sqlite3.OperationalError as e:
-            error_msg = str(e).lower()
-            if ("disk i/o error" in error_msg or "i/o error" in error_msg) and attempt < max_retries - 1:
+            if is_sqlite_io_error(e) and attempt < max_retries - 1:
                 # Переподключаемся к БД
-                global _global_db_connection
-                if _global_db_connection is not None:
-                    try:
-                        _global_db_connection.close()
-                    except:
-                        pass
-                    _global_db_connection = None
+                reset_db_connection()
                 
                 logger.warning(f"Disk I/O error on attempt {attempt + 1}/{max_retries}, retrying...")
                 time.sleep(retry_delay * (attempt + 1))  # Увеличиваем задержку с каждой попыткой
@@ -11,7 +11,8 @@ import logging
 import sqlite3
 from typing import Dict, Optional, Tuple, Any
 from database import get_db_connection
-from avito_api import AvitoAPI
+from avito_api import get_avito_api
+from utils.helpers import normalize_avito_url
 
 logger = logging.getLogger(__name__)
 
@@ -131,7 +132,7 @@ class ChatListingService:
         """Извлечь данные об объявлении из context чата"""
         try:
             logger.info(f"[CHAT LISTING SERVICE] Запрос к API get_chat_by_id для чата {avito_chat_id}...")
-            api = AvitoAPI(client_id=client_id, client_secret=client_secret)
+            api = get_avito_api(client_id, client_secret)
             chat_info = api.get_chat_by_id(user_id=str(avito_user_id), chat_id=str(avito_chat_id))
             
             if not isinstance(chat_info, dict):
@@ -211,7 +212,7 @@ class ChatListingService:
                                       shop_url: Optional[str] = None) -> Optional[str]:
         """Извлечь product_url из Avito API для чата"""
         try:
-            api = AvitoAPI(client_id=client_id, client_secret=client_secret)
+            api = get_avito_api(client_id, client_secret)
             
             try:
                 chat_details = api.get_chat_by_id(user_id=avito_user_id, chat_id=avito_chat_id)
@@ -221,8 +222,7 @@ class ChatListingService:
                     if isinstance(value, dict):
                         url = value.get('url')
                         if url:
-                            return f"https://www.avito.ru{url}" if url.startswith('/') else (
-                                f"https://www.avito.ru/{url}" if not url.startswith('http') else url)
+                            return normalize_avito_url(url)
             except Exception as e:
                 if '404' in str(e):
                     try:
@@ -240,8 +240,7 @@ class ChatListingService:
                                     if isinstance(context_item, dict):
                                         url = context_item.get('url')
                                         if url:
-                                            return f"https://www.avito.ru{url}" if url.startswith('/') else (
-                                                f"https://www.avito.ru/{url}" if not url.startswith('http') else url)
+                                            return normalize_avito_url(url)
                                     break
                     except Exception:
                         pass
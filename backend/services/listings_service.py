@@ -4,9 +4,51 @@ Listings Service - работа с объявлениями Avito
 import logging
 from typing import List, Dict, Optional, Tuple
 from datetime import datetime
+from time import perf_counter
+
+from utils.helpers import check_name_columns
 
 logger = logging.getLogger(__name__)
 
+# Результаты изменения объявления с проверкой доступа менеджера
+LISTING_OK = 'ok'
+LISTING_NOT_FOUND = 'not_found'
+LISTING_FORBIDDEN = 'forbidden'
+
+# UPSERT по UNIQUE(listing_id) (SQLite 3.24+): повторно найденное объявление
+# обновляет данные из поиска, а статус, менеджер и заметки остаются прежними
+_SQL_UPSERT_LISTING = '''
+    INSERT INTO avito_listings (
+        listing_id, title, price, url, image_url, location,
+        description, category, status, param_id
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'new', ?)
+    ON CONFLICT(listing_id) DO UPDATE SET
+        title = excluded.title,
+        price = excluded.price,
+        url = excluded.url,
+        image_url = excluded.image_url,
+        location = excluded.location,
+        description = excluded.description,
+        category = excluded.category,
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+
+def build_listing_row(listing: Dict, param_id: Optional[int] = None) -> tuple:
+    """Параметры INSERT для объявления (порядок колонок _SQL_UPSERT_LISTING)"""
+    return (
+        listing.get('listing_id', 'unknown'),
+        listing.get('title', ''),
+        listing.get('price', 0),
+        listing.get('url', ''),
+        listing.get('image_url', ''),
+        listing.get('location', ''),
+        listing.get('description', ''),
+        listing.get('category', ''),
+        param_id
+    )
+
 
 class ListingsService:
     """Сервис для работы с объявлениями"""
@@ -31,21 +73,17 @@ class ListingsService:
         Returns:
             Dict: Результаты поиска
         """
-        logger.info(f"[LISTINGS SERVICE] Начало поиска объявлений через публичный парсер")
-        logger.debug(f"[LISTINGS SERVICE] Параметры: query='{query}', category_id={category_id}, "
-                    f"location_id={location_id}, price_min={price_min}, price_max={price_max}, limit={limit}")
+        logger.debug("[LISTINGS SERVICE] Поиск через публичный парсер: query='%s', category_id=%s, "
+                     "location_id=%s, price_min=%s, price_max=%s, limit=%s",
+                     query, category_id, location_id, price_min, price_max, limit)
         
         from avito_public_parser import AvitoPublicParser
         
         try:
-            logger.debug(f"[LISTINGS SERVICE] Создание экземпляра AvitoPublicParser...")
             parser = AvitoPublicParser()
-            logger.debug(f"[LISTINGS SERVICE] AvitoPublicParser создан успешно")
             
-            import time
-            start_time = time.time()
+            start_time = perf_counter()
             
-            logger.info(f"[LISTINGS SERVICE] Вызов parser.search_listings()...")
             results = parser.search_listings(
                 query=query,
                 category_id=category_id,
@@ -55,40 +93,41 @@ class ListingsService:
                 limit=limit
             )
             
-            elapsed_time = time.time() - start_time
+            elapsed_time = perf_counter() - start_time
             listings = results.get('listings', [])
             listings_count = len(listings)
             total = results.get('total', 0)
             
-            logger.info(f"[LISTINGS SERVICE] Поиск завершен за {elapsed_time:.2f} сек. "
-                       f"Найдено объявлений: {listings_count}, total: {total}")
+            logger.info("[LISTINGS SERVICE] Поиск завершен за %.2f сек. Найдено объявлений: %d, total: %s",
+                        elapsed_time, listings_count, total)
             
-            if listings_count > 0:
+            if listings_count > 0 and logger.isEnabledFor(logging.DEBUG):
                 # Логируем примеры найденных объявлений
                 sample_listings = listings[:3]  # Первые 3 для примера
-                logger.debug(f"[LISTINGS SERVICE] Примеры найденных объявлений:")
+                logger.debug("[LISTINGS SERVICE] Примеры найденных объявлений:")
                 for idx, listing in enumerate(sample_listings, 1):
                     listing_id = listing.get('listing_id', 'N/A')
                     title = listing.get('title', 'N/A')[:60]
                     price = listing.get('price', 'N/A')
                     url = listing.get('url', 'N/A')[:80]
-                    logger.debug(f"[LISTINGS SERVICE]   {idx}. ID={listing_id}, title='{title}', "
-                                f"price={price}, url={url}")
+                    logger.debug("[LISTINGS SERVICE]   %d. ID=%s, title='%s', price=%s, url=%s",
+                                 idx, listing_id, title, price, url)
             
             if 'error' in results:
-                logger.warning(f"[LISTINGS SERVICE] В результатах есть ошибка: {results.get('error')}")
+                logger.warning("[LISTINGS SERVICE] В результатах есть ошибка: %s", results.get('error'))
             
-            logger.info(f"[LISTINGS SERVICE] Поиск завершен успешно")
             return results
             
         except Exception as e:
-            logger.error(f"[LISTINGS SERVICE] КРИТИЧЕСКАЯ ОШИБКА при поиске объявлений: {str(e)}", exc_info=True)
+            logger.error("[LISTINGS SERVICE] КРИТИЧЕСКАЯ ОШИБКА при поиске объявлений: %s", e, exc_info=True)
             return {'listings': [], 'total': 0, 'error': str(e)}
     
     def save_listing(self, listing_data: Dict, param_id: Optional[int] = None) -> int:
         """
         Сохранить объявление в БД
         
+        Не коммитит: транзакцией управляет вызывающий код.
+        
         Args:
             listing_data: Данные объявления
             param_id: ID параметров поиска (опционально)
@@ -97,61 +136,56 @@ class ListingsService:
             int: ID сохранённого объявления или 0
         """
         listing_id = listing_data.get('listing_id', 'unknown')
-        title = listing_data.get('title', '')[:50]
         
-        logger.debug(f"[LISTINGS SERVICE] Сохранение объявления: listing_id={listing_id}, "
-                    f"title='{title}', param_id={param_id}")
+        logger.debug("[LISTINGS SERVICE] Сохранение объявления: listing_id=%s, param_id=%s", listing_id, param_id)
         
         try:
-            # Проверяем, нет ли уже такого объявления
-            logger.debug(f"[LISTINGS SERVICE] Проверка существования объявления listing_id={listing_id}...")
-            existing = self.conn.execute('''
-                SELECT id FROM avito_listings 
-                WHERE listing_id = ?
-            ''', (listing_id,)).fetchone()
-            
-            if existing:
-                existing_id = existing['id']
-                logger.debug(f"[LISTINGS SERVICE] Объявление уже существует в БД с ID: {existing_id}")
-                return existing_id
-            
-            logger.debug(f"[LISTINGS SERVICE] Объявление не найдено, создание новой записи...")
-            
-            # Создаём новое
-            cursor = self.conn.execute('''
-                INSERT INTO avito_listings (
-                    listing_id, title, price, url, image_url, location,
-                    description, category, status, param_id
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'new', ?)
-            ''', (
-                listing_id,
-                listing_data.get('title', ''),
-                listing_data.get('price', 0),
-                listing_data.get('url', ''),
-                listing_data.get('image_url', ''),
-                listing_data.get('location', ''),
-                listing_data.get('description', ''),
-                listing_data.get('category', ''),
-                param_id
-            ))
-            
-            new_id = cursor.lastrowid
-            logger.debug(f"[LISTINGS SERVICE] Объявление создано в БД с ID: {new_id}")
-            
-            self.conn.commit()
-            logger.debug(f"[LISTINGS SERVICE] Изменения зафиксированы в БД")
-            
-            return new_id
+            # RETURNING (SQLite 3.35+) отдает id и для новой, и для обновленной строки
+            row = self.conn.execute(
+                _SQL_UPSERT_LISTING + ' RETURNING id', build_listing_row(listing_data, param_id)
+            ).fetchone()
+            logger.debug("[LISTINGS SERVICE] Объявление сохранено в БД с ID: %s", row['id'])
+            return row['id']
             
         except Exception as e:
-            logger.error(f"[LISTINGS SERVICE] ОШИБКА сохранения объявления listing_id={listing_id}: {str(e)}", exc_info=True)
+            logger.error("[LISTINGS SERVICE] ОШИБКА сохранения объявления listing_id=%s: %s", listing_id, e, exc_info=True)
+            return 0
+    
+    def save_listings_bulk(self, listings: List[Dict], param_id: Optional[int] = None) -> int:
+        """
+        Сохранить пачку объявлений одним executemany
+        
+        Не коммитит: вызывающий код открывает BEGIN IMMEDIATE и делает один
+        COMMIT на всю пачку (один fsync вместо коммита на каждое объявление).
+        Уже сохранённые объявления (по listing_id) обновляются, как и в save_listing.
+        Ошибки пробрасываются, чтобы вызывающий код откатил транзакцию.
+        
+        Args:
+            listings: Список данных объявлений
+            param_id: ID параметров поиска (опционально)
+        
+        Returns:
+            int: Количество добавленных или обновлённых объявлений
+        """
+        if not listings:
             return 0
+        
+        # Строки строятся лениво: executemany забирает их из генератора по одной,
+        # промежуточный список кортежей не создается
+        cursor = self.conn.executemany(
+            _SQL_UPSERT_LISTING,
+            (build_listing_row(listing, param_id) for listing in listings)
+        )
+        logger.debug("[LISTINGS SERVICE] Сохранено объявлений: %d", cursor.rowcount)
+        return cursor.rowcount
     
     def save_search_params(self, params: Dict, user_id: int) -> int:
         """
         Сохранить параметры поиска
         
+        Не коммитит: транзакцией управляет вызывающий код. Ошибки
+        пробрасываются, чтобы вызывающий код откатил транзакцию.
+        
         Args:
             params: Параметры поиска
             user_id: ID пользователя
@@ -159,13 +193,10 @@ class ListingsService:
         Returns:
             int: ID сохранённых параметров
         """
-        logger.debug(f"[LISTINGS SERVICE] Сохранение параметров поиска для user_id={user_id}")
-        logger.debug(f"[LISTINGS SERVICE] Параметры: {params}")
+        logger.debug("[LISTINGS SERVICE] Сохранение параметров поиска для user_id=%s: %s", user_id, params)
         
         try:
             name = params.get('name', 'Поиск ' + datetime.now().strftime('%Y-%m-%d %H:%M'))
-            logger.debug(f"[LISTINGS SERVICE] Имя параметров поиска: '{name}'")
-            
             cursor = self.conn.execute('''
                 INSERT INTO search_params (
                     user_id, name, query, category_id, location_id,
@@ -184,16 +215,13 @@ class ListingsService:
             ))
             
             param_id = cursor.lastrowid
-            logger.debug(f"[LISTINGS SERVICE] Параметры поиска сохранены с ID: {param_id}")
-            
-            self.conn.commit()
-            logger.debug(f"[LISTINGS SERVICE] Изменения зафиксированы в БД")
+            logger.debug("[LISTINGS SERVICE] Параметры поиска '%s' сохранены с ID: %s", name, param_id)
             
             return param_id
             
         except Exception as e:
-            logger.error(f"[LISTINGS SERVICE] ОШИБКА сохранения параметров поиска: {str(e)}", exc_info=True)
-            return 0
+            logger.error("[LISTINGS SERVICE] ОШИБКА сохранения параметров поиска: %s", e, exc_info=True)
+            raise
     
     def get_saved_listings(self, status: str = None, assigned_manager_id: int = None,
                           limit: int = 100, offset: int = 0) -> Tuple[List[Dict], int]:
@@ -209,18 +237,11 @@ class ListingsService:
         Returns:
             Tuple[List[Dict], int]: (список объявлений, общее количество)
         """
-        logger.debug(f"[LISTINGS SERVICE] Получение сохраненных объявлений: status='{status}', "
-                    f"assigned_manager_id={assigned_manager_id}, limit={limit}, offset={offset}")
+        logger.debug("[LISTINGS SERVICE] Получение сохраненных объявлений: status='%s', "
+                     "assigned_manager_id=%s, limit=%s, offset=%s", status, assigned_manager_id, limit, offset)
         
-        # Проверяем наличие колонок first_name и last_name
-        has_name_columns = False
-        try:
-            cursor = self.conn.execute("PRAGMA table_info(users)")
-            columns_info = cursor.fetchall()
-            user_columns = [row[1] if len(row) > 1 else str(row[0]) for row in columns_info]
-            has_name_columns = 'first_name' in user_columns and 'last_name' in user_columns
-        except Exception:
-            has_name_columns = False
+        # Наличие колонок first_name и last_name (проверяется один раз на процесс)
+        has_name_columns = check_name_columns(self.conn)
         
         if has_name_columns:
             query = '''
@@ -229,7 +250,8 @@ class ListingsService:
                            NULLIF(TRIM(u.first_name || ' ' || COALESCE(u.last_name, '')), ''),
                            u.username,
                            ''
-                       ) as assigned_manager_name
+                       ) as assigned_manager_name,
+                       COUNT(*) OVER() as total_count
                 FROM avito_listings l
                 LEFT JOIN users u ON l.assigned_manager_id = u.id
                 WHERE 1=1
@@ -237,50 +259,79 @@ class ListingsService:
         else:
             query = '''
                 SELECT l.*, 
-                       COALESCE(u.username, '') as assigned_manager_name
+                       COALESCE(u.username, '') as assigned_manager_name,
+                       COUNT(*) OVER() as total_count
                 FROM avito_listings l
                 LEFT JOIN users u ON l.assigned_manager_id = u.id
                 WHERE 1=1
             '''
+        where = ''
         params = []
         
         if status:
-            query += ' AND l.status = ?'
+            where += ' AND l.status = ?'
             params.append(status)
-            logger.debug(f"[LISTINGS SERVICE] Добавлен фильтр по статусу: {status}")
         
         if assigned_manager_id:
-            query += ' AND l.assigned_manager_id = ?'
+            where += ' AND l.assigned_manager_id = ?'
             params.append(assigned_manager_id)
-            logger.debug(f"[LISTINGS SERVICE] Добавлен фильтр по менеджеру: {assigned_manager_id}")
         
-        query += ' ORDER BY l.created_at DESC LIMIT ? OFFSET ?'
-        params.extend([limit, offset])
+        # Общее количество считается окном COUNT(*) OVER() в том же запросе,
+        # из БД читается только запрошенная страница
+        # id растет вместе с created_at; сортировка по id - последняя колонка
+        # индексов idx_listings_manager_status_id / idx_listings_status_id
+        query += where + ' ORDER BY l.id DESC LIMIT ? OFFSET ?'
         
-        logger.debug(f"[LISTINGS SERVICE] Выполнение SQL запроса: {query[:200]}...")
-        logger.debug(f"[LISTINGS SERVICE] Параметры запроса: {params}")
+        logger.debug("[LISTINGS SERVICE] Выполнение SQL запроса с параметрами %s", params)
         
-        listings = self.conn.execute(query, tuple(params)).fetchall()
-        listings_count = len(listings)
-        logger.debug(f"[LISTINGS SERVICE] Получено строк из БД: {listings_count}")
+        listings = []
+        total = 0
+        for row in self.conn.execute(query, (*params, limit, offset)):
+            listing = dict(row)
+            total = listing.pop('total_count')
+            listings.append(listing)
         
-        # Подсчет общего количества
-        count_query = 'SELECT COUNT(*) as count FROM avito_listings WHERE 1=1' + 
-            (' AND status = ?' if status else '') +
-            (' AND assigned_manager_id = ?' if assigned_manager_id else '')
-        count_params = tuple([p for p in params if p not in [limit, offset]])
+        if not listings and offset > 0:
+            # Страница за концом выборки: окно не вернуло ни одной строки
+            total = self.conn.execute(
+                'SELECT COUNT(*) as count FROM avito_listings l WHERE 1=1' + where, params
+            ).fetchone()['count']
         
-        logger.debug(f"[LISTINGS SERVICE] Выполнение запроса подсчета: {count_query}")
-        logger.debug(f"[LISTINGS SERVICE] Параметры подсчета: {count_params}")
+        logger.debug("[LISTINGS SERVICE] Запрос выполнен: получено %d объявлений, всего в БД: %d",
+                     len(listings), total)
         
-        total = self.conn.execute(count_query, count_params).fetchone()['count']
+        return listings, total
+    
+    def _write_listing(self, sql: str, params: tuple, manager_id: Optional[int]) -> str:
+        """
+        UPDATE/DELETE одного объявления с проверкой доступа менеджера
         
-        logger.info(f"[LISTINGS SERVICE] Запрос выполнен: получено {listings_count} объявлений, "
-                   f"всего в БД: {total}")
+        Запрос выполняется с RETURNING assigned_manager_id (SQLite 3.35+): одна
+        запись вместо SELECT + UPDATE/DELETE, и между проверкой и изменением
+        нет окна для гонки. Если объявление назначено другому менеджеру,
+        транзакция откатывается. Ошибки БД пробрасываются.
         
-        return [dict(listing) for listing in listings], total
+        Returns:
+            str: LISTING_OK, LISTING_NOT_FOUND или LISTING_FORBIDDEN
+        """
+        if not self.conn.in_transaction:
+            self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute(sql + ' RETURNING assigned_manager_id', params).fetchone()
+            if row is None:
+                self.conn.rollback()
+                return LISTING_NOT_FOUND
+            if manager_id is not None and row['assigned_manager_id'] not in (None, manager_id):
+                self.conn.rollback()
+                return LISTING_FORBIDDEN
+            self.conn.commit()
+            return LISTING_OK
+        except Exception:
+            self.conn.rollback()
+            raise
     
-    def update_listing_status(self, listing_id: int, status: str, notes: str = None) -> bool:
+    def update_listing_status(self, listing_id: int, status: str, notes: str = None,
+                              manager_id: int = None) -> str:
         """
         Обновить статус объявления
         
@@ -288,28 +339,34 @@ class ListingsService:
             listing_id: ID объявления
             status: Новый статус
             notes: Заметки (опционально)
+            manager_id: ID менеджера, если обновлять можно только его или
+                неназначенные объявления (None - без ограничения)
         
         Returns:
-            bool: True если успешно
+            str: LISTING_OK, LISTING_NOT_FOUND или LISTING_FORBIDDEN
         """
-        try:
-            if notes:
-                self.conn.execute('''
-                    UPDATE avito_listings
-                    SET status = ?, notes = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (status, notes, listing_id))
-            else:
-                self.conn.execute('''
-                    UPDATE avito_listings
-                    SET status = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (status, listing_id))
-            
-            self.conn.commit()
-            return True
-            
-        except Exception as e:
-            logger.error(f"Ошибка обновления статуса объявления {listing_id}: {e}")
-            return False
-
+        if notes:
+            return self._write_listing('''
+                UPDATE avito_listings
+                SET status = ?, notes = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (status, notes, listing_id), manager_id)
+        return self._write_listing('''
+            UPDATE avito_listings
+            SET status = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (status, listing_id), manager_id)
+    
+    def delete_listing(self, listing_id: int, manager_id: int = None) -> str:
+        """
+        Удалить объявление
+        
+        Args:
+            listing_id: ID объявления
+            manager_id: ID менеджера, если удалять можно только его или
+                неназначенные объявления (None - без ограничения)
+        
+        Returns:
+            str: LISTING_OK, LISTING_NOT_FOUND или LISTING_FORBIDDEN
+        """
+        return self._write_listing('DELETE FROM avito_listings WHERE id = ?', (listing_id,), manager_id)
@@ -1,12 +1,36 @@
 """
 Messenger Service - работа с чатами и сообщениями Avito
 """
+import atexit
 import logging
 import os
+import queue
 from typing import List, Dict, Optional, Tuple
 from datetime import datetime, timezone
 import re
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from utils.helpers import check_name_columns
+
+# Порядок списка чатов, общий для offset- и курсорного режима: сначала чаты с
+# идущим таймером ответа (больший таймер выше), затем более свежие. NULL в
+# response_timer/updated_at заменены значениями, которые сортируются последними:
+# строка с NULL иначе выпадала бы из сравнения row value в курсорном режиме
+_CHAT_SORT_COLUMNS = (
+    'CASE WHEN c.response_timer > 0 THEN 1 ELSE 0 END',
+    'COALESCE(c.response_timer, 0)',
+    "COALESCE(c.updated_at, '')",
+    'c.id',
+)
+_CHAT_ORDER_BY = ', '.join(f'{column} DESC' for column in _CHAT_SORT_COLUMNS)
+_CHAT_SORT_KEY_SQL = '(' + ', '.join(_CHAT_SORT_COLUMNS) + ')'
+
+
+def chat_sort_key(chat: Dict) -> List:
+    """Ключ сортировки строки чата - те же значения, что _CHAT_SORT_COLUMNS в SQL"""
+    response_timer = chat.get('response_timer') or 0
+    return [1 if response_timer > 0 else 0, response_timer, chat.get('updated_at') or '', chat.get('id')]
+
 
 # Настраиваем logger так же, как в app.py
 logger = logging.getLogger('app')
@@ -25,7 +49,6 @@ if not logger.handlers:
         '%(asctime)s [%(levelname)s] %(name)s: %(message)s [in %(pathname)s:%(lineno)d]'
     ))
     file_handler.setLevel(logging.INFO)
-    logger.addHandler(file_handler)
     
     # Также выводим в консоль
     console_handler = logging.StreamHandler()
@@ -33,7 +56,14 @@ if not logger.handlers:
         '%(asctime)s [%(levelname)s] %(message)s'
     ))
     console_handler.setLevel(logging.INFO)
-    logger.addHandler(console_handler)
+    
+    # Как и в app.py, запись и ротация файла идут в фоновом потоке
+    # QueueListener, а не в потоке, который пишет в лог
+    _log_queue = queue.Queue(-1)
+    logger.addHandler(QueueHandler(_log_queue))
+    _log_listener = QueueListener(_log_queue, file_handler, console_handler, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
 
 
 class MessengerService:
@@ -117,23 +147,17 @@ class MessengerService:
             shop_id: ID магазина (опционально)
             manager_id: ID менеджера (опционально)
             pool_only: Только чаты из пула
+            limit: Количество чатов (до 501 - одна лишняя строка для вычисления has_more)
+            with_total: Выполнить отдельный COUNT(*) для общего количества
         
         Returns:
             List[Dict] | Tuple[List[Dict], int]: Список чатов и, при необходимости, общее количество
         """
-        safe_limit = max(1, min(int(limit or 0), 500))
+        safe_limit = max(1, min(int(limit or 0), 501))
         safe_offset = max(0, int(offset or 0))
 
-        # Проверяем, существуют ли колонки first_name и last_name
-        has_name_columns = False
-        try:
-            cursor = self.conn.execute("PRAGMA table_info(users)")
-            columns_info = cursor.fetchall()
-            # PRAGMA table_info возвращает кортежи: (cid, name, type, notnull, dflt_value, pk)
-            user_columns = [row[1] if len(row) > 1 else str(row[0]) for row in columns_info]
-            has_name_columns = 'first_name' in user_columns and 'last_name' in user_columns
-        except Exception:
-            has_name_columns = False
+        # Наличие колонок first_name и last_name (проверяется один раз на процесс)
+        has_name_columns = check_name_columns(self.conn)
 
         base_query = '''
             FROM avito_chats c
@@ -183,10 +207,7 @@ class MessengerService:
                     ) as assigned_manager_name
                 {base_query}
                 {where_clause}
-                ORDER BY 
-                    CASE WHEN c.response_timer > 0 THEN 0 ELSE 1 END,
-                    c.response_timer DESC,
-                    c.updated_at DESC
+                ORDER BY {_CHAT_ORDER_BY}
                 LIMIT ? OFFSET ?
             '''
         else:
@@ -199,17 +220,85 @@ class MessengerService:
                     COALESCE(u.username, '') as assigned_manager_name
                 {base_query}
                 {where_clause}
-                ORDER BY 
-                    CASE WHEN c.response_timer > 0 THEN 0 ELSE 1 END,
-                    c.response_timer DESC,
-                    c.updated_at DESC
+                ORDER BY {_CHAT_ORDER_BY}
                 LIMIT ? OFFSET ?
             '''
         
         params_with_limits = params + [safe_limit, safe_offset]
         chats = self.conn.execute(query, tuple(params_with_limits)).fetchall()
-        
-        # Очищаем last_message и добавляем статусы
+        chats_list = self._prepare_chat_rows(chats)
+
+        if with_total:
+            return chats_list, (total or len(chats_list))
+        return chats_list
+
+    def get_chats_list_cursor(self, shop_id: Optional[int] = None,
+                              cursor: Optional[Tuple[str, int]] = None,
+                              limit: int = 100,
+                              pool_only: bool = False) -> List[Dict]:
+        """
+        Получить список чатов с keyset-пагинацией (без OFFSET)
+
+        Порядок тот же, что и в get_chats_list (см. _CHAT_SORT_COLUMNS), так что
+        оба режима отдают один и тот же список. Следующая страница начинается
+        строго после ключа сортировки последней строки предыдущей страницы,
+        поэтому глубокие страницы не сканируют пропущенные строки.
+
+        Args:
+            shop_id: ID магазина (опционально)
+            cursor: Ключ сортировки последней строки предыдущей страницы
+                (chat_sort_key) или None
+            limit: Количество чатов
+            pool_only: Только чаты из пула
+
+        Returns:
+            List[Dict]: Список чатов
+        """
+        safe_limit = max(1, min(int(limit or 0), 501))
+
+        conditions = ["c.status != 'completed'"]
+        params: List = []
+
+        if shop_id:
+            conditions.append('c.shop_id = ?')
+            params.append(shop_id)
+
+        if pool_only:
+            conditions.append('c.assigned_manager_id IS NULL')
+
+        if cursor:
+            conditions.append(f'{_CHAT_SORT_KEY_SQL} < (?, ?, ?, ?)')
+            params.extend(cursor)
+
+        if check_name_columns(self.conn):
+            manager_name_sql = """COALESCE(
+                    NULLIF(TRIM(u.first_name || ' ' || COALESCE(u.last_name, '')), ''),
+                    u.username,
+                    ''
+                )"""
+        else:
+            manager_name_sql = "COALESCE(u.username, '')"
+
+        query = f'''
+            SELECT
+                c.*,
+                s.name as shop_name,
+                s.is_active as shop_active,
+                s.client_id, s.client_secret, s.user_id, s.webhook_registered,
+                {manager_name_sql} as assigned_manager_name
+            FROM avito_chats c
+            LEFT JOIN avito_shops s ON c.shop_id = s.id
+            LEFT JOIN users u ON c.assigned_manager_id = u.id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {_CHAT_ORDER_BY}
+            LIMIT ?
+        '''
+        params.append(safe_limit)
+        chats = self.conn.execute(query, tuple(params)).fetchall()
+        return self._prepare_chat_rows(chats)
+
+    def _prepare_chat_rows(self, chats) -> List[Dict]:
+        """Очистить last_message и добавить статусы учетных данных для строк чатов"""
         chats_list = []
         chats_with_product_url = 0
         for chat in chats:
@@ -221,7 +310,7 @@ class MessengerService:
             if product_url_from_db:
                 chats_with_product_url += 1
                 if chats_with_product_url <= 3:  # Логируем только первые 3 для диагностики
-                    logger.info(f"[GET CHATS LIST] Чат {chat_dict.get('id')}: product_url найден в БД = {product_url_from_db}")
+                    logger.debug("[GET CHATS LIST] Чат %s: product_url найден в БД = %s", chat_dict.get('id'), product_url_from_db)
             
             client_id = chat_dict.pop('client_id', None)
             client_secret = chat_dict.pop('client_secret', None)
@@ -234,39 +323,30 @@ class MessengerService:
             
             chats_list.append(chat_dict)
         
-        logger.info(f"[GET CHATS LIST] Всего чатов: {len(chats_list)}, с product_url: {chats_with_product_url}")
-        
-        if with_total:
-            return chats_list, (total or len(chats_list))
+        logger.info("[GET CHATS LIST] Всего чатов: %s, с product_url: %s", len(chats_list), chats_with_product_url)
         return chats_list
     
-    def get_chat_messages(self, chat_id: int, limit: int = 100, offset: int = 0) -> Tuple[List[Dict], int]:
+    def get_chat_messages(self, chat_id: int, limit: int = 100, offset: int = 0,
+                          with_total: bool = True) -> Tuple[List[Dict], Optional[int]]:
         """
         Получить сообщения чата
         
         Args:
             chat_id: ID чата в БД
-            limit: Количество сообщений
+            limit: Количество сообщений (до 501 - одна лишняя строка для вычисления has_more)
             offset: Смещение
+            with_total: Вернуть общее количество сообщений (avito_chats.message_count)
         
         Returns:
-            Tuple[List[Dict], int]: (список сообщений, общее количество)
+            Tuple[List[Dict], Optional[int]]: (список сообщений, общее количество или None)
         """
-        safe_limit = max(1, min(int(limit or 0), 500))
+        safe_limit = max(1, min(int(limit or 0), 501))
         safe_offset = max(0, int(offset or 0))
 
-        logger.info(f"[GET MESSAGES] Загружаем сообщения для чата {chat_id}, limit={safe_limit}, offset={safe_offset}")
+        logger.info("[GET MESSAGES] Загружаем сообщения для чата %s, limit=%s, offset=%s", chat_id, safe_limit, safe_offset)
         
-        # Проверяем, существуют ли колонки first_name и last_name
-        has_name_columns = False
-        try:
-            cursor = self.conn.execute("PRAGMA table_info(users)")
-            columns_info = cursor.fetchall()
-            # PRAGMA table_info возвращает кортежи: (cid, name, type, notnull, dflt_value, pk)
-            user_columns = [row[1] if len(row) > 1 else str(row[0]) for row in columns_info]
-            has_name_columns = 'first_name' in user_columns and 'last_name' in user_columns
-        except Exception:
-            has_name_columns = False
+        # Наличие колонок first_name и last_name (проверяется один раз на процесс)
+        has_name_columns = check_name_columns(self.conn)
         
         # Получаем сообщения из БД
         if has_name_columns:
@@ -297,12 +377,16 @@ class MessengerService:
         
         logger.info(f"[GET MESSAGES] Найдено сообщений в БД: {len(messages)}")
         
-        total = self.conn.execute(
-            'SELECT COUNT(*) as count FROM avito_messages WHERE chat_id = ?',
-            (chat_id,)
-        ).fetchone()['count']
-        
-        logger.info(f"[GET MESSAGES] Всего сообщений в БД для чата {chat_id}: {total}")
+        total = None
+        if with_total:
+            # Счетчик поддерживается триггерами на avito_messages (см. init_database)
+            count_row = self.conn.execute(
+                'SELECT message_count FROM avito_chats WHERE id = ?',
+                (chat_id,)
+            ).fetchone()
+            total = (count_row['message_count'] or 0) if count_row else 0
+            
+            logger.info(f"[GET MESSAGES] Всего сообщений в БД для чата {chat_id}: {total}")
         
         messages_list = [dict(msg) for msg in messages]
         
@@ -688,6 +772,26 @@ class MessengerService:
                 if user_row:
                     sender_name = dict(user_row).get('username', 'Магазин') if not isinstance(user_row, dict) else user_row.get('username', 'Магазин')
             
+            self.save_outgoing_message(chat_id, message_text, sender_name, manager_id)
+            
+            logger.info(f"Сообщение отправлено в чат {chat_id}")
+            return True, None
+            
+        except Exception as e:
+            logger.error(f"Ошибка отправки сообщения в чат {chat_id}: {e}")
+            return False, str(e)
+    
+    def save_outgoing_message(self, chat_id: int, message_text: str,
+                              sender_name: str = 'Магазин', manager_id: Optional[int] = None):
+        """
+        Сохранить исходящее сообщение и обновить чат одной транзакцией
+        
+        BEGIN IMMEDIATE берет блокировку записи сразу, поэтому INSERT и UPDATE
+        выполняются без повторной эскалации блокировки при конкурентной синхронизации.
+        """
+        if not self.conn.in_transaction:
+            self.conn.execute('BEGIN IMMEDIATE')
+        try:
             self.conn.execute('''
                 INSERT INTO avito_messages (chat_id, message_text, message_type, sender_name, manager_id)
                 VALUES (?, ?, 'outgoing', ?, ?)
@@ -701,13 +805,9 @@ class MessengerService:
             ''', (message_text, chat_id))
             
             self.conn.commit()
-            
-            logger.info(f"Сообщение отправлено в чат {chat_id}")
-            return True, None
-            
-        except Exception as e:
-            logger.error(f"Ошибка отправки сообщения в чат {chat_id}: {e}")
-            return False, str(e)
+        except Exception:
+            self.conn.rollback()
+            raise
     
     def take_from_pool(self, chat_id: int, manager_id: int) -> bool:
         """Взять чат из пула"""
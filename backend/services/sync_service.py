@@ -28,8 +28,6 @@ class SyncService:
         Returns:
             Dict: Результаты синхронизации
         """
-        from avito_api import AvitoAPI
-        
         shops = self.conn.execute('''
             SELECT id, name, client_id, client_secret, user_id
             FROM avito_shops
@@ -72,7 +70,7 @@ class SyncService:
         Returns:
             Dict: Результат синхронизации
         """
-        from avito_api import AvitoAPI
+        from avito_api import get_avito_api
         from services.messenger_service import MessengerService
         
         result = {
@@ -86,10 +84,8 @@ class SyncService:
         }
         
         try:
-            api = AvitoAPI(
-                client_id=shop['client_id'],
-                client_secret=shop['client_secret']
-            )
+            # Клиент общий для процесса: токен не запрашивается заново при каждой синхронизации
+            api = get_avito_api(shop['client_id'], shop['client_secret'])
             
             # Получаем чаты
             chats_response = api.get_chats(user_id=shop['user_id'], limit=100, offset=0, timeout=10)
@@ -134,6 +130,7 @@ class SyncService:
             Dict: {'created': int, 'updated': int, 'messages': int}
         """
         from services.messenger_service import MessengerService
+        from utils.helpers import DIRECT_PRODUCT_URL_KEYS, first_present, normalize_avito_url
         
         api_chat_id = self.to_str(api_chat.get('id'))
         if not api_chat_id:
@@ -255,10 +252,7 @@ class SyncService:
         
         # Также проверяем прямые поля в api_chat (для обратной совместимости)
         if not product_url:
-            product_url = (api_chat.get('item_url') or 
-                          api_chat.get('listing_url') or 
-                          api_chat.get('ad_url') or
-                          api_chat.get('product_url'))
+            product_url = first_present(api_chat, DIRECT_PRODUCT_URL_KEYS)
             logger.debug(f"[SYNC CHAT] product_url из прямых полей api_chat: {product_url}")
         
         # Если product_url или listing_data отсутствуют, пытаемся получить через get_chat_by_id
@@ -294,11 +288,7 @@ class SyncService:
                                          detail_item.get('value') or
                                          detail_item.get('uri'))
                             if detail_url and not product_url:
-                                product_url = detail_url
-                                if product_url.startswith('/'):
-                                    product_url = f"https://www.avito.ru{product_url}"
-                                elif not product_url.startswith('http'):
-                                    product_url = f"https://www.avito.ru{product_url}"
+                                product_url = normalize_avito_url(detail_url)
                                 logger.info(f"[SYNC CHAT] ✅ product_url найден через get_chat_by_id context.value (url): {product_url}")
                             elif detail_item_id and not product_url:
                                 item_id_str = str(detail_item_id)
@@ -311,10 +301,7 @@ class SyncService:
                     
                     # Если не нашли в context, проверяем прямые поля
                     if not product_url:
-                        product_url = (chat_details.get('item_url') or 
-                                     chat_details.get('listing_url') or 
-                                     chat_details.get('ad_url') or
-                                     chat_details.get('product_url'))
+                        product_url = first_present(chat_details, DIRECT_PRODUCT_URL_KEYS)
                         if product_url:
                             logger.info(f"[SYNC CHAT] ✅ product_url найден через get_chat_by_id (прямые поля): {product_url}")
             except Exception as api_error:
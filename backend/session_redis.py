@@ -0,0 +1,195 @@
+"""
+OsaGaming CRM - Серверные сессии в Redis
+=========================================
+
+Хранение данных сессии Flask в Redis: в cookie уходит только короткий
+подписанный идентификатор сессии, а сами ключи (user_id, user_role, ...)
+лежат на сервере. Если Redis недоступен при старте, приложение работает со
+стандартными подписанными cookie-сессиями Flask; при сбое Redis во время
+работы запрос обслуживается cookie-сессией (SecureCookieSessionInterface).
+"""
+
+import logging
+import secrets
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SecureCookieSessionInterface, SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+logger = logging.getLogger(__name__)
+
+
+class RedisSession(CallbackDict, SessionMixin):
+    """Сессия, данные которой хранятся в Redis под ключом prefix + sid"""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class RedisSessionInterface(SessionInterface):
+    """
+    SessionInterface с хранением данных в Redis
+
+    Идентификатор сессии подписывается secret_key приложения (itsdangerous
+    Signer), поэтому подобрать чужой sid по cookie нельзя. Данные
+    сериализуются тем же TaggedJSONSerializer, что и cookie-сессии Flask,
+    и записываются только при изменении; для неизмененной постоянной сессии
+    лишь продлевается TTL ключа.
+
+    Если Redis не отвечает, сессия запроса читается и сохраняется через
+    SecureCookieSessionInterface, а после восстановления Redis данные такой
+    cookie-сессии переносятся в Redis под новым sid.
+
+    Args:
+        redis_client: Клиент redis (redis.Redis / StrictRedis)
+        key_prefix (str): Префикс ключей сессий в Redis
+    """
+
+    session_class = RedisSession
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, redis_client, key_prefix='session:'):
+        self.redis = redis_client
+        self.key_prefix = key_prefix
+        self.fallback = SecureCookieSessionInterface()
+
+    def _get_signer(self, app):
+        if not app.secret_key:
+            return None
+        return Signer(app.secret_key, salt='flask-session', key_derivation='hmac')
+
+    def _new_session(self):
+        return self.session_class(sid=secrets.token_urlsafe(32), new=True)
+
+    def regenerate(self, session):
+        """
+        Выдать сессии новый sid (защита от фиксации сессии при входе)
+
+        Данные старого sid удаляются из Redis; новый sid будет записан и
+        отправлен в cookie в save_session. Cookie-сессию (fallback) не трогает.
+        """
+        if not isinstance(session, RedisSession):
+            return
+        if not session.new:
+            try:
+                self.redis.delete(self.key_prefix + session.sid)
+            except Exception as e:
+                logger.warning(f"[SESSION] Не удалось удалить старую сессию из Redis: {e}")
+        session.sid = secrets.token_urlsafe(32)
+        session.new = True
+        session.modified = True
+
+    def _from_cookie_session(self, app, request):
+        """Перенести данные cookie-сессии, выданной при сбое Redis, в новую сессию"""
+        data = self.fallback.open_session(app, request)
+        session = self._new_session()
+        if data:
+            session.update(data)
+            session.modified = True
+        return session
+
+    def _save_fallback(self, app, session, response):
+        """Сохранить данные сессии в подписанную cookie, пока Redis недоступен"""
+        cookie_session = SecureCookieSession(dict(session))
+        cookie_session.modified = True
+        self.fallback.save_session(app, cookie_session, response)
+
+    def _ttl_seconds(self, app, session):
+        if session.permanent:
+            return int(app.permanent_session_lifetime.total_seconds())
+        # Несохраняемая между перезапусками браузера сессия - ограничиваем сутками
+        return 86400
+
+    def open_session(self, app, request):
+        signer = self._get_signer(app)
+        if signer is None:
+            return None
+
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if not cookie:
+            return self._new_session()
+
+        try:
+            sid = signer.unsign(cookie).decode('utf-8')
+        except BadSignature:
+            # Возможно, это cookie-сессия, выданная во время сбоя Redis
+            return self._from_cookie_session(app, request)
+
+        try:
+            raw = self.redis.get(self.key_prefix + sid)
+        except Exception as e:
+            logger.warning(f"[SESSION] Redis недоступен, используется cookie-сессия: {e}")
+            return self.fallback.open_session(app, request)
+
+        if raw is None:
+            return self._new_session()
+
+        try:
+            data = self.serializer.loads(raw)
+        except Exception:
+            return self._new_session()
+        return self.session_class(data, sid=sid)
+
+    def save_session(self, app, session, response):
+        if not isinstance(session, RedisSession):
+            # Сессия открыта через fallback (Redis не ответил при чтении)
+            self.fallback.save_session(app, session, response)
+            return
+
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            # Пустая сессия (например, после session.clear() в /logout) -
+            # удаляем данные на сервере и cookie у клиента
+            if session.modified:
+                try:
+                    self.redis.delete(self.key_prefix + session.sid)
+                except Exception as e:
+                    logger.warning(f"[SESSION] Не удалось удалить сессию из Redis: {e}")
+                response.delete_cookie(
+                    name, domain=domain, path=path, secure=secure,
+                    samesite=samesite, httponly=httponly,
+                )
+            return
+
+        if not self.should_set_cookie(app, session):
+            return
+
+        key = self.key_prefix + session.sid
+        ttl = self._ttl_seconds(app, session)
+        try:
+            if session.modified or session.new:
+                self.redis.setex(key, ttl, self.serializer.dumps(dict(session)))
+            else:
+                self.redis.expire(key, ttl)
+        except Exception as e:
+            logger.warning(f"[SESSION] Redis недоступен, сессия сохранена в cookie: {e}")
+            self._save_fallback(app, session, response)
+            return
+
+        response.vary.add('Cookie')
+        response.set_cookie(
+            name,
+            self._get_signer(app).sign(session.sid).decode('utf-8'),
+            expires=self.get_expiration_time(app, session),
+            httponly=httponly,
+            domain=domain,
+            path=path,
+            secure=secure,
+            samesite=samesite,
+        )
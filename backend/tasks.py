@@ -7,6 +7,7 @@ OsaGaming CRM - Асинхронные задачи
 - Загрузка сообщений
 - Отправка уведомлений
 - Обработка webhook'ов
+- Сохранение результатов поиска объявлений
 
 Автор: OsaGaming Development Team
 Версия: 1.0
@@ -51,12 +52,14 @@ try:
     except Exception as e:
         logger.warning(f"Не удалось подключиться к Redis для RQ: {e}. Асинхронные задачи будут отключены.")
         RQ_AVAILABLE = False
+        redis_conn = None
         default_queue = None
         sync_queue = None
         notifications_queue = None
 except ImportError:
     logger.warning("RQ не установлен. Установите: pip install rq")
     RQ_AVAILABLE = False
+    redis_conn = None
     default_queue = None
     sync_queue = None
     notifications_queue = None
@@ -68,7 +71,7 @@ def sync_all_chats_task():
     """
     try:
         from database import get_db_connection
-        from avito_api import AvitoAPI
+        from avito_api import get_avito_api
         from services.sync_service import SyncService
         
         logger.info("Начало синхронизации чатов (асинхронно)")
@@ -92,7 +95,7 @@ def sync_all_chats_task():
             for shop in shops:
                 try:
                     # Создаем API клиент для магазина
-                    api = AvitoAPI(shop['client_id'], shop['client_secret'])
+                    api = get_avito_api(shop['client_id'], shop['client_secret'])
                     
                     # Создаем сервис синхронизации
                     sync_service = SyncService(conn, api)
@@ -148,7 +151,7 @@ def sync_chat_messages_task(chat_id: int, user_id: str, avito_chat_id: str):
     """
     try:
         from database import get_db_connection
-        from avito_api import AvitoAPI
+        from avito_api import get_avito_api
         from services.messenger_service import MessengerService
         
         logger.info(f"Начало синхронизации сообщений для чата {chat_id}")
@@ -168,7 +171,7 @@ def sync_chat_messages_task(chat_id: int, user_id: str, avito_chat_id: str):
                 return {'status': 'error', 'error': 'Shop not found'}
             
             # Создаем API клиент
-            api = AvitoAPI(shop['client_id'], shop['client_secret'])
+            api = get_avito_api(shop['client_id'], shop['client_secret'])
             
             # Создаем сервис
             messenger_service = MessengerService(conn, api)
@@ -294,6 +297,102 @@ def process_webhook_task(webhook_data: Dict):
         }
 
 
+def extract_product_urls_task(limit: int = 500, after_id: Optional[int] = None,
+                              offset: Optional[int] = None):
+    """
+    Асинхронная задача для извлечения product_url у чатов без него
+    
+    Args:
+        limit: Размер страницы
+        after_id: Обработать чаты с id > after_id (keyset-пагинация)
+        offset: Устаревшая пагинация по смещению (если after_id не передан)
+    """
+    try:
+        from api.chats_api import EXTRACT_MAX_LIMIT, run_extract_product_urls
+        
+        # Параметры могли попасть в очередь в обход обработчика - приводим к int
+        limit = max(1, min(int(limit), EXTRACT_MAX_LIMIT))
+        after_id = max(int(after_id), 0) if after_id is not None else None
+        offset = max(int(offset), 0) if offset is not None else None
+        
+        logger.info(f"Извлечение product_url (асинхронно): limit={limit}, after_id={after_id}, offset={offset}")
+        job = get_current_job() if RQ_AVAILABLE else None
+        
+        def save_progress(processed, total):
+            # Прогресс читает GET /extract-all-product-urls-internal/status/<job_id>
+            job.meta['progress'] = {'processed': processed, 'total': total}
+            job.save_meta()
+        
+        result = run_extract_product_urls(limit=limit, after_id=after_id, offset=offset,
+                                          on_progress=save_progress if job else None)
+        result['status'] = 'success'
+        result['timestamp'] = datetime.now().isoformat()
+        return result
+        
+    except Exception as e:
+        logger.error(f"Критическая ошибка в extract_product_urls_task: {e}", exc_info=True)
+        return {
+            'status': 'error',
+            'error': str(e),
+            'timestamp': datetime.now().isoformat()
+        }
+
+
+def save_search_results_task(listings: List[Dict], search_params: Dict, user_id: int):
+    """
+    Асинхронная задача для сохранения результатов поиска объявлений
+    
+    Args:
+        listings: Найденные объявления
+        search_params: Параметры поиска (тело запроса /api/listings/search)
+        user_id: ID пользователя
+    """
+    try:
+        from api.listings_api import save_search_results
+        
+        result = save_search_results(listings, search_params, user_id)
+        result['status'] = 'success'
+        result['timestamp'] = datetime.now().isoformat()
+        return result
+        
+    except Exception as e:
+        logger.error(f"Ошибка в save_search_results_task: {e}", exc_info=True)
+        return {
+            'status': 'error',
+            'error': str(e),
+            'timestamp': datetime.now().isoformat()
+        }
+
+
+def get_job_status(job_id: str) -> Optional[Dict]:
+    """
+    Статус задачи RQ
+    
+    Args:
+        job_id: ID задачи
+    
+    Returns:
+        Dict: {'job_id', 'status', 'progress', 'result', 'error'} или None,
+        если задача не найдена или RQ недоступен
+    """
+    if not RQ_AVAILABLE:
+        return None
+    
+    try:
+        job = Job.fetch(job_id, connection=redis_conn)
+    except Exception:
+        return None
+    
+    status = job.get_status()
+    return {
+        'job_id': job.id,
+        'status': status,
+        'progress': job.meta.get('progress'),
+        'result': job.result if status == 'finished' else None,
+        'error': job.exc_info.splitlines()[-1] if status == 'failed' and job.exc_info else None
+    }
+
+
 def enqueue_sync_all_chats():
     """
     Поставить задачу синхронизации всех чатов в очередь
@@ -347,6 +446,70 @@ def enqueue_sync_chat_messages(chat_id: int, user_id: str, avito_chat_id: str):
         return sync_chat_messages_task(chat_id, user_id, avito_chat_id)
 
 
+def enqueue_extract_product_urls(limit: int = 500, after_id: Optional[int] = None,
+                                 offset: Optional[int] = None):
+    """
+    Поставить задачу извлечения product_url в очередь
+    
+    Args:
+        limit: Размер страницы
+        after_id: Обработать чаты с id > after_id
+        offset: Устаревшая пагинация по смещению
+    
+    Returns:
+        Job объект или результат синхронного выполнения, если RQ недоступен
+    """
+    if not RQ_AVAILABLE:
+        logger.warning("RQ недоступен, выполняется синхронное извлечение product_url")
+        return extract_product_urls_task(limit, after_id, offset)
+    
+    try:
+        job = sync_queue.enqueue(
+            extract_product_urls_task,
+            limit,
+            after_id,
+            offset,
+            job_timeout='15m'
+        )
+        logger.info(f"Задача извлечения product_url поставлена в очередь: {job.id}")
+        return job
+    except Exception as e:
+        logger.error(f"Ошибка постановки задачи в очередь: {e}")
+        # Fallback на синхронное выполнение
+        return extract_product_urls_task(limit, after_id, offset)
+
+
+def enqueue_save_search_results(listings: List[Dict], search_params: Dict, user_id: int):
+    """
+    Поставить задачу сохранения результатов поиска объявлений в очередь
+    
+    Args:
+        listings: Найденные объявления
+        search_params: Параметры поиска
+        user_id: ID пользователя
+    
+    Returns:
+        Job объект или результат синхронного выполнения, если RQ недоступен
+    """
+    if not RQ_AVAILABLE:
+        return save_search_results_task(listings, search_params, user_id)
+    
+    try:
+        job = default_queue.enqueue(
+            save_search_results_task,
+            listings,
+            search_params,
+            user_id,
+            job_timeout='2m'
+        )
+        logger.info(f"Задача сохранения результатов поиска поставлена в очередь: {job.id}")
+        return job
+    except Exception as e:
+        logger.error(f"Ошибка постановки задачи в очередь: {e}")
+        # Fallback на синхронное выполнение
+        return save_search_results_task(listings, search_params, user_id)
+
+
 def enqueue_notification(user_id: int, message: str, notification_type: str = 'info'):
     """
     Поставить задачу отправки уведомления в очередь
@@ -1,17 +1,23 @@
 """
 Utils package - вспомогательные модули
 """
-from .decorators import require_auth, require_role, handle_errors
-from .validators import validate_email, validate_phone
-from .helpers import log_activity, get_system_stats, check_name_columns
+from .decorators import require_auth, require_role, handle_errors, retry_on_sqlite_busy
+from .validators import validate_email, validate_phone, validate_send_message
+from .helpers import log_activity, get_system_stats, check_name_columns, first_present, normalize_avito_url
+from .ratelimit import TokenBucket
 
 __all__ = [
     'require_auth',
     'require_role', 
     'handle_errors',
+    'retry_on_sqlite_busy',
     'validate_email',
     'validate_phone',
+    'validate_send_message',
     'log_activity',
     'get_system_stats',
-    'check_name_columns'
+    'check_name_columns',
+    'first_present',
+    'normalize_avito_url',
+    'TokenBucket'
 ]
@@ -4,9 +4,27 @@
 from functools import wraps
 from flask import session, request, jsonify, redirect, render_template
 import logging
+import random
+import sqlite3
+import time
+from database import is_sqlite_io_error, reset_db_connection
 
 logger = logging.getLogger(__name__)
 
+# Первичные коды ошибок SQLite, после которых имеет смысл повторить запрос:
+# SQLITE_BUSY (5), SQLITE_LOCKED (6), SQLITE_IOERR (10)
+_SQLITE_RETRYABLE_CODES = frozenset((5, 6, 10))
+
+# Отдельный генератор для джиттера, чтобы не трогать глобальное состояние random
+_retry_random = random.Random()
+
+# Иерархия ролей для require_role: чем больше уровень, тем больше прав
+_ROLE_LEVELS = {
+    'manager': 1,
+    'admin': 2,
+    'super_admin': 3
+}
+
 
 def require_auth(f):
     """
@@ -61,20 +79,13 @@ def require_role(role):
     Returns:
         decorator: Декоратор для применения к функции
     """
+    # Требуемый уровень вычисляется один раз при декорировании
+    required_level = _ROLE_LEVELS.get(role, 999)
+
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            user_role = session.get('user_role')
-
-            # Иерархия ролей
-            role_hierarchy = {
-                'manager': 1,
-                'admin': 2,
-                'super_admin': 3
-            }
-
-            required_level = role_hierarchy.get(role, 999)
-            user_level = role_hierarchy.get(user_role, 0)
+            user_level = _ROLE_LEVELS.get(session.get('user_role'), 0)
 
             if user_level < required_level:
                 if request.is_json:
@@ -121,3 +132,59 @@ def handle_errors(f):
             # Для HTML запросов возвращаем страницу ошибки
             return render_template('error.html', error=str(error)), 500
     return decorated_function
+
+
+def retry_on_sqlite_busy(max_retries=3, base_ms=1, max_ms=100,
+                         retry_codes=('disk i/o error', 'database is locked')):
+    """
+    Декоратор для повтора функции при временных ошибках SQLite
+    
+    Повторяет вызов при sqlite3.OperationalError с кодом SQLITE_BUSY/LOCKED/IOERR
+    (или, если код недоступен, с текстом из retry_codes). Между попытками
+    используется экспоненциальная задержка с полным джиттером:
+    random.uniform(0, min(max_ms, base_ms * 2**attempt)) миллисекунд, чтобы
+    конкурирующие воркеры не просыпались одновременно.
+    После disk I/O ошибки глобальное соединение сбрасывается.
+    
+    Использование:
+        @app.route('/api/data')
+        @retry_on_sqlite_busy()
+        def get_data():
+            conn = get_db_connection()
+            ...
+    
+    Args:
+        max_retries (int): Максимальное количество попыток
+        base_ms (int): Базовая задержка в миллисекундах
+        max_ms (int): Верхняя граница задержки в миллисекундах
+        retry_codes (tuple): Фрагменты текста ошибки для повтора (fallback)
+    
+    Returns:
+        decorator: Декоратор для применения к функции
+    """
+    def is_retryable(error):
+        code = getattr(error, 'sqlite_errorcode', None)
+        if code is not None:
+            return (code & 0xFF) in _SQLITE_RETRYABLE_CODES
+        error_msg = str(error).lower()
+        return any(fragment in error_msg for fragment in retry_codes)
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            for attempt in range(max_retries):
+                try:
+                    return f(*args, **kwargs)
+                except sqlite3.OperationalError as error:
+                    if attempt >= max_retries - 1 or not is_retryable(error):
+                        raise
+                    if is_sqlite_io_error(error):
+                        reset_db_connection()
+                    delay_ms = _retry_random.uniform(0, min(max_ms, base_ms * (1 << attempt)))
+                    logger.warning(
+                        '[RETRY] %s: %s (попытка %d/%d), повтор через %.1f мс',
+                        f.__name__, error, attempt + 1, max_retries, delay_ms
+                    )
+                    time.sleep(delay_ms / 1000.0)
+        return decorated_function
+    return decorator
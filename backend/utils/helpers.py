@@ -3,28 +3,72 @@
 """
 import json
 import logging
+import re
 from flask import request
 from database import get_db_connection
 
 logger = logging.getLogger(__name__)
 
+AVITO_BASE_URL = 'https://www.avito.ru'
+_ABSOLUTE_URL_MATCH = re.compile(r'https?://', re.IGNORECASE).match
+_AVITO_HOST_MATCH = re.compile(r'(?:www\.)?avito\.ru/', re.IGNORECASE).match
+
+
+# Прямые поля чата Avito со ссылкой на объявление, в порядке приоритета
+DIRECT_PRODUCT_URL_KEYS = ('item_url', 'listing_url', 'ad_url', 'product_url')
+
+
+def first_present(data, keys):
+    """Первое непустое значение data[key] по ключам keys в заданном порядке (или None)"""
+    for key in keys:
+        value = data.get(key)
+        if value:
+            return value
+    return None
+
+
+def normalize_avito_url(url):
+    """
+    Привести ссылку Avito к абсолютному виду
+
+    '/brand/items/1', 'brand/items/1' и 'avito.ru/brand/items/1' дополняются
+    схемой и доменом, абсолютные ссылки возвращаются без изменений.
+    """
+    if _ABSOLUTE_URL_MATCH(url):
+        return url
+    if _AVITO_HOST_MATCH(url):
+        return f"https://{url}"
+    return f"{AVITO_BASE_URL}{url if url.startswith('/') else '/' + url}"
+
+
+# Результат check_name_columns: схема users меняется только миграциями
+# init_database при старте, поэтому достаточно одной проверки на процесс
+_has_name_columns = None
+
 
 def check_name_columns(conn):
     """
     Проверяет, существуют ли колонки first_name и last_name в таблице users.
     
+    PRAGMA table_info выполняется один раз, дальше возвращается
+    запомненный результат (ошибка проверки не запоминается).
+    
     Args:
         conn: Соединение с базой данных
         
     Returns:
         bool: True если обе колонки существуют, False в противном случае
     """
+    global _has_name_columns
+    if _has_name_columns is not None:
+        return _has_name_columns
     try:
         cursor = conn.execute("PRAGMA table_info(users)")
         columns_info = cursor.fetchall()
         # PRAGMA table_info возвращает кортежи: (cid, name, type, notnull, dflt_value, pk)
         user_columns = [row[1] if len(row) > 1 else str(row[0]) for row in columns_info]
-        return 'first_name' in user_columns and 'last_name' in user_columns
+        _has_name_columns = 'first_name' in user_columns and 'last_name' in user_columns
+        return _has_name_columns
     except Exception:
         return False
 
@@ -74,7 +118,6 @@ def log_activity(user_id, action_type, action_description=None, target_type=None
         # Если не удалось записать лог, логируем ошибку, но не прерываем выполнение
         logger.error(f'Error logging activity: {str(e)}')
     finally:
-        # Соединение глобальное, не закрываем
         pass
 
 
@@ -0,0 +1,52 @@
+"""
+Ограничение частоты запросов к внешним API
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Потокобезопасный token bucket
+
+    Пополняется со скоростью rate токенов в секунду, вмещает не более burst
+    токенов. acquire() блокирует вызывающий поток, пока не появится токен,
+    поэтому один экземпляр можно разделять между воркерами пула потоков.
+
+    Использование:
+        limiter = TokenBucket(rate=5.0, burst=10)
+        for chat in chats:
+            limiter.acquire()
+            api.get_chat_by_id(...)
+
+    Args:
+        rate (float): Скорость пополнения (токенов в секунду)
+        burst (int): Емкость ведра (максимальный всплеск запросов)
+    """
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self.rate = float(rate)
+        self.capacity = float(max(1, burst))
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Получить токен(ы), при необходимости дождавшись пополнения
+
+        Args:
+            tokens (int): Количество токенов
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
@@ -4,6 +4,26 @@
 import re
 
 
+# Регулярное выражение для проверки формата email
+# ^ - начало строки
+# [a-zA-Z0-9._%+-]+ - имя пользователя (один или более символов)
+# @ - символ @
+# [a-zA-Z0-9.-]+ - доменное имя
+# \. - точка перед доменом верхнего уровня
+# [a-zA-Z]{2,} - домен верхнего уровня (минимум 2 буквы)
+# $ - конец строки
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
+# Регулярное выражение для международного формата телефона:
+# ^\+? - необязательный знак + в начале
+# [1-9] - первая цифра не может быть 0
+# \d{1,14} - от 1 до 14 цифр (стандарт E.164)
+_PHONE_RE = re.compile(r'^\+?[1-9]\d{1,14}$')
+
+# Таблица для удаления пробелов и дефисов из номера телефона
+_PHONE_STRIP = str.maketrans('', '', ' -')
+
+
 def validate_email(email):
     """
     Валидация email адреса
@@ -21,16 +41,7 @@ def validate_email(email):
         validate_email("user@example.com") -> True
         validate_email("invalid.email") -> False
     """
-    # Регулярное выражение для проверки формата email
-    # ^ - начало строки
-    # [a-zA-Z0-9._%+-]+ - имя пользователя (один или более символов)
-    # @ - символ @
-    # [a-zA-Z0-9.-]+ - доменное имя
-    # \. - точка перед доменом верхнего уровня
-    # [a-zA-Z]{2,} - домен верхнего уровня (минимум 2 буквы)
-    # $ - конец строки
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    return _EMAIL_RE.match(email) is not None
 
 
 def validate_phone(phone):
@@ -51,13 +62,56 @@ def validate_phone(phone):
         validate_phone("7916-123-45-67") -> True (после удаления дефисов)
         validate_phone("123") -> False
     """
-    # Удаляем пробелы и дефисы для унификации формата
-    cleaned_phone = phone.replace(' ', '').replace('-', '')
-    
-    # Регулярное выражение для международного формата:
-    # ^\+? - необязательный знак + в начале
-    # [1-9] - первая цифра не может быть 0
-    # \d{1,14} - от 1 до 14 цифр (стандарт E.164)
-    pattern = r'^\+?[1-9]\d{1,14}$'
-    return re.match(pattern, cleaned_phone) is not None
+    # Удаляем пробелы и дефисы для унификации формата (один проход translate)
+    cleaned_phone = phone.translate(_PHONE_STRIP)
+    return _PHONE_RE.match(cleaned_phone) is not None
+
 
+
+MAX_MESSAGE_LENGTH = 5000
+
+
+def validate_send_message(data):
+    """
+    Валидация тела запроса на отправку сообщения в чат
+    
+    Проверяет тело запроса целиком за один проход: текст сообщения
+    (строка до MAX_MESSAGE_LENGTH символов) и вложения (список объектов с полем id).
+    Должно быть передано либо сообщение, либо хотя бы одно вложение.
+    
+    Args:
+        data (dict): Тело запроса {"message": str, "attachments": [{"id": ...}, ...]}
+    
+    Returns:
+        tuple: (message_text, attachments, error) - error равен None, если данные валидны;
+               message_text уже очищен от пробелов по краям или равен None
+    
+    Примеры:
+        validate_send_message({"message": " Привет "}) -> ("Привет", [], None)
+        validate_send_message({}) -> (None, [], "Either message text or attachments are required")
+    """
+    if not isinstance(data, dict):
+        return None, [], 'Request body must be a JSON object'
+    
+    message_text = data.get('message')
+    if message_text is not None and not isinstance(message_text, str):
+        return None, [], 'Message must be a string'
+    message_text = message_text.strip() if message_text else None
+    attachments = data.get('attachments') or []
+    
+    if not message_text and not attachments:
+        return None, [], 'Either message text or attachments are required'
+    
+    if message_text and len(message_text) > MAX_MESSAGE_LENGTH:
+        return None, [], f'Message is too long (max {MAX_MESSAGE_LENGTH} characters)'
+    
+    if not isinstance(attachments, list):
+        return None, [], 'Attachments must be a list'
+    
+    for i, attachment in enumerate(attachments):
+        if not isinstance(attachment, dict):
+            return None, [], f'Attachment {i} must be an object'
+        if 'id' not in attachment:
+            return None, [], f'Attachment {i} must have an "id" field'
+    
+    return message_text, attachments, None